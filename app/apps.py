@@ -1,5 +1,29 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from app import caching
 
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        if settings.CHIRP_SHARDS and settings.CHIRPER_FEED_SOURCE == 'timeline':
+            raise ImproperlyConfigured(
+                "CHIRPER_FEED_SOURCE = 'timeline' does not work with "
+                'CHIRP_SHARD_DATABASE_URLS: timeline entries are not written '
+                'while chirps are sharded.')
+        for name in ['FEED_CACHE_ALIAS', 'USERNAME_FILTER_CACHE_ALIAS']:
+            if settings.REPLICA_DATABASES and not caching.shared(
+                    getattr(settings, name)):
+                raise ImproperlyConfigured(
+                    'REPLICA_DATABASE_URL needs a {} cache that every process '
+                    'shares (CACHE_BACKEND set to memcached or redis): it '
+                    'remembers the writes replicas may not have yet.'.format(name))
+        if settings.CHIRP_SHARDS and not caching.shared(settings.FEED_CACHE_ALIAS):
+            raise ImproperlyConfigured(
+                'CHIRP_SHARD_DATABASE_URLS needs a FEED_CACHE_ALIAS cache that '
+                'every process shares (CACHE_BACKEND set to memcached or '
+                'redis): ETags of sharded feeds only change with the feed '
+                'versions kept there.')
@@ -0,0 +1,343 @@
+'''Keeps old chirps in compressed segment files instead of the database.
+
+`archive_chirps` moves chirps older than a cutoff out of the database into
+`settings.CHIRP_ARCHIVE_DIR`, one append-only segment file per batch. Files
+are never changed once written; a later run adds new ones. A segment file is
+
+    MAGIC | block ... | index entry ... | footer
+
+Each block holds up to `BLOCK_SIZE` chirps of one feed owner, newest first,
+as zlib-compressed JSON. A chirp is stored in the blocks of its author and of
+every user it mentions, so reading a feed never has to look anywhere else.
+The index has one fixed-size `ENTRY` per block, sorted by owner and then
+newest block first, and records the newest and oldest chirp in the block.
+The footer says where the index starts. Segments are read through `mmap`: the
+index is binary searched in place and only the blocks a page needs are
+decompressed.
+
+`ChirperUser.feed` wraps its query in a `ContinuedFeed`, which reads the
+archive once the database has no more chirps for the page. Archived chirps
+are assumed to be older than every chirp left in the database, which holds
+as long as chirps are written with the current time. Within the archive,
+chirps are sorted by `(date, id)`, whichever way the database sorts them, see
+`pagination.newest_first`. Archived chirps no longer show up in searches or
+on tag pages.
+'''
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import prefetch_related_objects
+
+from app import pagination
+
+MAGIC = b'CHIRPSEG1\n'
+
+# owner id, newest date, newest id, oldest date, oldest id, offset, length,
+# number of chirps. Dates are microseconds since the Unix epoch.
+ENTRY = struct.Struct('<qqqqqQII')
+
+# Offset of the index, number of index entries, `MAGIC` again.
+FOOTER = struct.Struct('<QI10s')
+
+BLOCK_SIZE = 256
+
+SUFFIX = '.chirps'
+
+# The fields of a record, and the order `Chirp.from_db` takes them in.
+FIELDS = ['id', 'message', 'author_id', 'date']
+
+_UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_lock = threading.Lock()
+_open = {'directory': None, 'mtime': None, 'segments': {}}
+
+
+class CorruptSegment(ValueError):
+    pass
+
+
+def enabled() -> bool:
+    return bool(settings.CHIRP_ARCHIVE_DIR)
+
+
+def micros(date: datetime) -> int:
+    return (date - _UNIX_EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(us: int) -> datetime:
+    return _UNIX_EPOCH + timedelta(microseconds=us)
+
+
+def write_segment(chirps: list, mentions) -> str:
+    '''Writes a new segment file and returns its path.
+
+    `chirps` are `(id, date, author_id, message)` tuples and `mentions`
+    `(chirp_id, chirperuser_id)` pairs for them. The file is synced to disk
+    before it is renamed into place, so readers never see part of one.
+    '''
+    directory = settings.CHIRP_ARCHIVE_DIR
+    os.makedirs(directory, exist_ok=True)
+    feeds = {}
+    records = {}
+    for id, date, author_id, message in chirps:
+        records[id] = [id, micros(date), author_id, message]
+        feeds.setdefault(author_id, []).append(records[id])
+    for chirp_id, chirperuser_id in mentions:
+        # A chirp mentioning its own author is in that feed once.
+        if chirperuser_id != records[chirp_id][2]:
+            feeds.setdefault(chirperuser_id, []).append(records[chirp_id])
+
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            entries = []
+            for owner_id in sorted(feeds):
+                feed = sorted(
+                    feeds[owner_id], key=lambda r: (r[1], r[0]), reverse=True)
+                for i in range(0, len(feed), BLOCK_SIZE):
+                    block = feed[i:i + BLOCK_SIZE]
+                    data = zlib.compress(
+                        json.dumps(block, separators=(',', ':')).encode('utf-8'))
+                    entries.append(ENTRY.pack(
+                        owner_id, block[0][1], block[0][0], block[-1][1],
+                        block[-1][0], f.tell(), len(data), len(block)))
+                    f.write(data)
+            index = f.tell()
+            f.writelines(entries)
+            f.write(FOOTER.pack(index, len(entries), MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        path = os.path.join(
+            directory, '{:020d}-{}{}'.format(time.time_ns(), os.getpid(), SUFFIX))
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+    return path
+
+
+class Segment:
+    '''`Segment` reads one segment file through a read-only memory map.
+
+    It is safe to share between threads.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if (len(self.map) < len(MAGIC) + FOOTER.size or
+                self.map[:len(MAGIC)] != MAGIC):
+            raise CorruptSegment(path)
+        self.index, self.entries, magic = FOOTER.unpack_from(
+            self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC:
+            raise CorruptSegment(path)
+
+    def entry(self, i: int) -> tuple:
+        return ENTRY.unpack_from(self.map, self.index + i * ENTRY.size)
+
+    def first_entry(self, owner_id: int) -> int:
+        'Returns the index of the first entry of `owner_id`, or where it would be.'
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < owner_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def owner_entries(self, owner_id: int):
+        for i in range(self.first_entry(owner_id), self.entries):
+            entry = self.entry(i)
+            if entry[0] != owner_id:
+                return
+            yield entry
+
+    def count(self, owner_id: int) -> int:
+        return sum(entry[7] for entry in self.owner_entries(owner_id))
+
+    def newest(self, owner_id: int, before=None):
+        '''Returns a `(date, id)` no older than the first record `records` yields, or `None` if it yields nothing.
+
+        Only the index is read.
+        '''
+        for entry in self.owner_entries(owner_id):
+            newest, oldest = entry[1:3], entry[3:5]
+            if before is None:
+                return newest
+            if oldest < before:
+                return min(newest, before)
+        return None
+
+    def records(self, owner_id: int, before=None):
+        '''Yields the `[id, date, author_id, message]` records in `owner_id`'s feed, newest first.
+
+        `before` is a `(date, id)` pair with the date in microseconds, and
+        limits the records to those after it. Blocks with nothing after it
+        are skipped without being decompressed.
+        '''
+        for _, _, _, oldest_date, oldest_id, offset, length, _ in \
+                self.owner_entries(owner_id):
+            if before is not None and (oldest_date, oldest_id) >= before:
+                continue
+            block = json.loads(
+                zlib.decompress(self.map[offset:offset + length]))
+            for record in block:
+                if before is None or (record[1], record[0]) < before:
+                    yield record
+
+
+def segments() -> list:
+    '''Returns the `Segment`s in the archive directory.
+
+    Segments stay open for the life of the process. The directory is only
+    listed again when its modification time changes, which it does when
+    `write_segment` adds a file.
+    '''
+    directory = settings.CHIRP_ARCHIVE_DIR
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    with _lock:
+        if _open['directory'] != directory or _open['mtime'] != mtime:
+            names = sorted(
+                name for name in os.listdir(directory) if name.endswith(SUFFIX))
+            opened = _open['segments'] if _open['directory'] == directory else {}
+            _open['segments'] = {
+                name: opened.get(name) or Segment(os.path.join(directory, name))
+                for name in names
+            }
+            _open['directory'] = directory
+            _open['mtime'] = mtime
+        return list(_open['segments'].values())
+
+
+def records(owner_id: int, before=None):
+    '''Yields the archived `(id, message, author_id, date)` records of `owner_id`'s feed, newest first.
+
+    `before` is a `(date, id)` pair, as for `ChirperUser.feed`. The segments
+    are merged with a heap, and a segment is only read once the merge gets
+    down to the newest record its index says it has, so a page usually
+    decompresses blocks of one or two segments only.
+    '''
+    if before is not None:
+        before = (micros(before[0]), before[1])
+    pending = []
+    for segment in segments():
+        newest = segment.newest(owner_id, before)
+        if newest is not None:
+            pending.append((newest, segment))
+    # Newest last, for `pop`.
+    pending.sort(key=lambda item: item[0])
+    heap = []
+    order = itertools.count()
+
+    def push(iterator):
+        record = next(iterator, None)
+        if record is not None:
+            heapq.heappush(
+                heap, (-record[1], -record[0], next(order), record, iterator))
+
+    while heap or pending:
+        while pending and (
+                not heap or pending[-1][0] >= (-heap[0][0], -heap[0][1])):
+            push(pending.pop()[1].records(owner_id, before))
+        if heap:
+            _, _, _, record, iterator = heapq.heappop(heap)
+            id, date, author_id, message = record
+            yield id, message, author_id, from_micros(date)
+            push(iterator)
+
+
+def count(owner_id: int, before=None) -> int:
+    if before is None:
+        return sum(segment.count(owner_id) for segment in segments())
+    return sum(1 for _ in records(owner_id, before))
+
+
+def has_author(chirp) -> bool:
+    try:
+        chirp.author
+    except ObjectDoesNotExist:
+        return False
+    return True
+
+
+class ContinuedFeed(pagination.LazyFeed):
+    '''`ContinuedFeed` is a newest-first feed that continues into the archive where `hot` ends.
+
+    `hot` is the feed's query on the database, a queryset or a
+    `sharding.MergedQuerySet`. Slices are read from `hot` first, and only
+    when it runs out before the slice is full are the rest read from the
+    archive, after the last chirp `hot` returned. Archived chirps are built
+    with `model.from_db`, and `prefetch` lookups are loaded for them. Those
+    whose prefetched author has been deleted since are left out.
+    '''
+
+    def __init__(self, hot, model, owner_id: int, before=None, prefetch=(),
+                 start=0, stop=None):
+        super().__init__(start, stop)
+        self.hot = hot
+        self.model = model
+        self.owner_id = owner_id
+        self.before = before
+        self.prefetch = prefetch
+
+    def copy(self, start, stop) -> 'ContinuedFeed':
+        return ContinuedFeed(self.hot, self.model, self.owner_id, self.before,
+                             self.prefetch, start, stop)
+
+    def count(self) -> int:
+        total = self.hot.count() + count(self.owner_id, self.before)
+        if self.stop is not None:
+            total = min(total, self.stop)
+        return max(0, total - self.start)
+
+    def fetch(self) -> list:
+        chirps = list(self.hot[self.start:self.stop])
+        wanted = None if self.stop is None else self.stop - self.start
+        if wanted is not None and len(chirps) >= wanted:
+            return chirps
+        skip, before = 0, self.before
+        if chirps:
+            before = (chirps[-1].date, chirps[-1].id)
+        elif self.start:
+            skip = max(0, self.start - self.hot.count())
+        remaining = itertools.islice(records(self.owner_id, before), skip, None)
+        archived = []
+        while True:
+            batch = [
+                self.model.from_db(None, FIELDS, record)
+                for record in itertools.islice(
+                    remaining,
+                    None if wanted is None else wanted - len(chirps) - len(archived))
+            ]
+            if not batch:
+                break
+            if self.prefetch:
+                prefetch_related_objects(batch, *self.prefetch)
+                batch = [chirp for chirp in batch if has_author(chirp)]
+            archived += batch
+            if wanted is None or len(chirps) + len(archived) >= wanted:
+                break
+        return chirps + archived
@@ -0,0 +1,80 @@
+'''Async versions of the read-only views, for running under ASGI.
+
+They use Django's async ORM, so a worker can serve other requests while
+these wait on the database. `app.urls` routes to them when
+`settings.CHIRPER_ASYNC_VIEWS` is set, which `chirper.asgi` does by default.
+'''
+from http import HTTPStatus
+
+from asgiref.sync import sync_to_async
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.http import HttpRequest, HttpResponse
+
+from app import (archive, feed_cache, pagination, replicas, sharding,
+                 usernames, views)
+from app.models import ChirperUser
+from app.replicas import replica_reads
+from app.views import (JsonResponse, acached_feed_response, afeed_response,
+                       afind_feed_owner, feed_etag, feed_page_params,
+                       username_exists_response)
+
+
+@replica_reads
+async def feed(request: HttpRequest, username: str) -> HttpResponse:
+    '''Returns a page of `username`'s feed, like `app.views.feed`.
+
+    `?stream=1` is not supported here and returns the page in one piece.
+    When chirps are sharded or archived, the sync view is run in a thread
+    instead, since shards are read on a thread pool anyway and the archive is
+    read from files.
+    '''
+    if sharding.enabled() or archive.enabled():
+        return await sync_to_async(views.feed)(request, username)
+    try:
+        chirper = await afind_feed_owner(username)
+    except ChirperUser.DoesNotExist:
+        return JsonResponse({}, HTTPStatus.NOT_FOUND)
+    page_params = feed_page_params(request)
+    version = await feed_cache.aversion(chirper.id)
+    etag = feed_etag(chirper, page_params, version)
+    cache_key = feed_cache.page_key(chirper.id, etag, version)
+    response = await acached_feed_response(request, etag, cache_key)
+    if response is not None:
+        return response
+
+    cursor = request.GET.get('before')
+    if cursor is None:
+        feed = chirper.feed()
+        paginator = Paginator(feed, pagination.PAGE_SIZE)
+        paginator.count = await feed.acount()
+        page = request.GET.get('page')
+        try:
+            page = paginator.page(page)
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+        chirps = [chirp async for chirp in page.object_list]
+        extra = {}
+    else:
+        try:
+            before = pagination.decode_cursor(cursor) if cursor else None
+        except pagination.InvalidCursor:
+            return JsonResponse({
+                'error': 'INVALID_CURSOR'
+            }, HTTPStatus.BAD_REQUEST)
+        chirps, next_cursor = await pagination.akeyset_page(
+            chirper.feed(before, limit=pagination.PAGE_SIZE + 1))
+        extra = {'next_cursor': next_cursor}
+
+    return await afeed_response(chirper, chirps, extra, etag, cache_key)
+
+
+@replica_reads
+async def username_exists(request: HttpRequest, username: str) -> HttpResponse:
+    if (replicas.reading_replica() and
+            await usernames.asaved_recently(username)):
+        # The replica may not have the user yet.
+        replicas.read_from_primary()
+    return username_exists_response(
+        request, await ChirperUser.ausername_exists(username))
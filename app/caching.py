@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+class TTLCache:
+    '''`TTLCache` is a small, thread safe, in-process LRU cache whose entries expire.
+
+    Once `maxsize` entries are stored the least recently used one is evicted.
+    Entries older than `ttl` seconds are treated as missing. `hits` and
+    `misses` count lookups, for reporting.
+    '''
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= now:
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def shared(alias: str) -> bool:
+    '''`shared` tells whether every process sees the same Django cache `alias`.
+
+    The in-memory and dummy backends keep nothing beyond the current process,
+    every other backend is taken to be shared.
+    '''
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
@@ -0,0 +1,141 @@
+'''Caches serialized feed pages in Django's cache framework.
+
+Every cached page is keyed by its owner's feed version. Writes that change a
+feed bump the version instead of deleting pages, so stale pages are simply
+never looked up again and expire on their own.
+'''
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from app import metrics
+
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0}
+
+
+def cache():
+    return caches[settings.FEED_CACHE_ALIAS]
+
+
+def version_key(chirper_id) -> str:
+    return 'feed-version:{}'.format(chirper_id)
+
+
+def version(chirper_id) -> int:
+    '''Returns the current feed version of the `ChirperUser` with id `chirper_id`.
+
+    A missing version is started at the current time in microseconds rather
+    than at 1, so a version that was evicted never comes back with a number
+    that old pages were cached under.
+    '''
+    key = version_key(chirper_id)
+    current = cache().get(key)
+    if current is None:
+        cache().add(key, int(time.time() * 1000000), None)
+        current = cache().get(key)
+    return current
+
+
+async def aversion(chirper_id) -> int:
+    'The async version of `version`.'
+    key = version_key(chirper_id)
+    current = await cache().aget(key)
+    if current is None:
+        await cache().aadd(key, int(time.time() * 1000000), None)
+        current = await cache().aget(key)
+    return current
+
+
+def bump(chirper_ids, using=None):
+    '''Moves the feeds of `chirper_ids` to a new version.
+
+    The versions are bumped right away, so later reads in the writing
+    transaction miss the cache, and again once the transaction on database
+    `using` commits, so pages cached from before the commit are not served
+    afterwards. With read replicas, the feeds are also marked as written for
+    `REPLICA_PIN_SECONDS` seconds, see `written_recently`.
+    '''
+    chirper_ids = set(chirper_ids)
+    _bump(chirper_ids)
+    transaction.on_commit(lambda: _bump(chirper_ids), using=using)
+
+
+def _bump(chirper_ids):
+    for chirper_id in chirper_ids:
+        key = version_key(chirper_id)
+        try:
+            cache().incr(key)
+        except ValueError:
+            cache().add(key, int(time.time() * 1000000), None)
+    if settings.REPLICA_DATABASES:
+        cache().set_many(
+            {written_key(chirper_id): True for chirper_id in chirper_ids},
+            settings.REPLICA_PIN_SECONDS)
+
+
+def written_key(chirper_id) -> str:
+    return 'feed-written:{}'.format(chirper_id)
+
+
+def written_recently(chirper_id) -> bool:
+    'Returns whether the feed of `chirper_id` changed too recently for read replicas to have caught up.'
+    return cache().get(written_key(chirper_id)) is not None
+
+
+async def awritten_recently(chirper_id) -> bool:
+    'The async version of `written_recently`.'
+    return await cache().aget(written_key(chirper_id)) is not None
+
+
+def page_key(chirper_id, page: str, feed_version=None) -> str:
+    '''Returns the cache key for the page of a feed described by `page`.
+
+    `feed_version` is the feed's current `version`, if the caller already
+    has it.
+    '''
+    if feed_version is None:
+        feed_version = version(chirper_id)
+    digest = hashlib.md5(page.encode('utf-8')).hexdigest()
+    return 'feed-page:{}:{}:{}'.format(chirper_id, feed_version, digest)
+
+
+def get_page(key):
+    content = cache().get(key)
+    _count(content)
+    return content
+
+
+async def aget_page(key):
+    content = await cache().aget(key)
+    _count(content)
+    return content
+
+
+def _count(content):
+    with _lock:
+        _counters['hits' if content is not None else 'misses'] += 1
+
+
+def set_page(key, content):
+    cache().set(key, content, settings.FEED_CACHE_TIMEOUT)
+
+
+async def aset_page(key, content):
+    await cache().aset(key, content, settings.FEED_CACHE_TIMEOUT)
+
+
+def counters() -> dict:
+    'Returns the number of feed cache hits and misses in this process.'
+    with _lock:
+        return dict(_counters)
+
+
+metrics.register_collector(lambda: {
+    'chirper_feed_cache_hits_total': _counters['hits'],
+    'chirper_feed_cache_misses_total': _counters['misses'],
+})
@@ -0,0 +1,51 @@
+'''Runs password hashing on a small pool of worker threads.
+
+Hashing a password is deliberately slow. Doing it on the request thread ties
+that thread up for the whole hash, so a burst of logins starves every other
+view. The pool bounds how many hashes run at once, and `run` refuses work once
+`PASSWORD_HASH_QUEUE` callers are already waiting, so an overloaded server
+answers quickly instead of queueing logins without limit.
+
+This only helps when a process serves several requests at once, which is
+why gunicorn.conf.py runs threaded workers. A sync worker serves one request
+at a time, so its pool never has more than one hash to run.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+
+class Busy(Exception):
+    'Raised by `run` when every worker is busy and the queue is full.'
+
+
+def _pool():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            workers = settings.PASSWORD_HASH_WORKERS
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='password-hash')
+            _slots = threading.BoundedSemaphore(
+                workers + settings.PASSWORD_HASH_QUEUE)
+        return _executor, _slots
+
+
+def run(fn, *args):
+    '''Calls `fn(*args)` on the hashing pool and waits for the result.
+
+    Raises `Busy` without waiting if the pool already has as much work as it
+    is allowed to queue.
+    '''
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        raise Busy()
+    try:
+        return executor.submit(fn, *args).result()
+    finally:
+        slots.release()
@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from app import archive
+from app.models import Chirp, Mention
+
+
+class Command(BaseCommand):
+    help = '''Moves chirps older than --days days out of the database into the archive, see `app.archive`.
+
+    Chirps are read oldest first, --batch-size at a time, and each batch is
+    written to a new segment file in CHIRP_ARCHIVE_DIR while the transaction
+    deleting it from the database is still open. The chirps' mentions,
+    timeline entries and hashtag links are deleted with them, so feeds keep
+    showing archived chirps but tag pages and searches do not. Should the
+    commit fail after the file was written, the batch shows up twice in feeds
+    until that file is removed. When chirps are sharded, every shard is
+    archived.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=365,
+            help='Archive chirps written more than this many days ago.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50000,
+            help='Number of chirps per segment file.')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many chirps would be archived.')
+
+    def handle(self, *args, **options):
+        if not archive.enabled():
+            raise CommandError('Set CHIRP_ARCHIVE_DIR to archive chirps.')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        total = 0
+        for db in settings.CHIRP_SHARDS or [router.db_for_write(Chirp)]:
+            if options['dry_run']:
+                count = Chirp.objects.using(db).filter(date__lt=cutoff).count()
+            else:
+                count = archive_before(cutoff, db, options['batch_size'])
+            total += count
+            self.stdout.write('{} {} chirps from {}.'.format(
+                'Would archive' if options['dry_run'] else 'Archived', count, db))
+        self.stdout.write('{} {} chirps written before {}.'.format(
+            'Would archive' if options['dry_run'] else 'Archived', total,
+            cutoff.isoformat()))
+
+
+def archive_before(cutoff, db, batch_size) -> int:
+    'Archives the chirps in database `db` written before `cutoff`, and returns how many there were.'
+    archived = 0
+    while True:
+        with transaction.atomic(using=db):
+            chirps = list(
+                Chirp.objects.using(db).filter(date__lt=cutoff)
+                .order_by('date', 'id')
+                .values_list('id', 'date', 'author_id', 'message')[:batch_size])
+            if not chirps:
+                return archived
+            _, last_date, _, _ = chirps[-1]
+            # The batch, without a parameter per chirp.
+            batch = Q(date__lt=last_date) | Q(date=last_date, id__lte=chirps[-1][0])
+            mentions = Mention.objects.using(db).filter(
+                chirp__in=Chirp.objects.using(db).filter(batch).values('id')
+            ).values_list('chirp_id', 'chirperuser_id')
+            archive.write_segment(chirps, list(mentions))
+            Chirp.objects.using(db).filter(batch).delete()
+        archived += len(chirps)
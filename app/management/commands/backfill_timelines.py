@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app import sharding
+from app.models import Chirp, Mention, TimelineEntry
+
+
+class Command(BaseCommand):
+    help = ('Fills in the TimelineEntry rows for existing chirps, '
+            'or checks them with --verify.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of chirps to handle per batch.')
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Only report chirps whose timeline entries are missing or extra.')
+
+    def handle(self, *args, **options):
+        if sharding.enabled():
+            raise CommandError(
+                'Timelines are not used while chirps are sharded.')
+        batch_size = options['batch_size']
+        seen = missing = extra = 0
+        for chirps in chirp_batches(batch_size):
+            seen += len(chirps)
+            expected = expected_entries(chirps)
+            if options['verify']:
+                actual = set(
+                    TimelineEntry.objects.filter(
+                        chirp_id__in=[id for id, _, _ in chirps])
+                    .values_list('owner_id', 'chirp_id'))
+                missing += len(expected.keys() - actual)
+                extra += len(actual - expected.keys())
+            else:
+                TimelineEntry.objects.bulk_create(
+                    [
+                        TimelineEntry(owner_id=owner_id, chirp_id=chirp_id,
+                                      date=date)
+                        for (owner_id, chirp_id), date in expected.items()
+                    ],
+                    ignore_conflicts=True)
+
+        if not options['verify']:
+            self.stdout.write('Backfilled timelines for {} chirps.'.format(seen))
+        elif missing or extra:
+            raise CommandError(
+                'Timelines are out of date: {} entries missing, {} extra.'.format(
+                    missing, extra))
+        else:
+            self.stdout.write(
+                'Timelines match chirps and mentions for {} chirps.'.format(seen))
+
+
+def chirp_batches(batch_size):
+    'Yields lists of `(id, author_id, date)` for every chirp, in id order.'
+    last_id = 0
+    while True:
+        chirps = list(
+            Chirp.objects.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'author_id', 'date')[:batch_size])
+        if not chirps:
+            return
+        yield chirps
+        last_id = chirps[-1][0]
+
+
+def expected_entries(chirps):
+    'Returns `{(owner_id, chirp_id): date}` for the timeline entries `chirps` should have.'
+    dates = {id: date for id, _, date in chirps}
+    expected = {(author_id, id): date for id, author_id, date in chirps}
+    mentions = Mention.objects.filter(chirp_id__in=dates).values_list(
+        'chirperuser_id', 'chirp_id')
+    for owner_id, chirp_id in mentions:
+        expected[owner_id, chirp_id] = dates[chirp_id]
+    return expected
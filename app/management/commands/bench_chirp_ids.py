@@ -0,0 +1,74 @@
+import multiprocessing
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import snowflake
+
+
+class Command(BaseCommand):
+    help = ('Measures how fast app.snowflake hands out chirp ids in forked '
+            'worker processes, the way gunicorn runs them, and checks that '
+            'no id is handed out twice. Does not touch the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            default='1,2,4,8',
+            help='Comma separated numbers of worker processes to measure with.')
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=1,
+            help='Threads per process, sharing the process\'s generator.')
+        parser.add_argument(
+            '--ids',
+            type=int,
+            default=200000,
+            help='Number of ids each process makes.')
+
+    def handle(self, *args, **options):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError('This benchmark needs fork() to start workers.')
+        context = multiprocessing.get_context('fork')
+        self.stdout.write('{:>9} {:>7} {:>14} {:>14} {:>10}'.format(
+            'processes', 'threads', 'ids/s/process', 'ids/s total', 'unique'))
+        for processes in [int(n) for n in options['processes'].split(',')]:
+            with context.Pool(processes) as pool:
+                results = pool.starmap(
+                    make_ids,
+                    [(worker, options['threads'], options['ids'])
+                     for worker in range(processes)])
+            elapsed = max(seconds for seconds, _ in results)
+            ids = [id for _, worker_ids in results for id in worker_ids]
+            rate = options['ids'] / elapsed
+            self.stdout.write('{:>9} {:>7} {:>14,.0f} {:>14,.0f} {:>10}'.format(
+                processes, options['threads'], rate, rate * processes,
+                'yes' if len(set(ids)) == len(ids) else 'NO'))
+
+
+def make_ids(worker, threads, count):
+    '''Makes `count` ids with worker id `worker` on `threads` threads.
+
+    Returns the seconds it took and the ids. Each thread checks that the ids it
+    gets increase.
+    '''
+    generator = snowflake.Generator(worker)
+    per_thread = [count // threads + (i < count % threads) for i in range(threads)]
+    made = [[] for _ in range(threads)]
+
+    def run(i):
+        ids = made[i]
+        for _ in range(per_thread[i]):
+            ids.append(generator.next_id())
+        if any(a >= b for a, b in zip(ids, ids[1:])):
+            raise AssertionError('Ids did not increase.')
+
+    workers = [threading.Thread(target=run, args=(i, )) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start, [id for ids in made for id in ids]
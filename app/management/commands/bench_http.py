@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = '''Sends concurrent GET requests to a running server and reports requests/sec and latency as JSON.
+
+    To compare the sync and async deployments, start each one with the same
+    number of worker processes, for example
+
+        gunicorn chirper.wsgi -w 4
+        gunicorn chirper.asgi:application -w 4 -k uvicorn.workers.UvicornWorker
+
+    and run this command against each with --server-pid set to the gunicorn
+    master, so the report includes the memory the workers used.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help='For example http://127.0.0.1:8000')
+        parser.add_argument(
+            '--path',
+            action='append',
+            dest='paths',
+            help='Path to request; may be repeated. Requests cycle through them.')
+        parser.add_argument('--concurrency', type=int, default=32)
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=5000,
+            help='Total number of requests to send.')
+        parser.add_argument(
+            '--server-pid',
+            type=int,
+            help='Report the resident memory of this process and its children.')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/api/username_exists/nobody/']
+        urls = [options['base_url'].rstrip('/') + path for path in paths]
+        latencies, errors, elapsed = run_load(urls, options['requests'],
+                                              options['concurrency'])
+        report = summarize(latencies, elapsed)
+        report['errors'] = errors
+        report['concurrency'] = options['concurrency']
+        if options['server_pid']:
+            report['server_rss_kib'] = tree_rss_kib(options['server_pid'])
+        self.stdout.write(json.dumps(report, indent=2))
+
+
+def run_load(urls, total, concurrency):
+    'Requests `urls` round robin `total` times from `concurrency` threads.'
+    latencies = []
+    errors = [0]
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urls[i % len(urls)]) as response:
+                    response.read()
+            except (urllib.error.URLError, OSError):
+                with lock:
+                    errors[0] += 1
+                continue
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    'Returns throughput and latency percentiles, in milliseconds, as a dict.'
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+    }
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def tree_rss_kib(pid):
+    'Returns the resident memory of `pid` and its descendants, read from /proc.'
+    total = 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open('/proc/{}/status'.format(pid)) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            for task in os.listdir('/proc/{}/task'.format(pid)):
+                with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return total
@@ -0,0 +1,130 @@
+import json
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from app import serializers
+from app.models import Chirp, ChirperUser
+
+
+class Command(BaseCommand):
+    help = ('Compares the old json.dumps response helper with app.serializers '
+            'and the streaming feed writer, in bytes/sec and peak memory. '
+            'Runs on in-memory chirps and does not touch the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='25,500,10000',
+            help='Comma separated numbers of chirps per response.')
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=20,
+            help='Number of responses to time for each size and writer.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('JSON backend: {}'.format(
+            'orjson' if serializers.orjson is not None else 'json'))
+        self.stdout.write('{:>7} {:<12} {:>12} {:>12}'.format(
+            'chirps', 'writer', 'MB/s', 'peak KiB'))
+        chirper = make_chirper('Nate', 'natec425')
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            for name, writer in WRITERS:
+                rate = throughput(writer, chirper, size, options['repeat'])
+                peak = peak_memory(writer, chirper, size)
+                self.stdout.write('{:>7} {:<12} {:>12.1f} {:>12.1f}'.format(
+                    size, name, rate / 1e6, peak / 1024))
+
+
+def make_chirper(name, username):
+    return ChirperUser(
+        user=User(username=username), name=name, joined=timezone.now().date())
+
+
+def chirps(author, count):
+    'Yields `count` chirps one at a time, the way a queryset iterator does.'
+    now = timezone.now()
+    for i in range(count):
+        yield Chirp(
+            id=i,
+            author=author,
+            date=now,
+            message='Chirp number {} with a message of a typical length'.format(i))
+
+
+def old_helper(chirper, count):
+    chirp_list = list(chirps(chirper, count))
+    response = HttpResponse(
+        json.dumps({
+            'chirper': {
+                'name': chirper.name,
+                'username': chirper.username,
+                'description': chirper.description,
+                'location': chirper.location,
+                'website': chirper.website,
+                'joined': {
+                    'month': chirper.joined.month,
+                    'year': chirper.joined.year
+                }
+            },
+            'chirps': [{
+                'author': {
+                    'name': c.author.name,
+                    'username': c.author.username
+                },
+                'date': {
+                    'month': c.date.month,
+                    'day': c.date.day,
+                    'year': c.date.year
+                },
+                'message': c.message
+            } for c in chirp_list]
+        }),
+        content_type='application/json')
+    return len(response.content)
+
+
+def serializer(chirper, count):
+    response = HttpResponse(
+        serializers.dumps(
+            serializers.feed(chirper, list(chirps(chirper, count)))),
+        content_type='application/json')
+    return len(response.content)
+
+
+def streaming(chirper, count):
+    response = StreamingHttpResponse(
+        serializers.stream_feed(chirper, chirps(chirper, count)),
+        content_type='application/json')
+    return sum(len(chunk) for chunk in response.streaming_content)
+
+
+WRITERS = [
+    ('old helper', old_helper),
+    ('serializers', serializer),
+    ('streaming', streaming),
+]
+
+
+def throughput(writer, chirper, count, repeat):
+    'Returns the bytes per second `writer` produces for `count` chirps.'
+    written = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        written += writer(chirper, count)
+    return written / (time.perf_counter() - start)
+
+
+def peak_memory(writer, chirper, count):
+    'Returns the most memory, in bytes, allocated at once while `writer` runs.'
+    tracemalloc.start()
+    try:
+        writer(chirper, count)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
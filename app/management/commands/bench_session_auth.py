@@ -0,0 +1,86 @@
+import secrets
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app import session_cache
+from app.models import ChirperUser, Session
+
+
+class Command(BaseCommand):
+    help = ('Measures ChirperUser.find_by_key as the sessions table grows. '
+            'All rows it creates are rolled back when it finishes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='1000,10000,100000,1000000',
+            help='Comma separated session counts to measure at.')
+        parser.add_argument(
+            '--lookups',
+            type=int,
+            default=2000,
+            help='Number of lookups to time at each size.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows per bulk insert while growing the sessions table.')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        self.stdout.write('{:>10} {:>14} {:>14}'.format(
+            'sessions', 'uncached (us)', 'cached (us)'))
+        with transaction.atomic():
+            keys = []
+            for size in sizes:
+                while len(keys) < size:
+                    count = min(options['batch_size'], size - len(keys))
+                    keys.extend(create_sessions(count))
+                sample = [
+                    secrets.choice(keys) for _ in range(options['lookups'])
+                ]
+                uncached = time_lookups(sample, forget)
+                cached = time_lookups(sample, lambda key: None)
+                self.stdout.write('{:>10} {:>14.1f} {:>14.1f}'.format(
+                    size, uncached, cached))
+            transaction.set_rollback(True)
+            for key in keys:
+                forget(key)
+
+
+def create_sessions(count):
+    'Creates `count` logged in users with bulk inserts and returns their session keys.'
+    prefix = secrets.token_hex(8)
+    users = User.objects.bulk_create([
+        User(username='bench-{}-{}'.format(prefix, i), password='!')
+        for i in range(count)
+    ])
+    if users[0].pk is None:
+        users = list(User.objects.filter(username__startswith='bench-' + prefix))
+    chirpers = ChirperUser.objects.bulk_create(
+        [ChirperUser(user=user, name='Bench') for user in users])
+    if chirpers[0].pk is None:
+        chirpers = list(ChirperUser.objects.filter(user__in=users))
+    sessions = Session.objects.bulk_create([
+        Session(chirperuser=chirper, key=secrets.token_hex(20))
+        for chirper in chirpers
+    ])
+    return [session.key for session in sessions]
+
+
+def forget(key):
+    session_cache.cache().delete(session_cache.entry_key(key))
+
+
+def time_lookups(keys, before_each):
+    'Returns the mean time of `ChirperUser.find_by_key` over `keys`, in microseconds.'
+    elapsed = 0
+    for key in keys:
+        before_each(key)
+        start = time.perf_counter()
+        ChirperUser.find_by_key(key)
+        elapsed += time.perf_counter() - start
+    return elapsed / len(keys) * 1e6
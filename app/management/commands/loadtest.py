@@ -0,0 +1,257 @@
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from app.management.commands.bench_http import summarize
+
+OPERATIONS = ('signup', 'login', 'chirp', 'feed', 'feed_deep',
+              'username_exists')
+
+DEFAULT_MIX = 'signup=2,login=3,chirp=15,feed=50,feed_deep=10,username_exists=20'
+
+
+class Command(BaseCommand):
+    help = '''Drives a mix of API calls from concurrent clients and reports latency, throughput and queries as JSON.
+
+    Each client signs up its own user, then picks operations at random
+    according to --mix. Feeds and usernames are chosen from the users already
+    in the database, so run `seed_data` first. `feed` reads the first page of
+    a feed and `feed_deep` reads page --deep-page, which the feed view clamps
+    to the last page of short feeds.
+
+    By default requests go through Django's test client in this process, so
+    the report also has the number of queries per operation. With --base-url
+    the requests are sent to a running server instead, and query counts are
+    left out.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', help='For example http://127.0.0.1:8000')
+        parser.add_argument('--clients', type=int, default=8)
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=2000,
+            help='Total number of requests, shared by all clients.')
+        parser.add_argument(
+            '--mix',
+            default=DEFAULT_MIX,
+            help='Relative weights of the operations, as name=weight pairs.')
+        parser.add_argument('--deep-page', type=int, default=200)
+        parser.add_argument(
+            '--targets',
+            type=int,
+            default=1000,
+            help='Number of existing users whose feeds are read.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the report to this file.')
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        targets = list(
+            User.objects.order_by('id').values_list(
+                'username', flat=True)[:options['targets']])
+        if not targets:
+            raise CommandError('There are no users to read; run seed_data first.')
+
+        if options['base_url']:
+            send = http_sender(options['base_url'].rstrip('/'))
+        else:
+            send = client_sender()
+        results = {name: [] for name in OPERATIONS}
+        counter = iter(range(options['requests']))
+        lock = threading.Lock()
+        run_id = uuid.uuid4().hex[:8]
+
+        def client(i):
+            rng = random.Random('{}-{}'.format(options['seed'], i))
+            session = LoadClient(send(), rng, targets, options['deep_page'],
+                                 'lt{}c{}'.format(run_id, i))
+            while True:
+                with lock:
+                    n = next(counter, None)
+                if n is None:
+                    break
+                if session.key is None:
+                    name = 'signup'
+                else:
+                    name = rng.choices(list(mix), weights=list(mix.values()))[0]
+                result = session.run(name)
+                with lock:
+                    results[name].append(result)
+            connection.close()
+
+        threads = [
+            threading.Thread(target=client, args=(i, ))
+            for i in range(options['clients'])
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        report = summarize(
+            [latency for runs in results.values() for _, latency, _ in runs],
+            elapsed)
+        report['clients'] = options['clients']
+        report['mode'] = 'http' if options['base_url'] else 'in-process'
+        report['operations'] = {
+            name: operation_report(runs, elapsed)
+            for name, runs in results.items() if runs
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+
+class LoadClient:
+    '''`LoadClient` is one simulated user of the API.
+
+    `send(method, path, body, key)` makes a request and returns
+    `(status, content, queries)`, where `queries` is `None` if unknown.
+    '''
+
+    def __init__(self, send, rng, targets, deep_page, name):
+        self.send = send
+        self.rng = rng
+        self.targets = targets
+        self.deep_page = deep_page
+        self.name = name
+        self.password = 'loadtest-' + name
+        self.signups = 0
+        self.username = None
+        self.key = None
+
+    def run(self, name):
+        'Performs operation `name` and returns `(status, seconds, queries)`.'
+        start = time.perf_counter()
+        status, content, queries = getattr(self, name)()
+        latency = time.perf_counter() - start
+        if name in ('signup', 'login') and status == 201:
+            self.key = json.loads(content.decode('utf-8'))['key']
+        return status, latency, queries
+
+    def signup(self):
+        self.signups += 1
+        self.username = '{}n{}'.format(self.name, self.signups)
+        return self.send('POST', '/api/signup/', {
+            'name': 'Load Test',
+            'username': self.username,
+            'email': '{}@example.com'.format(self.username),
+            'password': self.password
+        })
+
+    def login(self):
+        return self.send('POST', '/api/login/', {
+            'username': self.username,
+            'password': self.password
+        })
+
+    def chirp(self):
+        return self.send(
+            'POST', '/api/chirp/',
+            {'message': 'load test @{}'.format(self.rng.choice(self.targets))},
+            self.key)
+
+    def feed(self):
+        return self.send('GET', '/api/{}/'.format(self.rng.choice(self.targets)))
+
+    def feed_deep(self):
+        return self.send('GET', '/api/{}/?page={}'.format(
+            self.rng.choice(self.targets), self.deep_page))
+
+    def username_exists(self):
+        username = self.rng.choice(self.targets)
+        if self.rng.random() < 0.5:
+            username += 'missing'
+        return self.send('GET', '/api/username_exists/{}/'.format(username))
+
+
+def parse_mix(mix):
+    weights = {}
+    for pair in mix.split(','):
+        name, _, weight = pair.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise CommandError('Unknown operation {!r} in --mix.'.format(name))
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise CommandError('Bad weight for {!r} in --mix.'.format(name))
+    if not any(weights.values()):
+        raise CommandError('--mix has no operations with a positive weight.')
+    return weights
+
+
+def operation_report(runs, elapsed):
+    report = summarize([latency for _, latency, _ in runs], elapsed)
+    report['errors'] = sum(1 for status, _, _ in runs if status >= 400)
+    queries = [count for _, _, count in runs if count is not None]
+    if queries:
+        report['queries_mean'] = round(sum(queries) / len(queries), 2)
+        report['queries_max'] = max(queries)
+    return report
+
+
+def client_sender():
+    'Returns a factory of senders that call the app in this process.'
+
+    def sender():
+        client = Client(raise_request_exception=False)
+
+        def send(method, path, body=None, key=None):
+            extra = {'HTTP_AUTHORIZATION': 'Key ' + key} if key else {}
+            with CaptureQueriesContext(connection) as queries:
+                if method == 'GET':
+                    response = client.get(path, **extra)
+                else:
+                    response = client.post(
+                        path,
+                        json.dumps(body),
+                        content_type='application/json',
+                        **extra)
+                content = b''.join(response) if response.streaming else response.content
+            return response.status_code, content, len(queries)
+
+        return send
+
+    return sender
+
+
+def http_sender(base_url):
+    'Returns a factory of senders that make HTTP requests to `base_url`.'
+
+    def sender():
+        def send(method, path, body=None, key=None):
+            request = urllib.request.Request(
+                base_url + path,
+                method=method,
+                data=None if body is None else json.dumps(body).encode('utf-8'),
+                headers={'Content-Type': 'application/json'})
+            if key:
+                request.add_header('Authorization', 'Key ' + key)
+            try:
+                with urllib.request.urlopen(request) as response:
+                    return response.status, response.read(), None
+            except urllib.error.HTTPError as e:
+                return e.code, e.read(), None
+            except (urllib.error.URLError, OSError):
+                return 599, b'', None
+
+        return send
+
+    return sender
@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from app import search, sharding, snowflake
+from app.management.commands.seed_data import dates_as_given
+from app.models import Chirp, ChirpHashtag, Mention
+
+
+class Command(BaseCommand):
+    help = '''Moves chirps to the shard their author belongs in, see `app.sharding`.
+
+    Run it after adding a shard to the end of CHIRP_SHARD_DATABASE_URLS, or
+    after turning sharding on with chirps still in the default database. Every
+    shard and the default database are scanned for authors whose chirps belong
+    elsewhere. Their chirps are copied with their mentions, hashtag links and
+    text index rows, --batch-size at a time, and deleted from the old database once the
+    copy has committed. A chirp can show up twice in a feed between the two
+    commits. With snowflake ids, moved chirps keep their ids unless the new
+    shard already uses them, which only happens to ids from a database
+    sequence. Otherwise they get new ids from the new shard's sequence.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of chirps to move per transaction.')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many chirps would move.')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError(
+                'Chirps are not sharded; set CHIRP_SHARD_DATABASE_URLS first.')
+        sources = list(settings.CHIRP_SHARDS)
+        if DEFAULT_DB_ALIAS not in sources:
+            sources.append(DEFAULT_DB_ALIAS)
+        total = 0
+        for source in sources:
+            author_ids = list(
+                Chirp.objects.using(source).order_by('author_id')
+                .values_list('author_id', flat=True).distinct())
+            for author_id in author_ids:
+                target = sharding.shard_for(author_id)
+                if target == source:
+                    continue
+                if options['dry_run']:
+                    count = Chirp.objects.using(source).filter(
+                        author_id=author_id).count()
+                else:
+                    count = move(author_id, source, target,
+                                 options['batch_size'])
+                total += count
+                self.stdout.write('{} {} chirps of author {} from {} to {}.'.format(
+                    'Would move' if options['dry_run'] else 'Moved', count,
+                    author_id, source, target))
+        self.stdout.write('{} {} chirps.'.format(
+            'Would move' if options['dry_run'] else 'Moved', total))
+
+
+def move(author_id, source, target, batch_size) -> int:
+    'Moves the chirps of `author_id` from database `source` to `target`, and returns how many there were.'
+    moved = 0
+    while True:
+        chirps = list(
+            Chirp.objects.using(source).filter(author_id=author_id)
+            .order_by('id').only('message', 'date', 'author')[:batch_size])
+        if not chirps:
+            return moved
+        copies = {
+            chirp.id: Chirp(
+                id=chirp.id if snowflake.enabled() else None,
+                author_id=author_id,
+                message=chirp.message,
+                date=chirp.date)
+            for chirp in chirps
+        }
+        if snowflake.enabled():
+            for taken in Chirp.objects.using(target).filter(
+                    id__in=copies).values_list('id', flat=True):
+                copies[taken].id = snowflake.chirp_id()
+        mentions = Mention.objects.using(source).filter(
+            chirp__in=chirps).values_list('chirp_id', 'chirperuser_id')
+        hashtags = ChirpHashtag.objects.using(source).filter(
+            chirp__in=chirps).values_list('chirp_id', 'hashtag_id')
+        with dates_as_given(), transaction.atomic(using=target):
+            Chirp.objects.using(target).bulk_create(copies.values())
+            Mention.objects.using(target).bulk_create([
+                Mention(chirp=copies[chirp_id], chirperuser_id=chirperuser_id,
+                        date=copies[chirp_id].date)
+                for chirp_id, chirperuser_id in mentions
+            ])
+            ChirpHashtag.objects.using(target).bulk_create([
+                ChirpHashtag(chirp=copies[chirp_id], hashtag_id=hashtag_id,
+                             date=copies[chirp_id].date)
+                for chirp_id, hashtag_id in hashtags
+            ])
+            search.index(list(copies.values()))
+        with transaction.atomic(using=source):
+            Chirp.objects.using(source).filter(id__in=copies).delete()
+        moved += len(chirps)
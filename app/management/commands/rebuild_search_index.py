@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
+
+from app import search
+from app.models import Chirp
+
+NEW_TABLE = search.FTS_TABLE + '_new'
+
+# Copy chirps written while the new table is filled into it as well.
+TRIGGERS = {
+    NEW_TABLE + '_insert':
+    'AFTER INSERT ON {chirps} BEGIN '
+    'INSERT INTO {new} (rowid, message) VALUES (new.id, new.message); END',
+    NEW_TABLE + '_update':
+    'AFTER UPDATE OF message ON {chirps} BEGIN '
+    'DELETE FROM {new} WHERE rowid = old.id; '
+    'INSERT INTO {new} (rowid, message) VALUES (new.id, new.message); END',
+}
+
+
+class Command(BaseCommand):
+    help = '''Rebuilds the chirp text index used by `app.search`.
+
+    On SQLite a new FTS5 table is filled from the chirps, which are read in
+    id order, --batch-size at a time, with each batch written in its own
+    transaction. Triggers on the chirps table copy chirps written or edited
+    meanwhile into it, and once it is full it replaces the old table in one
+    transaction, so searches use the old index until then. On PostgreSQL the
+    GIN index is rebuilt with REINDEX. When chirps are sharded, the index of
+    every shard is rebuilt.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of chirps to index per batch.')
+
+    def handle(self, *args, **options):
+        for db in settings.CHIRP_SHARDS or [router.db_for_write(Chirp)]:
+            self.rebuild(db, options['batch_size'])
+
+    def rebuild(self, db, batch_size):
+        connection = connections[db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('REINDEX INDEX {}'.format(search.GIN_INDEX))
+            self.stdout.write('Rebuilt {}.'.format(search.GIN_INDEX))
+            return
+        if connection.vendor != 'sqlite':
+            self.stdout.write(
+                'The {} backend has no text index to rebuild.'.format(
+                    connection.vendor))
+            return
+
+        names = {'chirps': Chirp._meta.db_table, 'new': NEW_TABLE}
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            # Left over by a rebuild that did not finish.
+            self.drop_triggers(cursor)
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(NEW_TABLE))
+            cursor.execute(
+                'CREATE VIRTUAL TABLE {} USING fts5(message)'.format(NEW_TABLE))
+            for name, sql in TRIGGERS.items():
+                cursor.execute('CREATE TRIGGER {} {}'.format(
+                    name, sql.format(**names)))
+        seen = self.fill(db, batch_size)
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            self.drop_triggers(cursor)
+            cursor.execute('DROP TABLE {}'.format(search.FTS_TABLE))
+            cursor.execute('ALTER TABLE {} RENAME TO {}'.format(
+                NEW_TABLE, search.FTS_TABLE))
+        self.stdout.write('Indexed {} chirps.'.format(seen))
+
+    def fill(self, db, batch_size) -> int:
+        'Copies the chirps in database `db` into the new table, and returns how many there were.'
+        seen = 0
+        last_id = 0
+        while True:
+            ids = Chirp.objects.using(db).filter(
+                id__gt=last_id).order_by('id').values_list('id', flat=True)
+            last = ids[batch_size - 1:batch_size].first()
+            if last is None:
+                last = ids.last()
+            if last is None:
+                return seen
+            with connections[db].cursor() as cursor:
+                # One statement, so it reads the chirps and writes the batch
+                # atomically. Chirps the triggers copied already are skipped.
+                cursor.execute(
+                    'INSERT INTO {new} (rowid, message) '
+                    'SELECT id, message FROM {chirps} '
+                    'WHERE id > %s AND id <= %s AND id NOT IN ('
+                    'SELECT rowid FROM {new} WHERE rowid > %s AND rowid <= %s)'
+                    .format(chirps=Chirp._meta.db_table, new=NEW_TABLE),
+                    [last_id, last, last_id, last])
+            seen += Chirp.objects.using(db).filter(
+                id__gt=last_id, id__lte=last).count()
+            last_id = last
+
+    def drop_triggers(self, cursor):
+        for name in TRIGGERS:
+            cursor.execute('DROP TRIGGER IF EXISTS {}'.format(name))
@@ -0,0 +1,172 @@
+import itertools
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.utils import timezone
+
+from app import search, snowflake, usernames
+from app.models import Chirp, ChirperUser
+
+WORDS = ('the a chirp today lunch coffee django python deploy bug fix ship '
+         'weekend meeting release cat dog rain sun code review test cache '
+         'query index feed friend great terrible finally again why '
+         '#python #django #mondays').split()
+
+
+class Command(BaseCommand):
+    help = '''Fills the database with generated users and chirps for benchmarking.
+
+    Authors and mentioned users are drawn from a Zipf distribution, so a few
+    users write and are mentioned far more than the rest, as on a real site.
+    Rows are written with bulk inserts, one transaction per batch. Each
+    batch's mentions, hashtags and timeline entries are written by
+    `Chirp.write_references`, and its messages are added to the text index.
+    When chirps are sharded, each batch is split by the authors' shards.
+    Every generated user has the password given by --password.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--chirps', type=int, default=10000)
+        parser.add_argument(
+            '--zipf',
+            type=float,
+            default=1.1,
+            help='Exponent of the Zipf distribution of authors and mentions.')
+        parser.add_argument(
+            '--mention-rate',
+            type=float,
+            default=0.3,
+            help='Fraction of chirps that mention somebody.')
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=365,
+            help='Chirps are dated evenly over this many days up to now.')
+        parser.add_argument(
+            '--prefix',
+            default='seed',
+            help='Generated usernames are this prefix followed by a number.')
+        parser.add_argument('--password', default='seedpass')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument(
+            '--seed', type=int, default=0, help='Seed for the random generator.')
+
+    def handle(self, *args, **options):
+        if '@' in options['prefix']:
+            raise CommandError('--prefix cannot contain @')
+        if User.objects.filter(
+                username__startswith=options['prefix']).exists():
+            raise CommandError(
+                'Users starting with {!r} already exist; pass another --prefix.'
+                .format(options['prefix']))
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        users = create_users(options['prefix'], options['users'],
+                             options['password'], batch_size)
+        # Bulk inserts don't send `post_save`, which keeps the username filter
+        # up to date.
+        usernames.reset()
+        self.stdout.write('Created {} users.'.format(len(users)))
+
+        # Popularity ranks are shuffled, so the most popular users are not
+        # simply the first ones created.
+        ranked = list(users)
+        rng.shuffle(ranked)
+        cum_weights = list(
+            itertools.accumulate(
+                1 / rank**options['zipf'] for rank in range(1, len(ranked) + 1)))
+
+        total = options['chirps']
+        end = timezone.now()
+        step = timedelta(days=options['days']) / max(total, 1)
+        start = end - step * total
+        written = 0
+        with dates_as_given():
+            while written < total:
+                count = min(batch_size, total - written)
+                authors = rng.choices(ranked, cum_weights=cum_weights, k=count)
+                dates = [start + step * (written + i) for i in range(count)]
+                chirps = [
+                    Chirp(
+                        id=chirp_id(date),
+                        author_id=author_id,
+                        message=message(rng, ranked, cum_weights,
+                                        options['mention_rate']),
+                        date=date)
+                    for (author_id, _), date in zip(authors, dates)
+                ]
+                by_shard = {}
+                for chirp in chirps:
+                    by_shard.setdefault(
+                        router.db_for_write(Chirp, instance=chirp), []).append(chirp)
+                for db, shard_chirps in by_shard.items():
+                    with transaction.atomic(using=db):
+                        Chirp.objects.using(db).bulk_create(shard_chirps)
+                        Chirp.write_references(shard_chirps)
+                        search.index(shard_chirps)
+                written += count
+                self.stdout.write('Created {} of {} chirps.'.format(written, total))
+
+
+def create_users(prefix, count, password, batch_size):
+    'Creates `count` users and returns a list of their `(chirperuser_id, username)`.'
+    password = make_password(password)
+    users = []
+    for offset in range(0, count, batch_size):
+        usernames = [
+            '{}{}'.format(prefix, i)
+            for i in range(offset, min(count, offset + batch_size))
+        ]
+        with transaction.atomic():
+            User.objects.bulk_create([
+                User(username=username,
+                     email='{}@example.com'.format(username),
+                     password=password) for username in usernames
+            ])
+            user_ids = dict(
+                User.objects.filter(username__in=usernames)
+                .values_list('username', 'id'))
+            ChirperUser.objects.bulk_create([
+                ChirperUser(user_id=user_ids[username],
+                            name='User {}'.format(username),
+                            username_folded=username.casefold())
+                for username in usernames
+            ])
+        users.extend(
+            ChirperUser.objects.filter(user__username__in=usernames)
+            .values_list('id', 'user__username'))
+    return users
+
+
+def chirp_id(date):
+    'Returns a snowflake id for a chirp written at `date`, or `None` when the database picks ids.'
+    if not snowflake.enabled():
+        return None
+    return snowflake.generator().id_at(date)
+
+
+def message(rng, ranked, cum_weights, mention_rate):
+    words = rng.choices(WORDS, k=rng.randint(3, 20))
+    if rng.random() < mention_rate:
+        for _, username in rng.choices(
+                ranked, cum_weights=cum_weights, k=rng.randint(1, 2)):
+            words.insert(rng.randrange(len(words) + 1), '@' + username)
+    return ' '.join(words)[:280]
+
+
+@contextmanager
+def dates_as_given():
+    'Lets bulk inserted chirps keep their own `date` instead of the current time.'
+    field = Chirp._meta.get_field('date')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
@@ -0,0 +1,294 @@
+'''Collects request, cache and write metrics and renders them for Prometheus.
+
+Each process keeps its own numbers. When `METRICS_DIR` is set, each process
+also writes them to its own file in that directory, at most every
+`METRICS_FLUSH_INTERVAL` seconds, and `render` adds up the files of every
+process, so whichever gunicorn worker answers a scrape reports all of them.
+Process files are named after the process id and start time, so a new
+process that gets an old process id does not overwrite the old numbers.
+`render` folds the files of processes that have exited into one running
+total, so counters never go backwards and the directory does not grow with
+every worker restart.
+
+Cache hit ratios and write rates are left to the queries, for example
+`rate(chirper_chirps_written_total[5m])`.
+'''
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+METRICS = {
+    'chirper_requests_total':
+    ('counter', 'Requests handled, by view, method and status.'),
+    'chirper_request_duration_seconds':
+    ('histogram', 'Time taken to produce a response, by view.'),
+    'chirper_request_queries':
+    ('histogram', 'Database queries made per request, by view.'),
+    'chirper_session_cache_hits_total':
+    ('counter', 'Session keys found in the session key cache.'),
+    'chirper_session_cache_misses_total':
+    ('counter', 'Session keys looked up in the database.'),
+    'chirper_feed_cache_hits_total':
+    ('counter', 'Feed pages served from the feed cache.'),
+    'chirper_feed_cache_misses_total':
+    ('counter', 'Feed pages that had to be built.'),
+    'chirper_chirps_written_total': ('counter', 'Chirps committed.'),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_collectors = []
+_last_flush = [0.0]
+# The process id and start time that name this process's file. The start
+# time is taken again when the process id changes, for forked workers.
+_process = {'pid': None, 'started': None}
+
+
+def count(name: str, amount=1, **labels):
+    'Adds `amount` to the counter `name` with `labels`.'
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value, buckets, **labels):
+    'Records `value` in the histogram `name` with `labels`.'
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': list(buckets),
+                'counts': [0] * (len(buckets) + 1),
+                'sum': 0,
+            }
+        for i, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                break
+        else:
+            i = len(histogram['buckets'])
+        histogram['counts'][i] += 1
+        histogram['sum'] += value
+
+
+def register_collector(collector):
+    '''Adds a function that returns `{counter name: value}` when metrics are read.
+
+    This is for numbers another module already counts, such as cache hits.
+    '''
+    _collectors.append(collector)
+
+
+def observe_request(view: str, method: str, status: int, seconds, queries):
+    count('chirper_requests_total', view=view, method=method, status=str(status))
+    observe('chirper_request_duration_seconds', seconds, LATENCY_BUCKETS, view=view)
+    observe('chirper_request_queries', queries, QUERY_BUCKETS, view=view)
+    if settings.METRICS_DIR and (time.monotonic() - _last_flush[0] >=
+                                 settings.METRICS_FLUSH_INTERVAL):
+        flush()
+
+
+def snapshot() -> dict:
+    'Returns the numbers of this process in a form that can be written as JSON.'
+    with _lock:
+        counters = {encode_key(key): value for key, value in _counters.items()}
+        histograms = {
+            encode_key(key): {
+                'buckets': list(histogram['buckets']),
+                'counts': list(histogram['counts']),
+                'sum': histogram['sum'],
+            }
+            for key, histogram in _histograms.items()
+        }
+    for collector in _collectors:
+        for name, value in collector().items():
+            key = encode_key((name, ()))
+            counters[key] = counters.get(key, 0) + value
+    return {'counters': counters, 'histograms': histograms}
+
+
+def flush():
+    'Writes this process\'s numbers to its file in `METRICS_DIR`.'
+    _last_flush[0] = time.monotonic()
+    path = own_file()
+    temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(temporary, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(temporary, path)
+
+
+def own_file() -> str:
+    pid = os.getpid()
+    with _lock:
+        if _process['pid'] != pid:
+            _process['pid'] = pid
+            _process['started'] = time.time_ns()
+        return process_file(pid, _process['started'])
+
+
+def process_file(pid, started) -> str:
+    return os.path.join(settings.METRICS_DIR,
+                        'metrics-{}-{}.json'.format(pid, started))
+
+
+def retired_file() -> str:
+    return os.path.join(settings.METRICS_DIR, 'retired.json')
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_files() -> list:
+    '''Returns the snapshots of the other processes and of the exited ones.
+
+    Files of exited processes are first added to the retired total, which
+    lists the files it took in until they are deleted, so a crash between
+    writing the total and deleting the files does not count them twice.
+    Folding and reading hold an exclusive lock on the directory.
+    '''
+    own = own_file()
+    with open(os.path.join(settings.METRICS_DIR, 'metrics.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired = load(retired_file()) or {'counters': {}, 'histograms': {}}
+        folded = set(retired.get('folded', []))
+        live, exited = [], []
+        for path in glob.glob(process_file('*', '*')):
+            name = os.path.basename(path)
+            pid = int(name.split('-')[1])
+            if path == own:
+                continue
+            if name in folded:
+                os.unlink(path)
+            elif pid == os.getpid() or not is_running(pid):
+                exited.append(path)
+            else:
+                live.append(path)
+        snapshots = [load(path) for path in exited]
+        if exited:
+            counters, histograms = merge(
+                [retired] + [snapshot for snapshot in snapshots if snapshot])
+            retired = {
+                'counters': {encode_key(key): value
+                             for key, value in counters.items()},
+                'histograms': {encode_key(key): histogram
+                               for key, histogram in histograms.items()},
+                'folded': [os.path.basename(path) for path in exited],
+            }
+            temporary = retired_file() + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(retired, f)
+            os.replace(temporary, retired_file())
+            for path in exited:
+                os.unlink(path)
+        snapshots = [retired] + [load(path) for path in live]
+    return [snapshot for snapshot in snapshots if snapshot]
+
+
+def load(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def render() -> str:
+    'Returns the metrics of every process in the Prometheus text format.'
+    snapshots = [snapshot()]
+    if settings.METRICS_DIR:
+        flush()
+        snapshots += read_files()
+    counters, histograms = merge(snapshots)
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind == 'counter':
+            series = sorted(
+                (labels, value) for (metric, labels), value in counters.items()
+                if metric == name)
+            if not series:
+                series = [((), 0)]
+            for labels, value in series:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            continue
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(histogram['buckets'] + ['+Inf'],
+                                     histogram['counts']):
+                cumulative += bucket
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', str(bound)), )),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+                                              histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels),
+                                                cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def merge(snapshots):
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for key, value in snapshot['counters'].items():
+            key = decode_key(key)
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in snapshot['histograms'].items():
+            key = decode_key(key)
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = {
+                    'buckets': list(histogram['buckets']),
+                    'counts': list(histogram['counts']),
+                    'sum': histogram['sum'],
+                }
+            elif merged['buckets'] == histogram['buckets']:
+                # Workers running an older release may use other buckets;
+                # those are skipped rather than merged wrongly.
+                merged['counts'] = [
+                    a + b for a, b in zip(merged['counts'], histogram['counts'])
+                ]
+                merged['sum'] += histogram['sum']
+    return counters, histograms
+
+
+def encode_key(key) -> str:
+    name, labels = key
+    return json.dumps([name, [list(label) for label in labels]])
+
+
+def decode_key(key: str):
+    name, labels = json.loads(key)
+    return name, tuple(tuple(label) for label in labels)
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in labels) + '}'
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
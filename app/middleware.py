@@ -1,22 +1,180 @@
+from app import metrics, timing
 from app.models import ChirperUser
 import json
+import logging
+import random
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import HttpRequest, HttpResponse
 from django.contrib.auth.models import AnonymousUser
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.functional import SimpleLazyObject
 
+KEY_SCHEMES = ('key', 'bearer')
 
+timing_logger = logging.getLogger('app.timing')
+
+
+@sync_and_async_middleware
 def load_user_from_json_key(get_response):
-    def middleware(request: HttpRequest) -> HttpResponse:
-        try:
-            data = json.loads(request.body.decode('utf-8'))
-            key = data['key']
-            request.user = ChirperUser.find_by_key(key)
-        except (json.JSONDecodeError, KeyError, ChirperUser.DoesNotExist):
-            request.user = AnonymousUser()
-        except Exception as e:
-            print(e)
-            # TODO: Report error to sentry
-            request.user = AnonymousUser()
-        finally:
+    '''Sets `request.user` to the `ChirperUser` whose session key came with the request.
+
+    The key is read from an `Authorization: Key <key>` header, or else from
+    the `key` field of a JSON body. `request.user` is lazy, so requests whose
+    view never looks at it don't parse the body or query the sessions table.
+    Async views should use `await request.auser()` instead.
+    '''
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request: HttpRequest) -> HttpResponse:
+            set_user(request)
+            return await get_response(request)
+    else:
+
+        def middleware(request: HttpRequest) -> HttpResponse:
+            set_user(request)
             return get_response(request)
 
     return middleware
+
+
+@sync_and_async_middleware
+def request_timing(get_response):
+    '''Measures a sample of requests and reports them in a `Server-Timing` header and a log line.
+
+    A fraction `REQUEST_TIMING_SAMPLE_RATE` of requests is measured, see
+    `app.timing`. The log line is a JSON object logged to `app.timing` at INFO
+    level, and includes the SQL of the slowest query. Serialization that
+    happens while a streaming response is sent is not included.
+    '''
+    rate = settings.REQUEST_TIMING_SAMPLE_RATE
+    if rate <= 0:
+        raise MiddlewareNotUsed()
+    timing.install()
+
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request: HttpRequest) -> HttpResponse:
+            if random.random() >= rate:
+                return await get_response(request)
+            with timing.timing() as measurements:
+                response = await get_response(request)
+            report_timing(request, response, measurements)
+            return response
+    else:
+
+        def middleware(request: HttpRequest) -> HttpResponse:
+            if random.random() >= rate:
+                return get_response(request)
+            with timing.timing() as measurements:
+                response = get_response(request)
+            report_timing(request, response, measurements)
+            return response
+
+    return middleware
+
+
+@sync_and_async_middleware
+def record_metrics(get_response):
+    '''Counts every request in `app.metrics`, with its latency and number of queries.
+
+    Requests are labelled with the name of the view that handled them. The
+    middleware is not loaded when `CHIRPER_METRICS` is off.
+    '''
+    if not settings.CHIRPER_METRICS:
+        raise MiddlewareNotUsed()
+    timing.install()
+
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request: HttpRequest) -> HttpResponse:
+            with timing.timing() as measurements:
+                response = await get_response(request)
+            observe_request(request, response, measurements)
+            return response
+    else:
+
+        def middleware(request: HttpRequest) -> HttpResponse:
+            with timing.timing() as measurements:
+                response = get_response(request)
+            observe_request(request, response, measurements)
+            return response
+
+    return middleware
+
+
+def observe_request(request: HttpRequest, response: HttpResponse,
+                    measurements: timing.RequestTiming):
+    match = request.resolver_match
+    metrics.observe_request(match.view_name if match else 'unmatched',
+                            request.method, response.status_code,
+                            measurements.elapsed(), measurements.queries)
+
+
+def report_timing(request: HttpRequest, response: HttpResponse,
+                  measurements: timing.RequestTiming):
+    total = measurements.elapsed()
+    response['Server-Timing'] = measurements.server_timing(total)
+    record = {
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        **measurements.record(total)
+    }
+    timing_logger.info(json.dumps(record))
+
+
+def set_user(request: HttpRequest):
+    request.user = SimpleLazyObject(lambda: get_user(request))
+
+    async def auser():
+        return await sync_to_async(get_user)(request)
+
+    request.auser = auser
+
+
+def get_user(request: HttpRequest):
+    try:
+        key = session_key(request)
+        if key is None:
+            return AnonymousUser()
+        return ChirperUser.find_by_key(key)
+    except (ValueError, ChirperUser.DoesNotExist):
+        return AnonymousUser()
+    except Exception as e:
+        print(e)
+        # TODO: Report error to sentry
+        return AnonymousUser()
+
+
+def session_key(request: HttpRequest):
+    '''Returns the session key sent with `request`, or `None` if there isn't one.
+
+    Raises `json.JSONDecodeError` if there is no `Authorization` header and the
+    body is not JSON.
+    '''
+    scheme, _, key = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() in KEY_SCHEMES and key.strip():
+        return key.strip()
+    data = json_body(request)
+    if isinstance(data, dict):
+        return data.get('key')
+    return None
+
+
+def json_body(request: HttpRequest):
+    '''Returns the JSON body of `request`, parsing it at most once per request.
+
+    Raises `json.JSONDecodeError` if the body is not JSON.
+    '''
+    if not hasattr(request, '_json_body'):
+        try:
+            request._json_body = json.loads(request.body.decode('utf-8'))
+        except UnicodeDecodeError as e:
+            request._json_body = json.JSONDecodeError(str(e), '', 0)
+        except json.JSONDecodeError as e:
+            request._json_body = e
+    if isinstance(request._json_body, json.JSONDecodeError):
+        raise request._json_body
+    return request._json_body
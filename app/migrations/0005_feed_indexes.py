@@ -0,0 +1,43 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_chirp_chirping_at'),
+    ]
+
+    operations = [
+        # `Mention` takes over the table Django created for `Chirp.chirping_at`,
+        # so only the migration state changes here.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Mention',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('chirp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.Chirp')),
+                        ('chirperuser', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.ChirperUser')),
+                    ],
+                    options={
+                        'db_table': 'app_chirp_chirping_at',
+                        'unique_together': {('chirp', 'chirperuser')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='chirp',
+                    name='chirping_at',
+                    field=models.ManyToManyField(related_name='chirping_at_set', through='app.Mention', to='app.ChirperUser'),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chirp',
+            index=models.Index(fields=['author', '-date', '-id'], name='app_chirp_author_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mention',
+            index=models.Index(fields=['chirperuser', 'chirp'], name='app_mention_user_chirp_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('chirp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.chirp')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.chirperuser')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-date', '-chirp'], name='app_timeline_owner_date_idx')],
+                'unique_together': {('owner', 'chirp')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_timelineentry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='session',
+            name='key',
+            field=models.CharField(max_length=40, unique=True),
+        ),
+    ]
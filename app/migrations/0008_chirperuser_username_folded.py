@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:21
+
+from django.db import migrations, models
+
+
+def fill_username_folded(apps, schema_editor):
+    ChirperUser = apps.get_model('app', 'ChirperUser')
+    db = schema_editor.connection.alias
+    chirpers = ChirperUser.objects.using(db).filter(
+        username_folded='').select_related('user').only('user__username')
+    batch = []
+    for chirper in chirpers.iterator(chunk_size=2000):
+        chirper.username_folded = chirper.user.username.casefold()
+        batch.append(chirper)
+        if len(batch) == 2000:
+            ChirperUser.objects.using(db).bulk_update(batch, ['username_folded'])
+            batch = []
+    ChirperUser.objects.using(db).bulk_update(batch, ['username_folded'])
+
+
+def add_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS app_chirperuser_username_trgm_idx '
+        'ON app_chirperuser USING gin (username_folded gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS app_chirperuser_username_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_session_key_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chirperuser',
+            name='username_folded',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=150),
+        ),
+        migrations.RunPython(fill_username_folded, migrations.RunPython.noop),
+        migrations.RunPython(add_trigram_index, drop_trigram_index),
+    ]
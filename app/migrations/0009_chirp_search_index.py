@@ -0,0 +1,36 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS app_chirp_fts USING fts5(message)')
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS app_chirp_message_fts_idx ON app_chirp '
+            "USING gin (to_tsvector('simple', message))")
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS app_chirp_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS app_chirp_message_fts_idx')
+
+
+class Migration(migrations.Migration):
+    '''Adds the text index used by `app.search`.
+
+    On SQLite the index starts out empty; run `rebuild_search_index` to fill
+    it with the existing chirps.
+    '''
+
+    dependencies = [
+        ('app', '0008_chirperuser_username_folded'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_chirp_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Hashtag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HashtagMinute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minute', models.DateTimeField(db_index=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('hashtag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.hashtag')),
+            ],
+            options={
+                'unique_together': {('hashtag', 'minute')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ChirpHashtag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('chirp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.chirp')),
+                ('hashtag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.hashtag')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['hashtag', '-date', '-chirp'], name='app_chirphashtag_date_idx')],
+                'unique_together': {('hashtag', 'chirp')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_hashtags'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chirp',
+            name='author',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='app.chirperuser'),
+        ),
+        migrations.AlterField(
+            model_name='mention',
+            name='chirperuser',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='app.chirperuser'),
+        ),
+    ]
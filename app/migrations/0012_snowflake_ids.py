@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:46
+
+import app.snowflake
+from django.db import migrations, models
+
+
+def add_author_id_index(apps, schema_editor):
+    # With snowflake ids an author's chirps are read in id order. SQLite's
+    # index on `author_id` already ends with the rowid, PostgreSQL's does not.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS app_chirp_author_id_desc_idx '
+        'ON app_chirp (author_id, id DESC)')
+
+
+def drop_author_id_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS app_chirp_author_id_desc_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_sharding_constraints'),
+    ]
+
+    # Existing rows keep their ids, which sort before every snowflake id, so
+    # only the column type changes. Columns referencing chirps follow it.
+    operations = [
+        migrations.AlterField(
+            model_name='chirp',
+            name='id',
+            field=models.BigAutoField(default=app.snowflake.chirp_id, primary_key=True, serialize=False),
+        ),
+        migrations.RunPython(add_author_id_index, drop_author_id_index),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-17 14:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_snowflake_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chirphashtag',
+            name='hashtag',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='app.hashtag'),
+        ),
+        migrations.AlterField(
+            model_name='hashtagminute',
+            name='hashtag',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='app.hashtag'),
+        ),
+    ]
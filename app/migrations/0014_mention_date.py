@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:04
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+
+def fill_mention_dates(apps, schema_editor):
+    Chirp = apps.get_model('app', 'Chirp')
+    Mention = apps.get_model('app', 'Mention')
+    db = schema_editor.connection.alias
+    Mention.objects.using(db).update(date=Subquery(
+        Chirp.objects.using(db).filter(pk=OuterRef('chirp')).values('date')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_hashtag_sharding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mention',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_mention_dates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='mention',
+            index=models.Index(fields=['chirperuser', '-date', '-chirp'], name='app_mention_user_date_idx'),
+        ),
+    ]
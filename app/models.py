@@ -1,11 +1,69 @@
+import re
 import secrets
+import sys
+from datetime import timedelta
 
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_login_failed
 from django.core.exceptions import ValidationError
 from django.core.validators import MinLengthValidator
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.utils import IntegrityError
+from django.db.models import F, IntegerField, OuterRef, Q, Subquery, Sum, Value
 from django.db.models.query import QuerySet
-from django.db.models.signals import pre_save
+from django.utils import timezone
+from django.db.models.signals import post_save, pre_save
+
+from app import (archive, feed_cache, hashing, metrics, pagination, search,
+                 session_cache, sharding, snowflake, usernames)
+from app.caching import TTLCache
+
+HASHTAG = re.compile(r'#(\w+)')
+
+HASHTAG_MAX_LENGTH = 100
+
+# Usernames whose feed URL, `/api/<username>/`, is taken by another view.
+RESERVED_USERNAMES = {'chirp', 'login', 'logout', 'signup', 'trending'}
+
+# Maps a limit to the result of `Hashtag.trending`, which every process
+# recomputes at most every TRENDING_CACHE_TTL seconds.
+trending_tags = TTLCache(maxsize=16, ttl=settings.TRENDING_CACHE_TTL)
+
+# Holds an entry for a minute after this process last deleted the
+# `HashtagMinute` rows that left the trending window, see `HashtagMinute.prune`.
+pruned_minutes = TTLCache(maxsize=1, ttl=60)
+
+# Maps `(prefix, limit)` to the result of `ChirperUser.search`, so the most
+# typed prefixes are answered from memory. New users show up in cached results
+# once the entry expires.
+user_searches = TTLCache(
+    maxsize=settings.USER_SEARCH_CACHE_SIZE, ttl=settings.USER_SEARCH_CACHE_TTL)
+
+def parse_message(message: str) -> tuple:
+    '''`parse_message` returns the `@`-mentioned usernames and the `#` hashtags in `message`.
+
+    Each is listed once, in order. Hashtags are the word characters after the
+    `#`, case folded, so `#Django!` and `#django` are the same tag.
+    '''
+    usernames = {}
+    hashtags = {}
+    for word in message.split():
+        if word.startswith('@'):
+            usernames[word[1:]] = None
+        elif word.startswith('#'):
+            match = HASHTAG.match(word)
+            # Case folding can make a tag longer, e.g. 'ß' becomes 'ss'.
+            tag = match and match.group(1).casefold()
+            if tag and len(tag) <= HASHTAG_MAX_LENGTH:
+                hashtags[tag] = None
+    return list(usernames), list(hashtags)
+
+
+def mentioned_usernames(message: str) -> list:
+    '`mentioned_usernames` returns each username `@`-mentioned in `message` once, in order.'
+    return parse_message(message)[0]
 
 
 class ChirperUser(models.Model):
@@ -15,10 +73,24 @@ class ChirperUser(models.Model):
     location = models.CharField(max_length=50, blank=True)
     website = models.URLField(blank=True)
     joined = models.DateField(auto_now_add=True)
+    # `user.username`, case folded, for `ChirperUser.search`.
+    username_folded = models.CharField(
+        max_length=150, db_index=True, editable=False, default='')
 
     def clean(self):
+        if not self.user.username:
+            # Reported by the `User`'s own validation.
+            return
         if '@' in self.user.username:
             raise ValidationError('Username cannot contain @')
+        if self.user.username in RESERVED_USERNAMES:
+            raise ValidationError('Username is reserved')
+
+    def save(self, *args, **kwargs):
+        if ChirperUser.user.is_cached(self):
+            self.username_folded = self.user.username.casefold()
+        super(ChirperUser, self).save(*args, **kwargs)
+        feed_cache.bump([self.id])
 
     @property
     def username(self):
@@ -36,50 +108,327 @@ class ChirperUser(models.Model):
     def signup(name, username, email, password):
         '''`ChirperUser.signup` creates and returns a new `ChirperUser` with the provided data.
         
-        To create the `ChirperUser`, it creates the underlying `django.contrib.auth.models.User`,
-        and then creates the `ChirperUser`.
-        
-        Any errors during `User` creation or `ChirperUser` creation are unhandled by this method
-        and will bubble up. This may change in the future.
+        Both the underlying `django.contrib.auth.models.User` and the `ChirperUser` are
+        validated before anything is written, and then inserted in one transaction.
+        A taken username is caught by the database's unique constraint rather than
+        looked up first.
+
+        Raises `ValidationError` with the errors of both objects, and
+        `app.hashing.Busy` if the password could not be hashed right now.
         '''
         user = User(username=username, email=email)
-        user.set_password(password)
-        user.full_clean()
-        user.save()
         chirper = ChirperUser(user=user, name=name)
+        errors = {}
         try:
-            chirper.full_clean()
+            user.full_clean(exclude=['password'], validate_unique=False)
         except ValidationError as e:
-            user.delete()
-            raise e
-        chirper.save()
+            errors = e.update_error_dict(errors)
+        try:
+            chirper.full_clean(exclude=['user'])
+        except ValidationError as e:
+            errors = e.update_error_dict(errors)
+        if errors:
+            raise ValidationError(errors)
+        user.password = hashing.run(make_password, password)
+        try:
+            with transaction.atomic():
+                user.save()
+                chirper.save()
+        except IntegrityError:
+            raise ValidationError({
+                'username':
+                [User._meta.get_field('username').error_messages['unique']]
+            })
+        return chirper
+
+    @staticmethod
+    def authenticate(username: str, password: str) -> 'ChirperUser':
+        '''`ChirperUser.authenticate` returns the active `ChirperUser` with these credentials, or `None`.
+
+        The password is checked on the `app.hashing` pool, which raises
+        `app.hashing.Busy` when it is overloaded. Unknown usernames still hash
+        the password once, so they take as long to reject as wrong passwords.
+        Like `django.contrib.auth.authenticate`, failures send
+        `user_login_failed`, and a password hashed with an outdated hasher or
+        too few iterations is hashed again with the preferred one.
+        '''
+        try:
+            chirper = ChirperUser.find_by_username(username)
+        except ChirperUser.DoesNotExist:
+            hashing.run(make_password, password)
+            chirper = None
+        else:
+            user = chirper.user
+            # `check_password` calls this, on the pool, when the hash is outdated.
+            rehashed = []
+            if not (hashing.run(check_password, password, user.password,
+                                lambda raw: rehashed.append(make_password(raw)))
+                    and user.is_active):
+                chirper = None
+            elif rehashed:
+                user.password = rehashed[0]
+                user.save(update_fields=['password'])
+        if chirper is None:
+            user_login_failed.send(sender=__name__,
+                                   credentials={'username': username})
         return chirper
 
     @staticmethod
     def find_by_username(username: str) -> 'ChirperUser':
-        return ChirperUser.objects.get(user__username=username)
+        return ChirperUser.objects.select_related('user').get(
+            user__username=username)
+
+    @staticmethod
+    def find_feed_owner(username: str) -> 'ChirperUser':
+        '''`ChirperUser.find_feed_owner` is `find_by_username` for serving a feed.
+
+        The returned `ChirperUser` also has a `newest_chirp_id`, the id of the
+        newest chirp it wrote or was mentioned in (or `None`), found in the same
+        query with two index lookups.
+        '''
+        return ChirperUser.feed_owners().get(user__username=username)
+
+    @staticmethod
+    async def afind_feed_owner(username: str) -> 'ChirperUser':
+        '`ChirperUser.afind_feed_owner` is the async version of `find_feed_owner`.'
+        return await ChirperUser.feed_owners().aget(user__username=username)
+
+    @staticmethod
+    def feed_owners() -> QuerySet:
+        if sharding.enabled():
+            # The newest chirps are on the shards, out of reach of a subquery.
+            # Feed ETags then only change with the feed's cache version, which
+            # is why shards need a shared feed cache, see `AppConfig.ready`.
+            return ChirperUser.objects.select_related('user').annotate(
+                newest_authored_id=Value(None, output_field=IntegerField()),
+                newest_mentioned_id=Value(None, output_field=IntegerField()))
+        newest_authored = Chirp.objects.filter(
+            author=OuterRef('pk')).order_by('-id').values('id')[:1]
+        newest_mentioned = Mention.objects.filter(
+            chirperuser=OuterRef('pk')).order_by('-chirp').values('chirp')[:1]
+        return ChirperUser.objects.select_related('user').annotate(
+            newest_authored_id=Subquery(newest_authored),
+            newest_mentioned_id=Subquery(newest_mentioned))
+
+    @property
+    def newest_chirp_id(self):
+        'Only available on `ChirperUser`s from `find_feed_owner`.'
+        return max(
+            [self.newest_authored_id or 0, self.newest_mentioned_id or 0]) or None
 
     @staticmethod
     def find_by_key(key: str) -> 'ChirperUser':
-        return ChirperUser.objects.get(session__key=key)
+        '''`ChirperUser.find_by_key` returns the `ChirperUser` logged in with session `key`.
+
+        Keys that were looked up recently are remembered in `app.session_cache`,
+        so they are found by primary key instead of through the sessions table.
+        '''
+        ids = session_cache.get(key)
+        if ids is None:
+            chirper = ChirperUser.objects.select_related('user', 'session').get(
+                session__key=key)
+            session_cache.set(key, chirper.id, chirper.session.id)
+            return chirper
+        chirper_id, session_id = ids
+        chirper = ChirperUser.objects.select_related('user').get(id=chirper_id)
+        chirper.session = Session(
+            id=session_id, chirperuser=chirper, key=key)
+        return chirper
 
     @staticmethod
     def username_exists(username: str) -> bool:
+        '''`ChirperUser.username_exists` tells whether a `ChirperUser` has `username`.
+
+        Names that `app.usernames` knows are not taken are answered without a
+        query.
+        '''
+        if not usernames.might_exist(username):
+            return False
         return ChirperUser.objects.filter(user__username=username).exists()
 
+    @staticmethod
+    async def ausername_exists(username: str) -> bool:
+        if not await usernames.amight_exist(username):
+            return False
+        return await ChirperUser.objects.filter(
+            user__username=username).aexists()
+
+    @staticmethod
+    def search(prefix: str, limit: int) -> list:
+        '''`ChirperUser.search` returns up to `limit` `(username, name)` pairs for usernames starting with `prefix`.
+
+        Case is ignored, and matches are ordered by username. Where the database
+        has a trigram index on `username_folded` (PostgreSQL), a short result
+        is topped up with usernames that contain `prefix` elsewhere. Results
+        are kept in `user_searches` for a short while.
+        '''
+        prefix = prefix.casefold()
+        found = user_searches.get((prefix, limit))
+        if found is not None:
+            return found
+        found = list(
+            ChirperUser.objects.filter(username_prefix_q(prefix))
+            .order_by('username_folded')
+            .values_list('user__username', 'name')[:limit])
+        if len(found) < limit and connections[router.db_for_read(
+                ChirperUser)].vendor == 'postgresql':
+            found += list(
+                ChirperUser.objects.filter(username_folded__contains=prefix)
+                .exclude(username_folded__startswith=prefix)
+                .order_by('username_folded')
+                .values_list('user__username', 'name')[:limit - len(found)])
+        user_searches.set((prefix, limit), found)
+        return found
+
     def chirp(self, message):
         '`ChirperUser.chirp` will create a new chirp with the provided message and `self` as the author'
-        return Chirp.objects.create(author=self, message=message)
+        chirp = Chirp(author=self, message=message)
+        chirp.save()
+        return chirp
+
+    def chirp_many(self, messages) -> list:
+        '''`ChirperUser.chirp_many` creates a chirp for each valid message in `messages`.
+
+        Returns a list with, for each message, either the new `Chirp` or the
+        `ValidationError` that kept it from being created. All the chirps and
+        their mentions are written in one transaction with bulk inserts.
+        '''
+        results = []
+        for message in messages:
+            chirp = Chirp(author=self, message=message)
+            try:
+                if not isinstance(message, str):
+                    raise ValidationError({'message': ['Enter a string.']})
+                # Ids are only set here with snowflake ids, which are unique
+                # without asking the database.
+                chirp.full_clean(exclude=['author', 'id'])
+            except ValidationError as e:
+                results.append(e)
+            else:
+                results.append(chirp)
+        chirps = [chirp for chirp in results if isinstance(chirp, Chirp)]
+        if chirps:
+            db = router.db_for_write(Chirp, instance=self)
+            with transaction.atomic(using=db):
+                Chirp.objects.using(db).bulk_create(chirps)
+                mentioned = Chirp.write_references(chirps)
+                search.index(chirps)
+                feed_cache.bump({self.id}.union(*mentioned.values()), using=db)
+                transaction.on_commit(lambda: metrics.count(
+                    'chirper_chirps_written_total', len(chirps)), using=db)
+            for chirp in chirps:
+                chirp._saved_message = chirp.message
+        return results
+
+    def feed(self, before=None, limit=None) -> QuerySet:
+        '''`ChirperUser.feed` returns a queryset representing all `Chirp`s that belong to `self`'s feed.
+
+        Chirps are ordered newest first, with `id` breaking ties between chirps
+        from the same instant. If `before` is a `(date, id)` pair, only the chirps
+        that come after it in that order are included.
+
+        `settings.CHIRPER_FEED_SOURCE` picks where the feed is read from: the
+        `'live'` query over chirps and mentions, or the `'timeline'` that
+        `Chirp.save` materializes for each user. When chirps are sharded the
+        feed is always live and merged from every shard, see `sharded_feed`.
+        With `settings.CHIRP_ARCHIVE_DIR` set, the feed continues into the
+        archived chirps once the database's run out, see `app.archive`.
+        '''
+        if sharding.enabled():
+            chirps = self.sharded_feed(before, limit)
+        elif settings.CHIRPER_FEED_SOURCE == 'timeline':
+            chirps = self.timeline_feed(before, limit)
+        else:
+            chirps = self.live_feed(before, limit)
+        if archive.enabled():
+            chirps = archive.ContinuedFeed(
+                chirps, Chirp, self.id, before,
+                prefetch=[Chirp.authors_prefetch()])
+            if limit is not None:
+                chirps = chirps[:limit]
+        return chirps
 
-    def feed(self) -> QuerySet:
-        '`ChirperUser.feed` returns a queryset representing all `Chirp`s that belong to `self`\'s feed.'
-        return (self.chirp_set.all() |
-                self.chirping_at_set.all()).order_by('-date')
+    def live_feed(self, before=None, limit=None, using=None) -> QuerySet:
+        '''`ChirperUser.live_feed` computes `self`'s feed from `Chirp` and its mentions.
+
+        The feed is the `UNION` of the chirps `self` wrote and the chirps that
+        mention `self`. Each side is read in index order, so when `limit` is given
+        neither side reads more than `limit` rows before they are merged.
+
+        With `using`, only the part of the feed stored in that shard is read,
+        and the chirps come without their authors, see `Chirp.feed_objects`.
+        '''
+        authored = Chirp.feed_objects(using).filter(author=self)
+        # Mentions are read in the order of their own copy of the chirp's date.
+        mentioned = Q(mention__chirperuser=self)
+        if before is not None:
+            authored = pagination.before(authored, *before)
+            mentioned &= pagination.before_q(*before, 'mention__date',
+                                             'mention__chirp_id')
+        mentioned = Chirp.feed_objects(using).filter(mentioned)
+        if limit is not None:
+            # Not every backend allows LIMIT inside a compound statement, so each
+            # side is limited in a subquery of its own.
+            authored = Chirp.feed_objects(using).filter(
+                pk__in=authored.order_by(
+                    *pagination.newest_first()).values('pk')[:limit])
+            mentioned = Chirp.feed_objects(using).filter(
+                pk__in=mentioned.order_by(
+                    *pagination.newest_first('mention__date',
+                                             'mention__chirp_id')
+                ).values('pk')[:limit])
+        if using is None or using == router.db_for_write(Chirp, instance=self):
+            chirps = authored.union(mentioned)
+        else:
+            # `self` has no chirps of its own in other shards.
+            chirps = mentioned
+        chirps = chirps.order_by(*pagination.newest_first())
+        if limit is not None:
+            chirps = chirps[:limit]
+        return chirps
+
+    def sharded_feed(self, before=None, limit=None) -> 'sharding.MergedQuerySet':
+        '''`ChirperUser.sharded_feed` reads `self`'s feed from every shard.
+
+        Each shard runs `live_feed` for the chirps it holds, on the shard
+        pool, and the results are merged newest first. Authors are loaded from
+        the default database for the merged chirps only.
+        '''
+        chirps = sharding.MergedQuerySet(
+            {
+                alias: self.live_feed(before, limit, using=alias)
+                for alias in settings.CHIRP_SHARDS
+            },
+            prefetch=[Chirp.authors_prefetch()])
+        if limit is not None:
+            chirps = chirps[:limit]
+        return chirps
+
+    def timeline_feed(self, before=None, limit=None) -> QuerySet:
+        '''`ChirperUser.timeline_feed` reads `self`'s feed from its `TimelineEntry` rows.
+
+        This is a single range scan over the `(owner, date, chirp)` index, or
+        the `(owner, chirp)` one with snowflake ids.
+        '''
+        entries = Q(timelineentry__owner=self)
+        if before is not None:
+            entries &= pagination.before_q(
+                *before,
+                date_field='timelineentry__date',
+                id_field='timelineentry__chirp_id')
+        chirps = Chirp.feed_objects().filter(entries).order_by(
+            *pagination.newest_first('timelineentry__date',
+                                     'timelineentry__chirp_id'))
+        if limit is not None:
+            chirps = chirps[:limit]
+        return chirps
 
     def login(self):
-        if self.is_logged_in():
-            self.logout()
-        Session.create(self)
+        '''`ChirperUser.login` gives `self` a new session key, replacing any old one.
+
+        The old key is forgotten by every process, see `Session.rotate`.
+        '''
+        Session.rotate(self)
 
     def is_logged_in(self):
         try:
@@ -89,31 +438,254 @@ class ChirperUser(models.Model):
 
     def logout(self):
         if self.is_logged_in():
+            session_cache.forget(self.id, using=router.db_for_write(Session))
             self.session.delete()
 
 
+def username_prefix_q(prefix: str) -> Q:
+    '''`username_prefix_q` matches the `ChirperUser`s whose `username_folded` starts with `prefix`.
+
+    PostgreSQL serves `startswith` from the `varchar_pattern_ops` index Django
+    creates next to the `username_folded` index. SQLite only uses an index for
+    `LIKE` on case insensitive columns, but it compares text bytewise, so a
+    range over the index selects the same rows.
+    '''
+    q = Q(username_folded__startswith=prefix)
+    if (prefix and ord(prefix[-1]) < sys.maxunicode and
+            connections[router.db_for_read(ChirperUser)].vendor == 'sqlite'):
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        q &= Q(username_folded__gte=prefix, username_folded__lt=upper)
+    return q
+
+
+def add_username(sender, instance, created, update_fields=None, **kwargs):
+    usernames.add(instance.username)
+    if not created and (update_fields is None or 'username' in update_fields):
+        ChirperUser.objects.filter(user=instance).update(
+            username_folded=instance.username.casefold())
+
+
+post_save.connect(add_username, sender=User, dispatch_uid='app.add_username')
+
+
 class Chirp(models.Model):
+    # See `app.snowflake`. Without snowflake ids the default is `None`, and the
+    # database assigns ids.
+    id = models.BigAutoField(primary_key=True, default=snowflake.chirp_id)
     message = models.CharField(max_length=280)
-    author = models.ForeignKey(ChirperUser, on_delete=models.CASCADE)
+    # No database constraint, since the author is in another database when
+    # chirps are sharded.
+    author = models.ForeignKey(
+        ChirperUser, on_delete=models.CASCADE, db_constraint=False)
     date = models.DateTimeField(auto_now_add=True)
     chirping_at = models.ManyToManyField(
-        ChirperUser, related_name='chirping_at_set')
+        ChirperUser, related_name='chirping_at_set', through='Mention')
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['author', '-date', '-id'],
+                name='app_chirp_author_date_idx'),
+        ]
+
+    @staticmethod
+    def feed_objects(using=None) -> QuerySet:
+        '''`Chirp.feed_objects` returns the chirps queryset that feeds are built from.
+
+        Each chirp's author and the author's `User` are loaded in the same query,
+        and only the columns a feed shows are selected.
+
+        With `using`, the chirps are read from that shard, which has no users
+        to join, so the authors have to be loaded afterwards with
+        `authors_prefetch`.
+        '''
+        if using is not None:
+            return Chirp.objects.using(using).only('message', 'date', 'author')
+        return Chirp.objects.select_related('author__user').only(
+            'message', 'date', 'author__name', 'author__user__username')
+
+    @staticmethod
+    def authors_prefetch() -> models.Prefetch:
+        'Loads the authors of chirps read with `feed_objects(using)`, with only the columns a feed shows.'
+        return models.Prefetch(
+            'author',
+            queryset=ChirperUser.objects.select_related('user').only(
+                'name', 'user__username'))
+
+    @staticmethod
+    def search(query: str, before=None) -> QuerySet:
+        '''`Chirp.search` returns the chirps containing every word of `query`, newest first.
+
+        `before` is a `(date, id)` pair as returned by `pagination.decode_cursor`,
+        and limits the results to chirps after it. See `app.search`. When
+        chirps are sharded every shard is searched and the results merged.
+        '''
+        if sharding.enabled():
+            return sharding.MergedQuerySet(
+                {
+                    alias: Chirp.search_in(query, before, alias)
+                    for alias in settings.CHIRP_SHARDS
+                },
+                prefetch=[Chirp.authors_prefetch()])
+        return Chirp.search_in(query, before)
+
+    @staticmethod
+    def search_in(query: str, before=None, using=None) -> QuerySet:
+        chirps = Chirp.feed_objects(using).filter(
+            search.matches(query, using or router.db_for_read(Chirp)))
+        if before is not None:
+            chirps = pagination.before(chirps, *before)
+        return chirps.order_by(*pagination.newest_first())
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        chirp = super(Chirp, cls).from_db(db, field_names, values)
+        chirp._saved_message = chirp.__dict__.get('message')
+        return chirp
 
     def save(self, *args, **kwargs):
-        super(Chirp, self).save(*args, **kwargs)
-        usernames = [w[1:] for w in self.message.split() if w.startswith('@')]
-        users = ChirperUser.objects.filter(user__username__in=usernames)
-        for user in users:
-            self.chirping_at.add(user)
+        '''`Chirp.save` saves the chirp along with its mentions, hashtags, timeline entries and search index row.
+
+        Mentions and hashtags are only parsed and the message is only indexed when the
+        chirp is new or its message has changed, and everything is written in
+        one transaction.
+        '''
+        saved_message = getattr(self, '_saved_message', None)
+        db = router.db_for_write(Chirp, instance=self)
+        with transaction.atomic(using=db):
+            if self._state.adding:
+                transaction.on_commit(
+                    lambda: metrics.count('chirper_chirps_written_total'),
+                    using=db)
+            super(Chirp, self).save(*args, **kwargs)
+            if self.message != saved_message:
+                self.update_references(replace=saved_message is not None)
+                search.index([self], replace=saved_message is not None)
+        self._saved_message = self.message
+
+    def update_references(self, replace=False):
+        '''`Chirp.update_references` writes the mentions and hashtags in `self.message`.
+
+        With `replace`, rows for users that are no longer mentioned and for
+        hashtags that were removed are deleted. Every feed the chirp enters or
+        leaves gets a new cache version.
+        '''
+        user_ids = Chirp.write_references([self])[self]
+        changed_feeds = user_ids | {self.author_id}
+        if replace:
+            removed = Mention.objects.using(self._state.db).filter(
+                chirp=self).exclude(chirperuser_id__in=user_ids)
+            changed_feeds.update(removed.values_list('chirperuser_id', flat=True))
+            removed.delete()
+            Hashtag.remove(self, parse_message(self.message)[1])
+            if not sharding.enabled():
+                TimelineEntry.objects.filter(chirp=self).exclude(
+                    owner_id__in=user_ids | {self.author_id}).delete()
+        feed_cache.bump(changed_feeds, using=self._state.db)
+
+    @staticmethod
+    def write_references(chirps) -> dict:
+        '''`Chirp.write_references` writes the mentions and hashtags of every chirp in `chirps`.
+
+        All mentioned users are resolved with one query, and the `Mention` and
+        `TimelineEntry` rows for every chirp are written with one bulk insert
+        each. Hashtags are written by `Hashtag.write`. Returns a dict from each
+        chirp to the ids of the users it mentions.
+
+        The chirps must all be saved in the same database. Mentions and
+        hashtags are written next to them, and when chirps are sharded
+        timeline entries are not written at all.
+        '''
+        parsed = {chirp: parse_message(chirp.message) for chirp in chirps}
+        usernames = {chirp: names for chirp, (names, _) in parsed.items()}
+        everyone = set().union(*usernames.values())
+        ids = {}
+        if everyone:
+            ids = dict(
+                ChirperUser.objects.filter(user__username__in=everyone)
+                .values_list('user__username', 'id'))
+        mentioned = {
+            chirp: {ids[username] for username in names if username in ids}
+            for chirp, names in usernames.items()
+        }
+        db = chirps[0]._state.db
+        Mention.objects.using(db).bulk_create(
+            [
+                Mention(chirp=chirp, chirperuser_id=user_id, date=chirp.date)
+                for chirp, user_ids in mentioned.items()
+                for user_id in user_ids
+            ],
+            ignore_conflicts=True)
+        if not sharding.enabled():
+            TimelineEntry.objects.bulk_create(
+                [
+                    TimelineEntry(owner_id=owner_id, chirp=chirp, date=chirp.date)
+                    for chirp, user_ids in mentioned.items()
+                    for owner_id in user_ids | {chirp.author_id}
+                ],
+                ignore_conflicts=True)
+        # An edited chirp only adds the tags its saved message did not have.
+        Hashtag.write({
+            chirp: set(tags).difference(
+                parse_message(getattr(chirp, '_saved_message', None) or '')[1])
+            for chirp, (_, tags) in parsed.items()
+        }, using=db)
+        return mentioned
 
     def __str__(self):
         return '{} ({}): {}'.format(self.author.username, self.date,
                                     self.message)
 
 
+class Mention(models.Model):
+    '''`Mention` is the through table for `Chirp.chirping_at`.
+
+    It keeps the table Django originally created for the many to many field, and
+    adds a `(chirperuser, chirp)` index so a user's mentions can be found without
+    scanning the whole table. `date` is copied from the chirp so a user's
+    mentions can be read newest first from one index, like `TimelineEntry`.
+    '''
+    chirp = models.ForeignKey(Chirp, on_delete=models.CASCADE)
+    chirperuser = models.ForeignKey(
+        ChirperUser, on_delete=models.CASCADE, db_constraint=False)
+    date = models.DateTimeField()
+
+    class Meta:
+        db_table = 'app_chirp_chirping_at'
+        unique_together = [('chirp', 'chirperuser')]
+        indexes = [
+            models.Index(
+                fields=['chirperuser', 'chirp'],
+                name='app_mention_user_chirp_idx'),
+            models.Index(
+                fields=['chirperuser', '-date', '-chirp'],
+                name='app_mention_user_date_idx'),
+        ]
+
+
+class TimelineEntry(models.Model):
+    '''`TimelineEntry` records that `chirp` belongs in `owner`'s feed.
+
+    `Chirp.save` writes one for the author and one for each mentioned user, so
+    the feed can be read without recomputing it. `date` is copied from the chirp
+    so the entries can be read in feed order from one index.
+    '''
+    owner = models.ForeignKey(ChirperUser, on_delete=models.CASCADE)
+    chirp = models.ForeignKey(Chirp, on_delete=models.CASCADE)
+    date = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('owner', 'chirp')]
+        indexes = [
+            models.Index(
+                fields=['owner', '-date', '-chirp'],
+                name='app_timeline_owner_date_idx'),
+        ]
+
+
 class Session(models.Model):
     chirperuser = models.OneToOneField(ChirperUser, on_delete=models.CASCADE)
-    key = models.CharField(max_length=40)
+    key = models.CharField(max_length=40, unique=True)
 
     @staticmethod
     def create(chirperuser):
@@ -123,6 +695,291 @@ class Session(models.Model):
 
         return chirperuser.session
 
+    @staticmethod
+    def rotate(chirperuser):
+        '''`Session.rotate` stores a new key for `chirperuser`, creating the session if needed.
+
+        Where the database supports it this is one `INSERT ... ON CONFLICT DO
+        UPDATE` that rewrites the key of the existing row, instead of deleting
+        the row and inserting a new one. The old key is dropped from
+        `app.session_cache`.
+        '''
+        key = secrets.token_hex(20)
+        session_cache.forget(chirperuser.id, using=router.db_for_write(Session))
+        connection = connections[router.db_for_write(Session)]
+        features = connection.features
+        if (features.supports_update_conflicts_with_target and
+                features.can_return_columns_from_insert):
+            quote = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO {table} ({chirperuser}, {key}) VALUES (%s, %s) '
+                    'ON CONFLICT ({chirperuser}) DO UPDATE SET {key} = EXCLUDED.{key} '
+                    'RETURNING {id}'.format(
+                        table=quote(Session._meta.db_table),
+                        chirperuser=quote('chirperuser_id'),
+                        key=quote('key'),
+                        id=quote('id')), [chirperuser.id, key])
+                session = Session(
+                    id=cursor.fetchone()[0], chirperuser=chirperuser, key=key)
+        else:
+            session, _ = Session.objects.update_or_create(
+                chirperuser=chirperuser, defaults={'key': key})
+        chirperuser.session = session
+        return session
+
     @staticmethod
     def delete_with_key(key):
         Session.objects.get(key=key).chirperuser.logout()
+
+
+class Hashtag(models.Model):
+    '''`Hashtag` is a case folded `#` tag that has been used in a chirp.'''
+    name = models.CharField(max_length=HASHTAG_MAX_LENGTH, unique=True)
+
+    @staticmethod
+    def write(hashtags, using=None):
+        '''`Hashtag.write` records the hashtags of new chirps, given as a dict from chirp to tag names.
+
+        Missing `Hashtag` rows, the `ChirpHashtag` rows and the trending counts
+        are each written with one statement. Chirps without hashtags cost no
+        queries. `Hashtag` rows always live in the default database, while the
+        `ChirpHashtag` rows and trending counts are written to `using`, the
+        database of the chirps.
+        '''
+        names = set().union(*hashtags.values())
+        if not names:
+            return
+        Hashtag.objects.bulk_create(
+            [Hashtag(name=name) for name in names], ignore_conflicts=True)
+        ids = dict(
+            Hashtag.objects.filter(name__in=names).values_list('name', 'id'))
+        ChirpHashtag.objects.using(using).bulk_create(
+            [
+                ChirpHashtag(chirp=chirp, hashtag_id=ids[name], date=chirp.date)
+                for chirp, tags in hashtags.items() for name in tags
+            ],
+            ignore_conflicts=True)
+        counts = {}
+        for chirp, tags in hashtags.items():
+            minute = chirp.date.replace(second=0, microsecond=0)
+            for name in tags:
+                key = (ids[name], minute)
+                counts[key] = counts.get(key, 0) + 1
+        HashtagMinute.add(counts, using)
+        HashtagMinute.prune()
+
+    @staticmethod
+    def remove(chirp, keep):
+        '''`Hashtag.remove` removes the hashtags of `chirp` that are not in `keep`, for a chirp whose message was edited.
+
+        They are taken off the trending counts of the minute the chirp was
+        written in as well.
+        '''
+        db = chirp._state.db
+        tagged = dict(
+            ChirpHashtag.objects.using(db).filter(chirp=chirp).values_list(
+                'hashtag_id', 'id'))
+        if not tagged:
+            return
+        kept = Hashtag.objects.filter(
+            id__in=tagged, name__in=keep).values_list('id', flat=True)
+        ids = tagged.keys() - set(kept)
+        if not ids:
+            return
+        ChirpHashtag.objects.using(db).filter(
+            id__in=[tagged[hashtag_id] for hashtag_id in ids]).delete()
+        minute = chirp.date.replace(second=0, microsecond=0)
+        HashtagMinute.subtract({(hashtag_id, minute): 1 for hashtag_id in ids},
+                               db)
+
+    @staticmethod
+    def chirps(name: str, before=None) -> QuerySet:
+        '''`Hashtag.chirps` returns the chirps tagged with `name`, newest first.
+
+        The chirps are read in order from the `(hashtag, date, chirp)` index of
+        `ChirpHashtag`, or the `(hashtag, chirp)` one with snowflake ids.
+        `before` works as for `ChirperUser.feed`. When chirps are sharded every
+        shard is read and the results merged.
+        '''
+        name = name.casefold()
+        if sharding.enabled():
+            ids = list(
+                Hashtag.objects.filter(name=name).values_list('id', flat=True))
+            return sharding.MergedQuerySet(
+                {
+                    alias: Hashtag.chirps_in(
+                        Q(chirphashtag__hashtag_id__in=ids), before, alias)
+                    for alias in settings.CHIRP_SHARDS
+                },
+                prefetch=[Chirp.authors_prefetch()])
+        return Hashtag.chirps_in(Q(chirphashtag__hashtag__name=name), before)
+
+    @staticmethod
+    def chirps_in(condition: Q, before=None, using=None) -> QuerySet:
+        if before is not None:
+            condition &= pagination.before_q(*before, 'chirphashtag__date',
+                                             'chirphashtag__chirp_id')
+        return Chirp.feed_objects(using).filter(condition).order_by(
+            *pagination.newest_first('chirphashtag__date',
+                                     'chirphashtag__chirp_id'))
+
+    @staticmethod
+    def trending(limit: int) -> list:
+        '''`Hashtag.trending` returns `(name, count)` for the `limit` most used hashtags lately.
+
+        Counts are added up from the `HashtagMinute` buckets of the last
+        `TRENDING_WINDOW_MINUTES` minutes. Results are kept in `trending_tags`.
+        Buckets that have left the window are deleted by `HashtagMinute.prune`
+        as chirps are written, so this only reads. When chirps are sharded, the
+        counts of every shard are added up.
+        '''
+        found = trending_tags.get(limit)
+        if found is not None:
+            return found
+        since = timezone.now() - timedelta(
+            minutes=settings.TRENDING_WINDOW_MINUTES)
+        if sharding.enabled():
+            found = Hashtag.sharded_trending(since, limit)
+            trending_tags.set(limit, found)
+            return found
+        found = [
+            (name, total) for name, total in HashtagMinute.objects.filter(
+                minute__gte=since).values_list('hashtag__name').annotate(
+                    total=Sum('count')).filter(total__gt=0).order_by(
+                        '-total', 'hashtag__name')[:limit]
+        ]
+        trending_tags.set(limit, found)
+        return found
+
+    @staticmethod
+    def sharded_trending(since, limit: int) -> list:
+        '''`Hashtag.sharded_trending` is `Hashtag.trending` for sharded chirps.
+
+        Each shard adds up its buckets per hashtag id, in parallel. The totals
+        are added up here, and only the names of the `limit` most used
+        hashtags are read from the default database.
+        '''
+        totals = {}
+        for rows in sharding.run([
+            (lambda alias=alias: list(
+                HashtagMinute.objects.using(alias).filter(minute__gte=since)
+                .values_list('hashtag_id').annotate(total=Sum('count'))))
+            for alias in settings.CHIRP_SHARDS
+        ]):
+            for hashtag_id, total in rows:
+                totals[hashtag_id] = totals.get(hashtag_id, 0) + total
+        names = dict(
+            Hashtag.objects.filter(
+                id__in=[hashtag_id for hashtag_id, total in totals.items()
+                        if total > 0]).values_list('id', 'name'))
+        return sorted(
+            ((names[hashtag_id], total)
+             for hashtag_id, total in totals.items() if hashtag_id in names),
+            key=lambda found: (-found[1], found[0]))[:limit]
+
+    def __str__(self):
+        return '#' + self.name
+
+
+class ChirpHashtag(models.Model):
+    '''`ChirpHashtag` records that `chirp` is tagged with `hashtag`.
+
+    `date` is copied from the chirp so a tag's chirps can be read newest first
+    from one index, like `TimelineEntry`. Rows live next to their chirp, so
+    with sharding `hashtag` points into another database and has no
+    constraint.
+    '''
+    chirp = models.ForeignKey(Chirp, on_delete=models.CASCADE)
+    hashtag = models.ForeignKey(
+        Hashtag, on_delete=models.CASCADE, db_constraint=False)
+    date = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('hashtag', 'chirp')]
+        indexes = [
+            models.Index(
+                fields=['hashtag', '-date', '-chirp'],
+                name='app_chirphashtag_date_idx'),
+        ]
+
+
+class HashtagMinute(models.Model):
+    '''`HashtagMinute` counts the chirps tagged with `hashtag` during one minute.
+
+    `Hashtag.write` adds to the counts as chirps are written, so trending tags
+    are found by adding up a window of these rows rather than scanning chirps.
+    With sharding, each shard counts the hashtags of its own chirps.
+    '''
+    hashtag = models.ForeignKey(
+        Hashtag, on_delete=models.CASCADE, db_constraint=False)
+    minute = models.DateTimeField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('hashtag', 'minute')]
+
+    @staticmethod
+    def add(counts, using=None):
+        '''`HashtagMinute.add` adds to the counts given as a dict from `(hashtag_id, minute)` to a number.
+
+        Where the database supports it, all counts are added with one
+        `INSERT ... ON CONFLICT DO UPDATE` statement. `using` is the database
+        of the chirps being counted.
+        '''
+        if not counts:
+            return
+        using = using or router.db_for_write(HashtagMinute)
+        connection = connections[using]
+        if not connection.features.supports_update_conflicts_with_target:
+            for (hashtag_id, minute), count in counts.items():
+                updated = HashtagMinute.objects.using(using).filter(
+                    hashtag_id=hashtag_id, minute=minute).update(
+                        count=F('count') + count)
+                if not updated:
+                    HashtagMinute.objects.using(using).create(
+                        hashtag_id=hashtag_id, minute=minute, count=count)
+            return
+        quote = connection.ops.quote_name
+        table = quote(HashtagMinute._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO {table} ({hashtag}, {minute}, {count}) '
+                'VALUES (%s, %s, %s) '
+                'ON CONFLICT ({hashtag}, {minute}) '
+                'DO UPDATE SET {count} = {table}.{count} + EXCLUDED.{count}'
+                .format(
+                    table=table,
+                    hashtag=quote('hashtag_id'),
+                    minute=quote('minute'),
+                    count=quote('count')),
+                [(hashtag_id,
+                  connection.ops.adapt_datetimefield_value(minute), count)
+                 for (hashtag_id, minute), count in counts.items()])
+
+    @staticmethod
+    def subtract(counts, using=None):
+        '''`HashtagMinute.subtract` takes the counts given as for `HashtagMinute.add` off again.
+
+        Buckets that were deleted meanwhile are left alone.
+        '''
+        for (hashtag_id, minute), count in counts.items():
+            HashtagMinute.objects.using(using).filter(
+                hashtag_id=hashtag_id, minute=minute, count__gte=count).update(
+                    count=F('count') - count)
+
+    @staticmethod
+    def prune():
+        '''`HashtagMinute.prune` deletes the buckets that have left the trending window.
+
+        It is called as hashtags are written and deletes at most once a minute
+        per process, so the trending view never writes. When chirps are
+        sharded, every shard is pruned.
+        '''
+        if pruned_minutes.get('pruned') is not None:
+            return
+        pruned_minutes.set('pruned', True)
+        since = timezone.now() - timedelta(
+            minutes=settings.TRENDING_WINDOW_MINUTES)
+        for db in settings.CHIRP_SHARDS or [router.db_for_write(HashtagMinute)]:
+            HashtagMinute.objects.using(db).filter(minute__lt=since).delete()
@@ -0,0 +1,170 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from app import snowflake
+
+PAGE_SIZE = 25
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(chirp) -> str:
+    '''`encode_cursor` returns an opaque cursor pointing just past `chirp` in a feed.
+
+    The cursor is the chirp's `(date, id)` pair, base64 encoded so that clients
+    treat it as a token rather than something to construct themselves.
+    '''
+    raw = '{}|{}'.format(chirp.date.isoformat(), chirp.id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str):
+    '''`decode_cursor` turns a cursor from `encode_cursor` back into a `(date, id)` pair.
+
+    Raises `InvalidCursor` for anything that was not produced by `encode_cursor`,
+    including dates without a time zone.
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        date, id = raw.split('|')
+        date = parse_datetime(date)
+        id = int(id)
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise InvalidCursor(cursor) from e
+    if date is None or timezone.is_naive(date):
+        raise InvalidCursor(cursor)
+    return date, id
+
+
+def before(queryset: QuerySet, date, id) -> QuerySet:
+    '`before` narrows `queryset` to the chirps that sort after `(date, id)` in a newest-first feed.'
+    return queryset.filter(before_q(date, id))
+
+
+def before_q(date, id, date_field='date', id_field='id') -> Q:
+    '''`before_q` is the condition used by `before`, as a `Q` object.
+
+    `date_field` and `id_field` name the lookups that hold the chirp's date and
+    id, for querysets that are ordered through a related table. Conditions on a
+    related table must be combined into one `filter` call so they apply to the
+    same joined row. With snowflake ids, the id alone decides, see
+    `newest_first`.
+    '''
+    if snowflake.enabled():
+        return Q(**{id_field + '__lt': id})
+    return (Q(**{date_field + '__lt': date}) |
+            Q(**{date_field: date, id_field + '__lt': id}))
+
+
+def newest_first(date_field='date', id_field='id') -> list:
+    '''`newest_first` returns the `order_by` arguments that sort chirps newest first.
+
+    Chirps are sorted by `(date, id)`, or by id alone when ids come from
+    `app.snowflake`, since those start with the time the chirp was written.
+    The fields are named as in `before_q`.
+    '''
+    if snowflake.enabled():
+        return ['-' + id_field]
+    return ['-' + date_field, '-' + id_field]
+
+
+def sort_key(chirp):
+    '`sort_key` is the key `newest_first` sorts by, for sorting chirps in Python.'
+    if snowflake.enabled():
+        return chirp.id
+    return (chirp.date, chirp.id)
+
+
+class LazyFeed:
+    '''`LazyFeed` is a newest-first list of chirps that is only read when it is iterated.
+
+    It can be counted, sliced and iterated like a queryset, which is all
+    `Paginator` and `KeysetPage` need. Subclasses implement `count` and
+    `fetch`, which reads the chirps from `start` to `stop`, and `copy` for
+    slicing.
+    '''
+    ordered = True
+
+    def __init__(self, start=0, stop=None):
+        self.start = start
+        self.stop = stop
+        self._result_cache = None
+
+    def __getitem__(self, k):
+        if isinstance(k, int):
+            if k < 0:
+                raise ValueError('Negative indexing is not supported.')
+            return list(self[k:k + 1])[0]
+        if ((k.start is not None and k.start < 0) or
+                (k.stop is not None and k.stop < 0) or k.step is not None):
+            raise ValueError('Only slices with non-negative bounds are supported.')
+        start = self.start + (k.start or 0)
+        stop = self.stop
+        if k.stop is not None:
+            stop = self.start + k.stop
+            if self.stop is not None:
+                stop = min(stop, self.stop)
+        return self.copy(start, stop)
+
+    def iterator(self):
+        return iter(self)
+
+    def __iter__(self):
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def _fetch_all(self) -> list:
+        if self._result_cache is None:
+            self._result_cache = self.fetch()
+        return self._result_cache
+
+
+def keyset_page(queryset: QuerySet, size: int=PAGE_SIZE):
+    '''`keyset_page` returns `(chirps, next_cursor)` for a newest-first chirp queryset.
+
+    One extra row is fetched to learn whether there is a next page, so no
+    `COUNT(*)` is ever needed. `next_cursor` is `None` on the last page.
+    '''
+    page = KeysetPage(queryset, size)
+    chirps = list(page)
+    return chirps, page.next_cursor
+
+
+async def akeyset_page(queryset: QuerySet, size: int=PAGE_SIZE):
+    '`akeyset_page` is the async version of `keyset_page`.'
+    chirps = [chirp async for chirp in queryset[:size + 1]]
+    if len(chirps) > size:
+        chirps = chirps[:size]
+        return chirps, encode_cursor(chirps[-1])
+    return chirps, None
+
+
+class KeysetPage:
+    '''`KeysetPage` iterates over one page of a newest-first chirp queryset.
+
+    Chirps are read from a queryset iterator as they are needed.
+    `next_cursor` is set once the iteration has reached the end of the page.
+    '''
+
+    def __init__(self, queryset: QuerySet, size: int=PAGE_SIZE):
+        self.queryset = queryset
+        self.size = size
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        for i, chirp in enumerate(self.queryset[:self.size + 1].iterator()):
+            if i == self.size:
+                self.next_cursor = encode_cursor(last)
+                return
+            last = chirp
+            yield chirp
@@ -0,0 +1,82 @@
+'''Sends the reads of some views to read replicas.
+
+`settings.REPLICA_DATABASES` lists the database aliases made from
+`REPLICA_DATABASE_URL`. Views decorated with `replica_reads` pick one of them
+per request, and `ReplicaRouter` sends the reads made while the view runs to
+it. Everything else, including every write, uses `default`.
+
+Replicas lag behind the primary. `feed_cache.bump` remembers every feed a
+write changed for `REPLICA_PIN_SECONDS` seconds, in the cache every process
+shares, and the feed views read such feeds from the primary instead (see
+`read_from_primary`), so users see their own chirps and the chirps that
+mention them right away. Likewise usernames saved lately (see
+`usernames.saved_recently`) are looked up on the primary. `AppConfig.ready`
+refuses replicas when those caches are not shared.
+'''
+import contextvars
+import random
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+_reads = contextvars.ContextVar('replica_reads', default=None)
+
+
+class ReplicaRouter:
+    '''`ReplicaRouter` routes reads inside `replica_reads` views to the chosen replica.
+
+    It has no opinion about anything else, so Django's default routing
+    applies. Migrations never run on replicas.
+    '''
+
+    def db_for_read(self, model, **hints):
+        return _reads.get()
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.REPLICA_DATABASES:
+            return False
+        return None
+
+
+def choose(request: HttpRequest):
+    'Returns the replica alias `request` should read from, or `None` for the primary.'
+    if not settings.REPLICA_DATABASES:
+        return None
+    return random.choice(settings.REPLICA_DATABASES)
+
+
+def reading_replica() -> bool:
+    'Returns whether reads go to a replica at this point of the current view.'
+    return _reads.get() is not None
+
+
+def read_from_primary():
+    'Sends the remaining reads of the current `replica_reads` view to the primary.'
+    _reads.set(None)
+
+
+def replica_reads(view):
+    'Makes the reads of `view` go to a replica, see `choose`.'
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+            token = _reads.set(choose(request))
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                _reads.reset(token)
+    else:
+
+        @wraps(view)
+        def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+            token = _reads.set(choose(request))
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                _reads.reset(token)
+
+    return wrapper
+
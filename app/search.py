@@ -0,0 +1,74 @@
+'''Full-text search over chirp messages.
+
+On SQLite the text index is the FTS5 table `app_chirp_fts`, whose rowids are
+chirp ids. Its rows are written by `index`, which `Chirp.save` and the bulk
+write paths call in the same transaction as the chirps. On PostgreSQL the
+index is a GIN index on `to_tsvector('simple', message)`, which the database
+keeps current by itself, so `index` does nothing there. Other databases fall
+back to a scan with `icontains`. When chirps are sharded, each shard indexes
+its own chirps and `Chirp.search` queries them all.
+
+Rows of deleted chirps are left in `app_chirp_fts`. Searches only return
+chirps that still exist, and `rebuild_search_index` drops the leftovers.
+'''
+import re
+
+from django.db import connections, router
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'app_chirp_fts'
+
+GIN_INDEX = 'app_chirp_message_fts_idx'
+
+
+def index(chirps, replace=False):
+    '''Writes the messages of `chirps` to the text index.
+
+    With `replace`, rows the chirps already have are removed first, for
+    chirps whose message was edited.
+    '''
+    if not chirps:
+        return
+    connection = connections[router.db_for_write(
+        type(chirps[0]), instance=chirps[0])]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        if replace:
+            cursor.executemany(
+                'DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE),
+                [(chirp.id, ) for chirp in chirps])
+        cursor.executemany(
+            'INSERT INTO {} (rowid, message) VALUES (%s, %s)'.format(FTS_TABLE),
+            [(chirp.id, chirp.message) for chirp in chirps])
+
+
+def terms(query: str) -> list:
+    'Returns the words of `query`, split the way the text index splits them.'
+    return re.findall(r'\w+', query)
+
+
+def matches(query: str, using: str):
+    '''Returns a filter for `Chirp` querysets that keeps chirps containing every word of `query`.
+
+    `using` is the alias of the database the queryset reads from.
+    '''
+    words = terms(query)
+    vendor = connections[using].vendor
+    if vendor == 'sqlite':
+        # Each word is quoted, so FTS5 query syntax in `query` is not
+        # interpreted.
+        match = ' '.join('"{}"'.format(word) for word in words)
+        return Q(id__in=RawSQL(
+            'SELECT rowid FROM {} WHERE {} MATCH %s'.format(
+                FTS_TABLE, FTS_TABLE), [match]))
+    if vendor == 'postgresql':
+        return RawSQL(
+            "to_tsvector('simple', app_chirp.message) @@ "
+            "plainto_tsquery('simple', %s)", [' '.join(words)],
+            output_field=BooleanField())
+    q = Q()
+    for word in words:
+        q &= Q(message__icontains=word)
+    return q
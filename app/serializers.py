@@ -0,0 +1,79 @@
+'''Turns chirps and chirpers into JSON.
+
+Each shape the API returns has one encoder here, so views never build the
+same nested dicts in more than one place. `dumps` uses `orjson` when it is
+installed and falls back to the standard library otherwise.
+'''
+import json
+
+from app import timing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(json_dumpable) -> bytes:
+    with timing.serializing():
+        if orjson is not None:
+            return orjson.dumps(json_dumpable)
+        return json.dumps(json_dumpable, separators=(',', ':')).encode('utf-8')
+
+
+def author(chirper) -> dict:
+    return {'name': chirper.name, 'username': chirper.username}
+
+
+def chirp(chirp) -> dict:
+    return {
+        'author': author(chirp.author),
+        'date': {
+            'month': chirp.date.month,
+            'day': chirp.date.day,
+            'year': chirp.date.year
+        },
+        'message': chirp.message
+    }
+
+
+def profile(chirper) -> dict:
+    return {
+        'name': chirper.name,
+        'username': chirper.username,
+        'description': chirper.description,
+        'location': chirper.location,
+        'website': chirper.website,
+        'joined': {
+            'month': chirper.joined.month,
+            'year': chirper.joined.year
+        }
+    }
+
+
+def feed(chirper, chirps, **extra) -> dict:
+    return {
+        'chirper': profile(chirper),
+        'chirps': [chirp(c) for c in chirps],
+        **extra
+    }
+
+
+def stream_feed(chirper, chirps, **extra):
+    '''Yields the JSON of `feed(chirper, chirps, **extra)` in pieces.
+
+    Each chirp is encoded as it is taken from `chirps`, so a queryset iterator
+    can be written out without holding the whole page in memory. Values in
+    `extra` may be callables, which are called once every chirp is written.
+    '''
+    yield b'{"chirper":' + dumps(profile(chirper)) + b',"chirps":['
+    separator = b''
+    for c in chirps:
+        yield separator + dumps(chirp(c))
+        separator = b','
+    yield b']'
+    for key, value in extra.items():
+        if callable(value):
+            value = value()
+        yield b',' + dumps(key) + b':' + dumps(value)
+    yield b'}'
@@ -0,0 +1,87 @@
+'''Remembers which user a session key belongs to, in Django's cache framework.
+
+`ChirperUser.find_by_key` looks keys up here before going to the sessions
+table. The cache is shared by every process, so once `ChirperUser.logout` or
+`Session.rotate` forget a key, no process accepts it any more. A cache that
+only one process sees could not forget a key in the others, so then nothing
+is cached. Next to each key the user's current key is kept, so a login can
+forget the previous key without reading it first.
+'''
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from app import caching, metrics
+
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0}
+
+
+def cache():
+    return caches[settings.SESSION_KEY_CACHE_ALIAS]
+
+
+def enabled() -> bool:
+    return caching.shared(settings.SESSION_KEY_CACHE_ALIAS)
+
+
+def entry_key(key: str) -> str:
+    return 'session-key:{}'.format(key)
+
+
+def owner_key(chirper_id) -> str:
+    return 'session-owner:{}'.format(chirper_id)
+
+
+def get(key: str):
+    'Returns the `(chirperuser_id, session_id)` of session `key`, or `None` if it is not cached.'
+    if not enabled():
+        return None
+    ids = cache().get(entry_key(key))
+    with _lock:
+        _counters['hits' if ids is not None else 'misses'] += 1
+    return ids
+
+
+def set(key: str, chirper_id, session_id):
+    if not enabled():
+        return
+    cache().set_many({
+        entry_key(key): (chirper_id, session_id),
+        owner_key(chirper_id): key,
+    }, settings.SESSION_KEY_CACHE_TTL)
+
+
+def forget(chirper_id, using=None):
+    '''Forgets the cached key of the `ChirperUser` with id `chirper_id`.
+
+    The key is forgotten right away, and again once the transaction on
+    database `using` that changes the session commits, so a lookup that read
+    the old row before the commit cannot cache it again.
+    '''
+    if not enabled():
+        return
+    _forget(chirper_id)
+    transaction.on_commit(lambda: _forget(chirper_id), using=using)
+
+
+def _forget(chirper_id):
+    key = cache().get(owner_key(chirper_id))
+    keys = [owner_key(chirper_id)]
+    if key is not None:
+        keys.append(entry_key(key))
+    cache().delete_many(keys)
+
+
+def counters() -> dict:
+    'Returns the number of session key cache hits and misses in this process.'
+    with _lock:
+        return dict(_counters)
+
+
+metrics.register_collector(lambda: {
+    'chirper_session_cache_hits_total': _counters['hits'],
+    'chirper_session_cache_misses_total': _counters['misses'],
+})
@@ -0,0 +1,181 @@
+'''Spreads chirps over several databases by author.
+
+`settings.CHIRP_SHARDS` lists the database aliases made from
+`CHIRP_SHARD_DATABASE_URLS`. When it is empty, which is the default, every
+chirp lives in the default database and nothing here changes how queries are
+routed.
+
+When it is set, each author's chirps and the `Mention`, `ChirpHashtag` and
+`HashtagMinute` rows of those chirps live in the shard `shard_for` picks for
+the author, and `ShardRouter` sends their writes there. Users, sessions,
+`Hashtag` names and everything else stay in the default database. A user's
+feed mixes chirps from every shard, since anybody can mention them, so
+`ChirperUser.feed` runs its query on each shard and merges the results with a
+`MergedQuerySet`. Tag pages and searches do the same, and trending tags add
+up the counts of every shard.
+
+Timeline entries are not written while chirps are sharded, and feeds are
+always computed live, so `CHIRPER_FEED_SOURCE = 'timeline'` is refused at
+startup, see `app.apps`.
+'''
+import contextvars
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+from django.db.models import prefetch_related_objects
+
+from app import pagination
+
+# Models whose rows live in the shard of the chirp's author.
+SHARDED_MODELS = {
+    'app.chirp', 'app.mention', 'app.chirphashtag', 'app.hashtagminute'
+}
+
+_lock = threading.Lock()
+_executor = None
+
+
+def enabled() -> bool:
+    return bool(settings.CHIRP_SHARDS)
+
+
+def shard_for(chirperuser_id: int) -> str:
+    'Returns the alias of the database that holds the chirps of the `ChirperUser` with `chirperuser_id`.'
+    return settings.CHIRP_SHARDS[jump_hash(chirperuser_id, len(settings.CHIRP_SHARDS))]
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    '''Maps `key` to one of `buckets` buckets with Lamping and Veach's jump consistent hash.
+
+    Going from `n` to `n + 1` buckets only moves keys into the new bucket,
+    about `1 / (n + 1)` of them, so shards can be added to the end of
+    `CHIRP_SHARDS` without moving most chirps. Removing or reordering shards
+    moves nearly everything.
+    '''
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardRouter:
+    '''`ShardRouter` sends the writes of chirps and the rows next to them to their shard.
+
+    A new chirp goes to its author's shard, and a row that was already saved
+    or read stays in the database it came from, so only `rebalance_chirps`
+    moves chirps between shards. Users and other unsharded rows reached
+    through a chirp are read from the default database. Without shards it
+    has no opinion about anything.
+    '''
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if (enabled() and instance is not None and
+                model._meta.label_lower not in SHARDED_MODELS and
+                instance._meta.label_lower in SHARDED_MODELS):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if (not enabled() or instance is None or
+                model._meta.label_lower not in SHARDED_MODELS):
+            return None
+        if instance._meta.label_lower == 'app.chirperuser':
+            return shard_for(instance.pk)
+        if instance._state.db is not None:
+            return instance._state.db
+        if instance._meta.label_lower == 'app.chirp':
+            return shard_for(instance.author_id)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if enabled() and (obj1._meta.label_lower in SHARDED_MODELS or
+                          obj2._meta.label_lower in SHARDED_MODELS):
+            return True
+        return None
+
+
+class MergedQuerySet(pagination.LazyFeed):
+    '''`MergedQuerySet` reads the same newest-first chirp query from several shards as one.
+
+    `querysets` maps each shard's alias to the query to run there, ordered
+    with `pagination.newest_first`. Each shard is asked for no more rows than
+    the slice ends at, the shards are read in parallel, and their rows are
+    merged with a heap until the slice is full. `prefetch` lookups are then
+    loaded for the merged rows only, with `prefetch_related_objects`.
+
+    Unless ids come from `app.snowflake`, chirp ids are only unique within a
+    shard, so two chirps from the same instant on different shards may come
+    in either order.
+    '''
+
+    def __init__(self, querysets: dict, prefetch=(), start=0, stop=None):
+        super().__init__(start, stop)
+        self.querysets = querysets
+        self.prefetch = prefetch
+
+    def copy(self, start, stop) -> 'MergedQuerySet':
+        return MergedQuerySet(self.querysets, self.prefetch, start, stop)
+
+    def count(self) -> int:
+        total = sum(run([queryset.count for queryset in self.querysets.values()]))
+        if self.stop is not None:
+            total = min(total, self.stop)
+        return max(0, total - self.start)
+
+    def fetch(self) -> list:
+        stop = self.stop
+        parts = run([
+            (lambda queryset=queryset: list(
+                queryset if stop is None else queryset[:stop]))
+            for queryset in self.querysets.values()
+        ])
+        chirps = list(
+            itertools.islice(
+                heapq.merge(*parts, key=pagination.sort_key, reverse=True),
+                self.start, stop))
+        if self.prefetch:
+            prefetch_related_objects(chirps, *self.prefetch)
+        return chirps
+
+
+def run(calls: list) -> list:
+    '''Calls each of `calls` on the shard pool and returns their results, in order.
+
+    The calls see the caller's context variables, so their queries count
+    towards the current request's timing. A single call runs on the calling
+    thread.
+    '''
+    if len(calls) == 1:
+        return [calls[0]()]
+    futures = [
+        _pool().submit(contextvars.copy_context().run, in_worker, call)
+        for call in calls
+    ]
+    return [future.result() for future in futures]
+
+
+def in_worker(call):
+    try:
+        return call()
+    finally:
+        # Pool threads are not request threads, so nothing else closes their
+        # connections once they are too old or broken.
+        close_old_connections()
+
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CHIRP_SHARD_WORKERS,
+                thread_name_prefix='chirp-shards')
+        return _executor
@@ -0,0 +1,129 @@
+'''Generates time-ordered 64-bit chirp ids, in the style of Twitter's Snowflake.
+
+By default chirp ids come from the database's sequence, which only makes them
+unique within one database and says nothing about when a chirp was written,
+so feeds sort by `(date, id)`. With `settings.CHIRP_ID_SOURCE = 'snowflake'`
+`Chirp` ids are generated in the process instead, packed as
+
+    41 bits of milliseconds since `EPOCH` | 10 bits of worker id | 12 bits of sequence
+
+They are unique across processes and shards as long as every live process has
+its own worker id, and sorting chirps by id sorts them by the time they were
+written, so feeds, cursors and shard merges use the primary key alone (see
+`pagination.newest_first`).
+
+Chirps written before the switch keep their sequence ids, which are far below
+every generated id and were handed out in date order, so they still sort
+before every newer chirp and no rows need rewriting. Switching back is safe
+too, since feeds then sort by date again.
+
+The worker id is `settings.CHIRP_ID_WORKER` if it is set, which
+`gunicorn.conf.py` does for each worker, and otherwise the process id modulo
+1024.
+'''
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+WORKER_BITS = 10
+
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+_EPOCH_MS = int(EPOCH.timestamp() * 1000)
+
+_lock = threading.Lock()
+_generators = {}
+
+
+class Generator:
+    '''`Generator` hands out ids for one worker id. It is safe to share between threads.
+
+    Ids from `next_id` always increase, even if the clock goes back: the
+    generator keeps using the last millisecond it saw until the clock passes
+    it, and borrows the next millisecond when 4096 ids were made in one.
+    '''
+
+    def __init__(self, worker: int):
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError('Worker ids go from 0 to {}.'.format(MAX_WORKER))
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.last = -1
+        self.sequence = 0
+        self.backfill_sequence = 0
+
+    def next_id(self) -> int:
+        with self.lock:
+            now = int(time.time() * 1000) - _EPOCH_MS
+            if now > self.last:
+                self.last = now
+                self.sequence = 0
+            elif self.sequence < MAX_SEQUENCE:
+                self.sequence += 1
+            else:
+                self.last += 1
+                self.sequence = 0
+            return pack(self.last, self.worker, self.sequence)
+
+    def id_at(self, date: datetime) -> int:
+        '''Returns an id for a chirp written at `date`, for loading old chirps.
+
+        These ids are unique unless more than 4096 of them are made for the
+        same millisecond.
+        '''
+        with self.lock:
+            self.backfill_sequence = (self.backfill_sequence + 1) & MAX_SEQUENCE
+            return pack(
+                int(date.timestamp() * 1000) - _EPOCH_MS, self.worker,
+                self.backfill_sequence)
+
+
+def pack(ms: int, worker: int, sequence: int) -> int:
+    return (ms << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence
+
+
+def unpack(id: int) -> tuple:
+    'Returns the `(datetime, worker, sequence)` an id was made from.'
+    ms = (id >> (WORKER_BITS + SEQUENCE_BITS)) + _EPOCH_MS
+    return (datetime.fromtimestamp(ms / 1000, timezone.utc),
+            (id >> SEQUENCE_BITS) & MAX_WORKER, id & MAX_SEQUENCE)
+
+
+def enabled() -> bool:
+    return settings.CHIRP_ID_SOURCE == 'snowflake'
+
+
+def worker_id() -> int:
+    if settings.CHIRP_ID_WORKER is not None:
+        return settings.CHIRP_ID_WORKER
+    return os.getpid() & MAX_WORKER
+
+
+def generator() -> Generator:
+    '''Returns this process's `Generator`.
+
+    Generators are kept per process id, so a worker forked after ids were
+    made does not continue its parent's sequence.
+    '''
+    pid = os.getpid()
+    with _lock:
+        if pid not in _generators:
+            _generators.clear()
+            _generators[pid] = Generator(worker_id())
+        return _generators[pid]
+
+
+def chirp_id():
+    'The default of `Chirp.id`: a new id, or `None` to let the database pick one.'
+    if not enabled():
+        return None
+    return generator().next_id()
@@ -1,18 +1,70 @@
+import base64
+import datetime
+import copy
+import io
+import itertools
 import json
+import os
+import tempfile
+from unittest import mock
 
+from django.apps import apps
+from django.conf import settings
 from django.contrib import auth
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from django.core.exceptions import ValidationError
+from django.contrib.auth.signals import user_login_failed
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connection, connections, router
 from django.db.utils import IntegrityError
-from django.test import TestCase
+from django.http import HttpResponse
+from django.test import (AsyncRequestFactory, RequestFactory, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from app.models import ChirperUser, Session
+from app import (archive, async_views, feed_cache, hashing, metrics, pagination,
+                 replicas, sharding, snowflake, usernames)
+from app.management.commands import rebuild_search_index
+from app.models import (HASHTAG_MAX_LENGTH, Chirp, ChirperUser, ChirpHashtag,
+                        Hashtag, HashtagMinute, Mention, Session, TimelineEntry,
+                        parse_message, pruned_minutes, trending_tags,
+                        user_searches, username_prefix_q)
 
 
 def identity(x):
     return x
 
 
+# The caches of two worker processes: each its own in-memory cache, or one
+# directory of files they both see.
+
+LOCMEM_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+
+FILE_CACHE_DIR = tempfile.mkdtemp(prefix='chirper-tests-')
+
+PER_PROCESS_CACHES = {
+    'default': {'BACKEND': LOCMEM_CACHE},
+    'worker-a': {'BACKEND': LOCMEM_CACHE, 'LOCATION': 'worker-a'},
+    'worker-b': {'BACKEND': LOCMEM_CACHE, 'LOCATION': 'worker-b'},
+}
+
+SHARED_CACHES = {
+    'default': {'BACKEND': LOCMEM_CACHE},
+    'worker-a': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': FILE_CACHE_DIR,
+    },
+    'worker-b': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': FILE_CACHE_DIR,
+    },
+}
+
+
 class TestModels(TestCase):
     def test_can_sign_up(self):
         chirper = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
@@ -47,11 +99,37 @@ class TestModels(TestCase):
         self.assertEqual(User.objects.count(), 0)
         self.assertEqual(ChirperUser.objects.count(), 0)
 
+    def test_signup_reports_errors_of_both_objects(self):
+        with self.assertNumQueries(0):
+            with self.assertRaises(ValidationError) as caught:
+                ChirperUser.signup('N', 'nate c', 'not an email', 'badpass')
+
+        self.assertEqual(
+            set(caught.exception.message_dict), {'name', 'username', 'email'})
+
+    def test_signup_and_login_queries(self):
+        with self.assertNumQueries(5):
+            chirper = ChirperUser.signup('Nate', 'natec425',
+                                         'foo@example.com', 'badpass')
+            chirper.login()
+
+        self.assertTrue(chirper.is_logged_in())
+
     def test_username_cannot_have_at_sign(self):
         with self.assertRaises(ValidationError):
             ChirperUser.signup('Nate', '@natec425', 'foo@example.com',
                                'badpass')
 
+    def test_signup_without_username(self):
+        with self.assertRaises(ValidationError) as raised:
+            ChirperUser.signup('Nate', None, 'foo@example.com', 'badpass')
+
+        self.assertIn('username', raised.exception.message_dict)
+
+    def test_username_cannot_shadow_a_view(self):
+        with self.assertRaises(ValidationError):
+            ChirperUser.signup('Nate', 'trending', 'foo@example.com', 'badpass')
+
     def test_chirper_user_can_chirp(self):
         chirper = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
                                      'badpass')
@@ -112,6 +190,47 @@ class TestModels(TestCase):
             self.assertTrue(chirper.is_logged_in())
             chirper.logout()
 
+    def test_find_by_key_after_logout_and_relogin(self):
+        chirper = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                     'badpass')
+        chirper.login()
+        old_key = chirper.session.key
+
+        self.assertEqual(ChirperUser.find_by_key(old_key), chirper)
+        with self.assertNumQueries(1):
+            self.assertTrue(ChirperUser.find_by_key(old_key).is_authenticated)
+
+        chirper.login()
+
+        with self.assertRaises(ChirperUser.DoesNotExist):
+            ChirperUser.find_by_key(old_key)
+        self.assertEqual(ChirperUser.find_by_key(chirper.session.key), chirper)
+
+        Session.delete_with_key(chirper.session.key)
+
+        with self.assertRaises(ChirperUser.DoesNotExist):
+            ChirperUser.find_by_key(chirper.session.key)
+
+    def test_find_by_key_after_logout_elsewhere(self):
+        chirper = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                     'badpass')
+        chirper.login()
+        old_key = chirper.session.key
+        ChirperUser.find_by_key(old_key)
+
+        # Another worker only knows the user, not which key is cached.
+        ChirperUser.objects.get(id=chirper.id).login()
+
+        with self.assertRaises(ChirperUser.DoesNotExist):
+            ChirperUser.find_by_key(old_key)
+        new_key = Session.objects.get().key
+        ChirperUser.find_by_key(new_key)
+
+        ChirperUser.objects.get(id=chirper.id).logout()
+
+        with self.assertRaises(ChirperUser.DoesNotExist):
+            ChirperUser.find_by_key(new_key)
+
     def test_chirp_chirping_at(self):
         nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
                                   'badpass')
@@ -129,6 +248,196 @@ class TestModels(TestCase):
         self.assertQuerysetEqual(nate.feed(), [chirp], transform=identity)
 
 
+class TestFeedQueryPlan(TestCase):
+    def setUp(self):
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        not_nate = ChirperUser.signup('Not Nate', 'not_nate',
+                                      'foo@example.com', 'badpass')
+        for i in range(10):
+            self.nate.chirp('Hello {}'.format(i))
+            not_nate.chirp('Hey @natec425 {}'.format(i))
+
+    def test_feed_page_is_read_through_indexes(self):
+        feed = self.nate.feed((timezone.now(), 0), limit=26)
+
+        if connection.vendor == 'sqlite':
+            plan = feed.explain()
+            self.assertIn('app_chirp_author_date_idx', plan)
+            self.assertIn('app_mention_user_date_idx', plan)
+            rows = [line.split(' ', 3) for line in plan.splitlines()]
+            scans = [row for row in rows if row[-1].startswith('SCAN')]
+            self.assertEqual(scans, [])
+            # Each side reads its page in index order. Only the merge sorts,
+            # at most `limit` rows per side.
+            parents = {row[0]: row[1] for row in rows}
+            sides = [row[0] for row in rows if row[-1].startswith('LIST SUBQUERY')]
+            self.assertEqual(len(sides), 2)
+            for side in sides:
+                sorts = [
+                    row for row in rows
+                    if row[-1].startswith('USE TEMP B-TREE')
+                    and self.descends_from(row[0], side, parents)
+                ]
+                self.assertEqual(sorts, [])
+        elif connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = feed.explain()
+            self.assertNotIn('Seq Scan on app_chirp', plan)
+        else:
+            self.skipTest('no query plan expectations for this database')
+
+    def descends_from(self, node, ancestor, parents):
+        while node in parents:
+            node = parents[node]
+            if node == ancestor:
+                return True
+        return False
+
+    def test_feed_union_does_not_repeat_chirps(self):
+        chirp = self.nate.chirp('Talking to myself @natec425')
+
+        self.assertEqual(list(self.nate.feed()).count(chirp), 1)
+        self.assertEqual(self.nate.feed().count(), 21)
+
+
+class TestTimeline(TestCase):
+    def setUp(self):
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        self.not_nate = ChirperUser.signup('Not Nate', 'not_nate',
+                                           'foo@example.com', 'badpass')
+
+    def test_chirp_fills_author_and_mentioned_timelines(self):
+        chirp = self.nate.chirp('Hey @not_nate')
+
+        self.assertQuerysetEqual(
+            self.nate.timeline_feed(), [chirp], transform=identity)
+        self.assertQuerysetEqual(
+            self.not_nate.timeline_feed(), [chirp], transform=identity)
+
+    @override_settings(CHIRPER_FEED_SOURCE='timeline')
+    def test_timeline_feed_matches_live_feed(self):
+        for i in range(5):
+            self.nate.chirp('Hello {}'.format(i))
+            self.not_nate.chirp('Hey @natec425 {}'.format(i))
+        before = (timezone.now(), 0)
+
+        self.assertEqual(
+            list(self.nate.feed(before, limit=6)),
+            list(self.nate.live_feed(before, limit=6)))
+        self.assertEqual(
+            list(self.nate.feed()), list(self.nate.live_feed()))
+
+    def test_backfill_timelines(self):
+        self.nate.chirp('Hey @not_nate')
+        self.nate.chirp('Hello')
+        TimelineEntry.objects.all().delete()
+
+        with self.assertRaises(CommandError):
+            call_command('backfill_timelines', '--verify', stdout=io.StringIO())
+
+        call_command('backfill_timelines', '--batch-size', '1',
+                     stdout=io.StringIO())
+
+        self.assertEqual(TimelineEntry.objects.count(), 3)
+        call_command('backfill_timelines', '--verify', stdout=io.StringIO())
+
+
+class TestFeedCache(TestCase):
+    def setUp(self):
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        self.not_nate = ChirperUser.signup('Not Nate', 'not_nate',
+                                           'foo@example.com', 'badpass')
+
+    def messages(self, username):
+        response = self.client.get('/api/{}/'.format(username))
+        return [c['message'] for c in response.json()['chirps']]
+
+    def test_repeated_reads_are_served_from_cache(self):
+        self.nate.chirp('Hello')
+        self.messages('natec425')
+        before = feed_cache.counters()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.messages('natec425'), ['Hello'])
+
+        after = feed_cache.counters()
+        self.assertEqual(after['hits'], before['hits'] + 1)
+        self.assertEqual(after['misses'], before['misses'])
+
+    def test_chirp_invalidates_author_and_mentioned_feeds(self):
+        self.assertEqual(self.messages('natec425'), [])
+        self.assertEqual(self.messages('not_nate'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.nate.chirp('Hey @not_nate')
+
+        self.assertEqual(self.messages('natec425'), ['Hey @not_nate'])
+        self.assertEqual(self.messages('not_nate'), ['Hey @not_nate'])
+
+    def test_editing_chirp_invalidates_unmentioned_feed(self):
+        chirp = self.nate.chirp('Hey @not_nate')
+        self.assertEqual(self.messages('not_nate'), ['Hey @not_nate'])
+
+        chirp.message = 'Hey nobody'
+        chirp.save()
+
+        self.assertEqual(self.messages('not_nate'), [])
+
+
+@override_settings(CACHES=SHARED_CACHES, USERNAME_FILTER_CACHE_ALIAS='worker-a')
+class TestConditionalGet(TestCase):
+    def setUp(self):
+        caches['worker-a'].clear()
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        self.not_nate = ChirperUser.signup('Not Nate', 'not_nate',
+                                           'foo@example.com', 'badpass')
+        usernames.rebuild()
+
+    def test_unchanged_feed_is_not_modified(self):
+        self.nate.chirp('Hello')
+        etag = self.client.get('/api/natec425/')['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                '/api/natec425/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_feed_etag_changes_with_feed(self):
+        etag = self.client.get('/api/natec425/')['ETag']
+
+        self.not_nate.chirp('Hey @natec425')
+        response = self.client.get('/api/natec425/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_feed_etag_depends_on_page(self):
+        first = self.client.get('/api/natec425/')['ETag']
+        second = self.client.get('/api/natec425/', {'page': 2})['ETag']
+
+        self.assertNotEqual(first, second)
+
+    def test_username_exists_not_modified(self):
+        etag = self.client.get('/api/username_exists/natec425/')['ETag']
+
+        response = self.client.get(
+            '/api/username_exists/natec425/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(
+            '/api/username_exists/nobody/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'exists': False})
+
+
 class TestViews(TestCase):
     def test_successful_signup(self):
         response = self.client.post(
@@ -164,6 +473,19 @@ class TestViews(TestCase):
             }
         })
 
+    def test_missing_username_signup(self):
+        response = self.client.post(
+            '/api/signup/',
+            json.dumps({
+                'name': 'Nate',
+                'email': 'foo@example.com',
+                'password': 'badpass'
+            }),
+            content_type='application/json')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(list(response.json()['errors']), ['username'])
+
     def test_duplicate_username_signup(self):
         chirper = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
                                      'badpass')
@@ -443,3 +765,1218 @@ class TestViews(TestCase):
             content_type='application/json', )
 
         self.assertEqual(response.status_code, 422)
+
+    def test_feed_cursor_pages_through_all_chirps(self):
+        chirper = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                     'badpass')
+        for i in range(30):
+            chirper.chirp('Chirp {}'.format(i))
+
+        response = self.client.get('/api/natec425/', {'before': ''})
+
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json()
+        self.assertEqual(len(first_page['chirps']), 25)
+        self.assertEqual(first_page['chirps'][0]['message'], 'Chirp 29')
+        self.assertIsNotNone(first_page['next_cursor'])
+
+        response = self.client.get('/api/natec425/',
+                                   {'before': first_page['next_cursor']})
+
+        second_page = response.json()
+        self.assertEqual([c['message'] for c in second_page['chirps']],
+                         ['Chirp {}'.format(i) for i in range(4, -1, -1)])
+        self.assertIsNone(second_page['next_cursor'])
+
+    def test_feed_with_invalid_cursor(self):
+        ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+
+        response = self.client.get('/api/natec425/', {'before': 'this'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'INVALID_CURSOR'})
+
+    def test_feed_with_naive_cursor(self):
+        ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+        cursor = base64.urlsafe_b64encode(b'2017-01-01T00:00:00|1').decode()
+
+        response = self.client.get('/api/natec425/', {'before': cursor})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'INVALID_CURSOR'})
+
+    def test_feed_query_budget(self):
+        nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                  'badpass')
+        for i in range(30):
+            chirper = ChirperUser.signup('Not Nate', 'not_nate{}'.format(i),
+                                         'foo@example.com', 'badpass')
+            chirper.chirp('Hey @natec425')
+            nate.chirp('Hey @not_nate{}'.format(i))
+
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/natec425/', {'page': 2})
+        self.assertEqual(len(response.json()['chirps']), 25)
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/natec425/', {'before': ''})
+        self.assertEqual(len(response.json()['chirps']), 25)
+
+    def test_streamed_feed_matches_feed(self):
+        chirper = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                     'badpass')
+        for i in range(30):
+            chirper.chirp('Chirp {}'.format(i))
+
+        for params in [{}, {'page': 2}, {'before': ''}]:
+            response = self.client.get('/api/natec425/', params)
+            streamed = self.client.get('/api/natec425/',
+                                       dict(params, stream='1'))
+
+            self.assertTrue(streamed.streaming)
+            self.assertEqual(
+                json.loads(b''.join(streamed.streaming_content)),
+                response.json())
+
+
+class TestMentions(TestCase):
+    def setUp(self):
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        self.others = [
+            ChirperUser.signup('Not Nate', 'not_nate{}'.format(i),
+                               'foo@example.com', 'badpass') for i in range(3)
+        ]
+
+    def test_mentions_are_written_in_bulk(self):
+        message = ' '.join('@not_nate{}'.format(i) for i in range(3))
+
+        # Savepoint, chirp insert, user lookup, mention insert, timeline
+        # insert, search index insert on SQLite, savepoint release.
+        with self.assertNumQueries(7 if connection.vendor == 'sqlite' else 6):
+            chirp = self.nate.chirp(message + ' @not_nate0 @nobody')
+
+        self.assertEqual(set(chirp.chirping_at.all()), set(self.others))
+
+    def test_resave_without_changes_skips_mentions(self):
+        chirp = self.nate.chirp('Hey @not_nate0')
+        chirp = type(chirp).objects.get(pk=chirp.pk)
+
+        with self.assertNumQueries(3):
+            chirp.save()
+
+    def test_editing_message_updates_mentions(self):
+        chirp = self.nate.chirp('Hey @not_nate0')
+
+        chirp.message = 'Hey @not_nate1'
+        chirp.save()
+
+        self.assertQuerysetEqual(
+            chirp.chirping_at.all(), [self.others[1]], transform=identity)
+        self.assertQuerysetEqual(self.others[0].feed(), [])
+        self.assertQuerysetEqual(self.others[0].timeline_feed(), [])
+        self.assertQuerysetEqual(
+            self.others[1].timeline_feed(), [chirp], transform=identity)
+
+
+@override_settings(CACHES=SHARED_CACHES, SESSION_KEY_CACHE_ALIAS='worker-a')
+class TestAuthentication(TestCase):
+    def setUp(self):
+        caches['worker-a'].clear()
+        self.chirper = ChirperUser.signup('Nate', 'natec425',
+                                          'foo@example.com', 'badpass')
+        self.chirper.login()
+        self.auth = 'Key {}'.format(self.chirper.session.key)
+
+    def test_chirp_with_authorization_header(self):
+        response = self.client.post(
+            '/api/chirp/',
+            json.dumps({
+                'message': 'Hello World'
+            }),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=self.auth)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.chirper.chirp_set.get().message, 'Hello World')
+
+    def test_chirp_with_unknown_key(self):
+        response = self.client.post(
+            '/api/chirp/',
+            json.dumps({
+                'message': 'Hello World'
+            }),
+            content_type='application/json',
+            HTTP_AUTHORIZATION='Key nope')
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_feed_does_not_look_up_session(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                '/api/natec425/', {'before': ''},
+                HTTP_AUTHORIZATION=self.auth)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_logout_with_authorization_header(self):
+        response = self.client.post(
+            '/api/logout/', HTTP_AUTHORIZATION=self.auth)
+
+        self.chirper.refresh_from_db()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.chirper.is_logged_in())
+
+    def logout_in_another_worker(self):
+        key = self.chirper.session.key
+        with self.settings(SESSION_KEY_CACHE_ALIAS='worker-b'):
+            ChirperUser.find_by_key(key)
+
+        self.chirper.logout()
+
+        with self.settings(SESSION_KEY_CACHE_ALIAS='worker-b'):
+            with self.assertRaises(ChirperUser.DoesNotExist):
+                ChirperUser.find_by_key(key)
+
+    def test_logout_in_another_worker(self):
+        self.logout_in_another_worker()
+
+    @override_settings(CACHES=PER_PROCESS_CACHES)
+    def test_logout_in_another_worker_without_a_shared_cache(self):
+        self.logout_in_another_worker()
+
+    def login(self):
+        return self.client.post(
+            '/api/login/',
+            json.dumps({
+                'username': 'natec425',
+                'password': 'badpass'
+            }),
+            content_type='application/json')
+
+    def test_login_rotates_key_in_place(self):
+        old_session = self.chirper.session
+        ChirperUser.find_by_key(old_session.key)
+
+        with self.assertNumQueries(2):
+            response = self.login()
+
+        self.assertEqual(response.status_code, 201)
+        session = Session.objects.get()
+        self.assertEqual(session.id, old_session.id)
+        self.assertEqual(session.key, response.json()['key'])
+        with self.assertRaises(ChirperUser.DoesNotExist):
+            ChirperUser.find_by_key(old_session.key)
+
+    def test_login_upgrades_outdated_password_hash(self):
+        user = self.chirper.user
+        user.password = make_password('badpass', hasher='pbkdf2_sha1')
+        user.save()
+
+        self.assertEqual(self.login().status_code, 201)
+
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+        self.assertTrue(user.check_password('badpass'))
+
+    def test_failed_login_is_signalled(self):
+        handler = mock.Mock()
+        user_login_failed.connect(handler)
+        self.addCleanup(user_login_failed.disconnect, handler)
+
+        response = self.client.post(
+            '/api/login/',
+            json.dumps({
+                'username': 'natec425',
+                'password': 'wrong'
+            }),
+            content_type='application/json')
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(handler.call_args.kwargs['credentials'],
+                         {'username': 'natec425'})
+
+    def test_login_when_hashing_is_busy(self):
+        with mock.patch('app.hashing.run', side_effect=hashing.Busy):
+            response = self.login()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.json(), {'error': 'BUSY'})
+
+
+class TestRequestTiming(TestCase):
+    def setUp(self):
+        ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+
+    @override_settings(REQUEST_TIMING_SAMPLE_RATE=1)
+    def test_sampled_request(self):
+        with self.assertLogs('app.timing', 'INFO') as logs:
+            response = self.client.get('/api/natec425/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['path'], '/api/natec425/')
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['queries'], 2)
+        self.assertIn('SELECT', record['slowest_query'])
+        self.assertGreater(record['serialize_ms'], 0)
+
+    def test_disabled_by_default(self):
+        response = self.client.get('/api/natec425/')
+
+        self.assertNotIn('Server-Timing', response)
+
+
+@override_settings(CHIRPER_METRICS=True, METRICS_TOKEN='secret')
+class TestMetrics(TestCase):
+    def setUp(self):
+        ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+
+    def scrape(self):
+        response = self.client.get(
+            '/api/_metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8')
+
+    def sample(self, text, line_start):
+        for line in text.splitlines():
+            if line.startswith(line_start + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0.0
+
+    def test_requests_and_queries_by_view(self):
+        series = ('chirper_requests_total{method="GET",status="200",'
+                  'view="chirper:feed"}')
+        before = self.sample(self.scrape(), series)
+
+        self.client.get('/api/natec425/')
+        text = self.scrape()
+
+        self.assertEqual(self.sample(text, series), before + 1)
+        self.assertIn(
+            'chirper_request_queries_bucket{view="chirper:feed",le="+Inf"}', text)
+        self.assertIn('# TYPE chirper_request_duration_seconds histogram', text)
+        self.assertIn('chirper_feed_cache_misses_total', text)
+        self.assertIn('chirper_session_cache_hits_total', text)
+
+    def test_chirp_writes(self):
+        before = self.sample(self.scrape(), 'chirper_chirps_written_total')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChirperUser.find_by_username('natec425').chirp_many(['one', 'two'])
+
+        self.assertEqual(
+            self.sample(self.scrape(), 'chirper_chirps_written_total'),
+            before + 2)
+
+    def write_process_file(self, directory, pid, started, written):
+        path = os.path.join(directory, 'metrics-{}-{}.json'.format(pid, started))
+        with open(path, 'w') as f:
+            json.dump({
+                'counters': {
+                    metrics.encode_key(('chirper_chirps_written_total', ())):
+                    written
+                },
+                'histograms': {}
+            }, f)
+        return path
+
+    def test_workers_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            live = self.write_process_file(directory, os.getppid(), 1, 5)
+            before = self.sample(self.scrape(), 'chirper_chirps_written_total')
+
+            with override_settings(METRICS_DIR=directory):
+                text = self.scrape()
+
+            self.assertTrue(os.path.exists(live))
+            own = 'metrics-{}-{}.json'.format(os.getpid(),
+                                              metrics._process['started'])
+            self.assertTrue(os.path.exists(os.path.join(directory, own)))
+        self.assertEqual(
+            self.sample(text, 'chirper_chirps_written_total'), before + 5)
+
+    def test_exited_workers_are_folded_into_a_total(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # An exited process whose id this process now has, and one whose
+            # id nothing has.
+            recycled = self.write_process_file(directory, os.getpid(), 1, 3)
+            with mock.patch.object(metrics, 'is_running', return_value=False):
+                with override_settings(METRICS_DIR=directory):
+                    before = self.sample(
+                        self.scrape(), 'chirper_chirps_written_total')
+            gone = self.write_process_file(directory, 99999999, 1, 4)
+
+            with override_settings(METRICS_DIR=directory):
+                with mock.patch.object(
+                        metrics, 'is_running', side_effect=lambda pid: pid != 99999999):
+                    first = self.sample(
+                        self.scrape(), 'chirper_chirps_written_total')
+                    second = self.sample(
+                        self.scrape(), 'chirper_chirps_written_total')
+
+            self.assertFalse(os.path.exists(recycled))
+            self.assertFalse(os.path.exists(gone))
+            self.assertEqual(
+                [name for name in os.listdir(directory)
+                 if name.startswith('metrics-')],
+                ['metrics-{}-{}.json'.format(os.getpid(),
+                                             metrics._process['started'])])
+        self.assertEqual(first, before + 4)
+        self.assertEqual(second, first)
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/api/_metrics').status_code, 401)
+        self.scrape()
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/api/_metrics').status_code, 404)
+
+
+@override_settings(CACHES=SHARED_CACHES, USERNAME_FILTER_CACHE_ALIAS='worker-a')
+class TestUsernameFilter(TestCase):
+    def setUp(self):
+        caches['worker-a'].clear()
+        ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+        usernames.rebuild()
+
+    def test_missing_username_skips_database(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/username_exists/nobody/')
+
+        self.assertEqual(response.json(), {'exists': False})
+        self.assertIn('max-age=10', response['Cache-Control'])
+
+    def test_existing_username_is_confirmed(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/username_exists/natec425/')
+
+        self.assertEqual(response.json(), {'exists': True})
+
+    def test_signup_adds_username(self):
+        ChirperUser.signup('Not Nate', 'not_nate', 'bar@example.com', 'badpass')
+
+        self.assertTrue(usernames.might_exist('not_nate'))
+        self.assertTrue(ChirperUser.username_exists('not_nate'))
+
+    def test_username_saved_by_another_process(self):
+        # Another process's filter does not have the username, but the cache
+        # it shares with this one does.
+        stale = copy.deepcopy(usernames.usable())
+        ChirperUser.signup('Not Nate', 'not_nate', 'bar@example.com', 'badpass')
+        usernames._state['filter'] = stale
+
+        self.assertNotIn('not_nate', stale)
+        self.assertTrue(ChirperUser.username_exists('not_nate'))
+        self.assertFalse(ChirperUser.username_exists('nobody'))
+
+    @override_settings(CACHES=PER_PROCESS_CACHES)
+    def test_filter_needs_a_shared_cache(self):
+        # Names saved by other processes could not be seen, so the database
+        # is asked.
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/username_exists/nobody/')
+
+        self.assertEqual(response.json(), {'exists': False})
+
+    def test_old_filter_is_not_trusted(self):
+        usernames._state['built'] -= 2 * settings.USERNAME_FILTER_REFRESH
+
+        with mock.patch.object(usernames, 'start_rebuild') as start_rebuild:
+            self.assertTrue(usernames.might_exist('nobody'))
+        start_rebuild.assert_called_once_with()
+
+    def test_missing_filter_is_built_in_background(self):
+        usernames.reset()
+
+        with mock.patch.object(usernames, 'start_rebuild') as start_rebuild:
+            with self.assertNumQueries(0):
+                self.assertTrue(usernames.might_exist('nobody'))
+        start_rebuild.assert_called_once_with()
+
+    def test_bloom_filter(self):
+        bloom = usernames.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('user{}'.format(i))
+
+        self.assertTrue(all('user{}'.format(i) in bloom for i in range(1000)))
+        false_positives = sum('other{}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class TestUserSearch(TestCase):
+    def setUp(self):
+        user_searches.clear()
+        for name, username in [('Nate', 'natec425'), ('Nathan', 'Nathan'),
+                               ('Not Nate', 'not_nate'), ('Ann', 'ann_nat')]:
+            ChirperUser.signup(name, username, 'foo@example.com', 'badpass')
+
+    def search(self, **params):
+        return self.client.get('/api/users/search', params)
+
+    def test_prefix_search(self):
+        response = self.search(prefix='@NAT')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'users': [{
+                'username': 'natec425',
+                'name': 'Nate'
+            }, {
+                'username': 'Nathan',
+                'name': 'Nathan'
+            }]
+        })
+        self.assertEqual(
+            [u['username'] for u in self.search(prefix='n', limit=2).json()['users']],
+            ['natec425', 'Nathan'])
+
+    def test_repeated_prefix_is_served_from_memory(self):
+        with self.assertNumQueries(1):
+            self.search(prefix='na')
+        with self.assertNumQueries(0):
+            self.search(prefix='na')
+
+    def test_renamed_user_is_found_by_new_name(self):
+        user = User.objects.get(username='ann_nat')
+        user.username = 'zed'
+        user.save()
+
+        self.assertEqual(
+            self.search(prefix='ZE').json()['users'],
+            [{'username': 'zed', 'name': 'Ann'}])
+
+    def test_bad_search(self):
+        self.assertEqual(self.search().status_code, 422)
+        self.assertEqual(self.search(prefix='@').status_code, 422)
+        self.assertEqual(self.search(prefix='n', limit='x').status_code, 422)
+        self.assertEqual(self.search(prefix='n', limit=51).status_code, 422)
+
+    def test_search_uses_index(self):
+        query = ChirperUser.objects.filter(username_prefix_q('na')).order_by(
+            'username_folded').values_list('user__username', 'name')[:10]
+
+        if connection.vendor == 'sqlite':
+            plan = query.explain()
+            self.assertIn('app_chirperuser_username_folded', plan)
+            self.assertNotIn('USE TEMP B-TREE', plan)
+
+
+class TestChirpSearch(TestCase):
+    def setUp(self):
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        self.nate.chirp('Deploying the new release today')
+        self.nate.chirp_many(['Lunch first', 'The release went out'])
+        self.nate.chirp('Coffee before the RELEASE')
+
+    def search(self, **params):
+        return self.client.get('/api/search/chirps', params)
+
+    def messages(self, response):
+        return [c['message'] for c in response.json()['chirps']]
+
+    def test_search(self):
+        response = self.search(q='release')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.messages(response), [
+            'Coffee before the RELEASE', 'The release went out',
+            'Deploying the new release today'
+        ])
+        self.assertIsNone(response.json()['next_cursor'])
+        self.assertEqual(
+            self.messages(self.search(q='(new" release')),
+            ['Deploying the new release today'])
+
+    def test_edited_chirp_is_reindexed(self):
+        chirp = Chirp.objects.get(message='Lunch first')
+        chirp.message = 'Lunch after the release'
+        chirp.save()
+
+        self.assertIn('Lunch after the release',
+                      self.messages(self.search(q='release')))
+        self.assertEqual(self.messages(self.search(q='lunch')),
+                         ['Lunch after the release'])
+        self.assertEqual(self.messages(self.search(q='first')), [])
+
+    def test_pages(self):
+        chirps, cursor = pagination.keyset_page(Chirp.search('release'), 2)
+        rest, _ = pagination.keyset_page(
+            Chirp.search('release', pagination.decode_cursor(cursor)), 2)
+
+        self.assertEqual([c.message for c in chirps + rest], [
+            'Coffee before the RELEASE', 'The release went out',
+            'Deploying the new release today'
+        ])
+
+    def test_bad_search(self):
+        self.assertEqual(self.search().status_code, 422)
+        self.assertEqual(self.search(q='!!').status_code, 422)
+        self.assertEqual(
+            self.search(q='release', before='nope').status_code, 400)
+
+    def test_rebuild_search_index(self):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM app_chirp_fts')
+
+        call_command('rebuild_search_index', batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual(len(self.messages(self.search(q='release'))), 3)
+
+    def test_search_during_rebuild(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Only the SQLite index is rebuilt into a new table.')
+        fill = rebuild_search_index.Command.fill
+
+        def fill_while_writing(command, db, batch_size):
+            self.assertEqual(len(self.messages(self.search(q='release'))), 3)
+            self.nate.chirp('Another release')
+            seen = fill(command, db, batch_size)
+            lunch = Chirp.objects.get(message='Lunch first')
+            lunch.message = 'Lunch after the release'
+            lunch.save()
+            return seen
+
+        with mock.patch.object(rebuild_search_index.Command, 'fill',
+                               fill_while_writing):
+            call_command('rebuild_search_index', batch_size=2,
+                         stdout=io.StringIO())
+
+        self.assertEqual(len(self.messages(self.search(q='release'))), 5)
+        self.assertEqual(len(self.messages(self.search(q='lunch'))), 1)
+
+
+class TestHashtags(TestCase):
+    def setUp(self):
+        trending_tags.clear()
+        pruned_minutes.clear()
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+
+    def tag_page(self, tag, **params):
+        return self.client.get('/api/tags/{}/'.format(tag), params)
+
+    def test_parse_message(self):
+        self.assertEqual(
+            parse_message('Hi @nate #Django! #django #python3 # @not_nate'),
+            (['nate', 'not_nate'], ['django', 'python3']))
+
+    def test_parse_message_limits_folded_tags(self):
+        # 'ß' folds to 'ss', one character longer.
+        fits = 'ß' * (HASHTAG_MAX_LENGTH // 2)
+        too_long = 'ß' * (HASHTAG_MAX_LENGTH // 2 + 1)
+
+        self.assertEqual(parse_message('#{} #{}'.format(fits, too_long)),
+                         ([], ['ss' * (HASHTAG_MAX_LENGTH // 2)]))
+
+    def test_tag_page(self):
+        self.nate.chirp('Hello #Django')
+        self.nate.chirp_many(['Nothing here', 'More #django #python'])
+
+        response = self.tag_page('DJANGO')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [c['message'] for c in response.json()['chirps']],
+            ['More #django #python', 'Hello #Django'])
+        self.assertIsNone(response.json()['next_cursor'])
+
+    def test_tag_pages_use_keyset_pagination(self):
+        self.nate.chirp_many(['#busy {}'.format(i) for i in range(30)])
+
+        first = self.tag_page('busy').json()
+        second = self.tag_page('busy', before=first['next_cursor']).json()
+
+        self.assertEqual(len(first['chirps']), 25)
+        self.assertEqual([c['message'] for c in second['chirps']],
+                         ['#busy {}'.format(i) for i in range(4, -1, -1)])
+        self.assertIsNone(second['next_cursor'])
+        if connection.vendor == 'sqlite':
+            plan = Hashtag.chirps('busy')[:26].explain()
+            self.assertIn('app_chirphashtag_date_idx', plan)
+            self.assertNotIn('USE TEMP B-TREE', plan)
+
+    def test_edited_chirp_leaves_tag(self):
+        chirp = self.nate.chirp('Hello #django')
+        chirp.message = 'Hello #python'
+        chirp.save()
+
+        self.assertEqual(self.tag_page('django').json()['chirps'], [])
+        self.assertEqual(len(self.tag_page('python').json()['chirps']), 1)
+
+    def test_trending(self):
+        self.nate.chirp_many(['#django', '#python #django', '#django'])
+        self.nate.chirp('#python')
+        old = Chirp.objects.create(author=self.nate, message='#mondays')
+        HashtagMinute.objects.filter(hashtag__name='mondays').update(
+            minute=timezone.now() - datetime.timedelta(hours=2))
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/trending/')
+        with self.assertNumQueries(0):
+            self.client.get('/api/trending/')
+
+        self.assertEqual(response.json(), {
+            'tags': [{
+                'tag': 'django',
+                'count': 3
+            }, {
+                'tag': 'python',
+                'count': 2
+            }]
+        })
+        self.assertTrue(
+            HashtagMinute.objects.filter(hashtag__name='mondays').exists())
+
+        pruned_minutes.clear()
+        self.nate.chirp('#python')
+
+        self.assertFalse(
+            HashtagMinute.objects.filter(hashtag__name='mondays').exists())
+        self.assertEqual(old.chirphashtag_set.count(), 1)
+
+    def test_edits_count_changed_tags_only(self):
+        chirp = self.nate.chirp('Hello #django')
+        chirp.message = 'Hello #django #python'
+        chirp.save()
+        chirp.message = 'Hi #django #python'
+        chirp.save()
+
+        self.assertEqual(Hashtag.trending(10), [('django', 1), ('python', 1)])
+
+        chirp.message = 'Hi #python'
+        chirp.save()
+        trending_tags.clear()
+
+        self.assertEqual(Hashtag.trending(10), [('python', 1)])
+
+
+class TestReplicas(TestCase):
+    def setUp(self):
+        feed_cache.cache().clear()
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+
+    def test_reads_in_replica_views_use_a_replica(self):
+        seen = []
+
+        @replicas.replica_reads
+        def view(request):
+            seen.append((router.db_for_read(Chirp), router.db_for_write(Chirp)))
+            replicas.read_from_primary()
+            seen.append((router.db_for_read(Chirp), router.db_for_write(Chirp)))
+            return HttpResponse()
+
+        with override_settings(REPLICA_DATABASES=['replica0']):
+            view(RequestFactory().get('/'))
+
+        self.assertEqual(seen, [('replica0', 'default'), ('default', 'default')])
+        self.assertEqual(router.db_for_read(Chirp), 'default')
+
+    @override_settings(REPLICA_DATABASES=['default'], REPLICA_PIN_SECONDS=5)
+    def test_written_feeds_are_read_from_the_primary(self):
+        with mock.patch('app.replicas.read_from_primary') as read_from_primary:
+            self.client.get('/api/natec425/')
+            self.assertFalse(read_from_primary.called)
+
+            self.nate.chirp('Hello')
+            self.client.get('/api/natec425/')
+            self.assertEqual(read_from_primary.call_count, 1)
+
+    @override_settings(REPLICA_DATABASES=['default'])
+    def test_new_users_are_read_from_the_primary(self):
+        # The replica has not seen the new user yet.
+        find_feed_owner = mock.Mock(side_effect=[
+            ChirperUser.DoesNotExist,
+            ChirperUser.feed_owners().get(id=self.nate.id)
+        ])
+        with mock.patch.object(ChirperUser, 'find_feed_owner', find_feed_owner):
+            self.assertEqual(self.client.get('/api/natec425/').status_code, 200)
+
+        find_feed_owner = mock.Mock(side_effect=ChirperUser.DoesNotExist)
+        with mock.patch.object(ChirperUser, 'find_feed_owner', find_feed_owner):
+            self.assertEqual(self.client.get('/api/nobody/').status_code, 404)
+        self.assertEqual(find_feed_owner.call_count, 1)
+
+    @override_settings(REPLICA_DATABASES=['default'])
+    def test_new_usernames_are_checked_on_the_primary(self):
+        with mock.patch('app.replicas.read_from_primary') as read_from_primary:
+            self.client.get('/api/username_exists/nobody/')
+            self.assertFalse(read_from_primary.called)
+
+            response = self.client.get('/api/username_exists/natec425/')
+            self.assertEqual(read_from_primary.call_count, 1)
+        self.assertEqual(response.json(), {'exists': True})
+
+    @override_settings(REPLICA_DATABASES=['replica0'])
+    def test_replicas_need_shared_caches(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, 'FEED_CACHE_ALIAS'):
+            apps.get_app_config('app').ready()
+        with override_settings(CACHES=SHARED_CACHES,
+                               FEED_CACHE_ALIAS='worker-a'):
+            with self.assertRaisesMessage(ImproperlyConfigured,
+                                          'USERNAME_FILTER_CACHE_ALIAS'):
+                apps.get_app_config('app').ready()
+            with override_settings(USERNAME_FILTER_CACHE_ALIAS='worker-b'):
+                apps.get_app_config('app').ready()
+
+    def test_no_pins_without_replicas(self):
+        self.nate.chirp('Hello')
+
+        self.assertFalse(feed_cache.written_recently(self.nate.id))
+
+
+class TestSnowflake(TestCase):
+    def setUp(self):
+        snowflake._generators.clear()
+        self.addCleanup(snowflake._generators.clear)
+
+    def test_ids_increase_even_if_the_clock_goes_back(self):
+        now = snowflake.EPOCH.timestamp() + 100
+        generator = snowflake.Generator(5)
+        with mock.patch('app.snowflake.time.time',
+                        side_effect=[now, now, now - 1, now + 1]):
+            ids = [generator.next_id() for _ in range(4)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        date, worker, sequence = snowflake.unpack(ids[2])
+        self.assertEqual((date.timestamp(), worker, sequence), (now, 5, 2))
+
+    def test_a_full_millisecond_borrows_the_next_one(self):
+        now = snowflake.EPOCH.timestamp() + 100
+        generator = snowflake.Generator(0)
+        with mock.patch('app.snowflake.time.time', return_value=now):
+            ids = [generator.next_id() for _ in range(snowflake.MAX_SEQUENCE + 2)]
+
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertAlmostEqual(
+            snowflake.unpack(ids[-1])[0].timestamp(), now + 0.001)
+
+    def test_worker_ids_are_checked(self):
+        with self.assertRaises(ValueError):
+            snowflake.Generator(snowflake.MAX_WORKER + 1)
+
+    def test_chirps_get_database_ids_by_default(self):
+        nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+
+        self.assertLess(nate.chirp('hi').id, 1 << 22)
+
+    @override_settings(CHIRP_ID_SOURCE='snowflake', CHIRP_ID_WORKER=7)
+    def test_feed_is_ordered_by_snowflake_id(self):
+        nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+        first = nate.chirp('first')
+        second, third = nate.chirp_many(['second', 'third'])
+        # Ids decide the order, even if the dates disagree.
+        Chirp.objects.filter(id=first.id).update(date=timezone.now())
+
+        self.assertEqual(snowflake.unpack(first.id)[1], 7)
+        self.assertEqual([c.id for c in nate.feed()],
+                         [third.id, second.id, first.id])
+        response = self.client.get('/api/natec425/', {'before': ''})
+        self.assertEqual(
+            [c['message'] for c in response.json()['chirps']],
+            ['third', 'second', 'first'])
+        self.assertEqual(
+            [c.id for c in nate.feed((third.date, third.id), limit=1)],
+            [second.id])
+
+    @override_settings(CHIRP_ID_SOURCE='snowflake')
+    def test_chirp_many_does_not_look_up_snowflake_ids(self):
+        nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com', 'badpass')
+        with CaptureQueriesContext(connection) as one:
+            nate.chirp_many(['hi'])
+        with CaptureQueriesContext(connection) as twenty:
+            nate.chirp_many(['hi {}'.format(i) for i in range(20)])
+
+        self.assertEqual(len(twenty), len(one))
+
+    @override_settings(CHIRP_ID_SOURCE='snowflake')
+    def test_seed_data_ids_follow_dates(self):
+        call_command('seed_data', users=5, chirps=50, stdout=io.StringIO())
+
+        ids = list(Chirp.objects.order_by('date').values_list('id', flat=True))
+        self.assertEqual(ids, sorted(ids))
+        self.assertGreater(ids[0], 1 << 22)
+
+
+@override_settings(CHIRP_SHARDS=['default', 'shard1'])
+class TestSharding(TransactionTestCase):
+    '''Shards chirps over the test database and a second SQLite database, `shard1`.
+
+    `shard1` is only added to the connections in `setUpClass`, after the test
+    runner has set up the databases, so it is picked up through `__all__`.
+    '''
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shard_dir = tempfile.TemporaryDirectory()
+        connections.settings['shard1'] = dict(
+            connections.settings['default'],
+            ENGINE='django.db.backends.sqlite3',
+            NAME=os.path.join(cls.shard_dir.name, 'shard1.sqlite3'))
+        call_command('migrate', database='shard1', verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['shard1'].close()
+        del connections['shard1']
+        del connections.settings['shard1']
+        cls.shard_dir.cleanup()
+
+    def setUp(self):
+        home = {}
+        for i in range(10):
+            user = User.objects.create(username='user{}'.format(i))
+            chirper = ChirperUser.objects.create(user=user, name='User {}'.format(i))
+            home.setdefault(sharding.shard_for(chirper.id), chirper)
+        self.nate = home['default']
+        self.zoe = home['shard1']
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        for key in range(1000):
+            self.assertIn(
+                sharding.jump_hash(key, 3), [sharding.jump_hash(key, 2), 2])
+
+    def test_chirps_are_written_to_their_author_shard(self):
+        chirp = self.zoe.chirp('hi @{}'.format(self.nate.username))
+        self.nate.chirp_many(['hello @{}'.format(self.zoe.username), 'again'])
+
+        self.assertEqual(chirp._state.db, 'shard1')
+        self.assertTrue(
+            Mention.objects.using('shard1').filter(
+                chirp=chirp, chirperuser=self.nate).exists())
+        self.assertEqual(
+            Chirp.objects.using('default').filter(author=self.nate).count(), 2)
+        self.assertFalse(
+            Chirp.objects.using('default').filter(author=self.zoe).exists())
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_feed_merges_every_shard(self):
+        self.zoe.chirp('first @{}'.format(self.nate.username))
+        second = self.nate.chirp('second')
+        self.zoe.chirp('third @{}'.format(self.nate.username))
+        self.zoe.chirp('not for nate')
+
+        feed = self.nate.feed()
+        self.assertEqual(feed.count(), 3)
+        self.assertEqual([(c.message.split()[0], c.author.username) for c in feed],
+                         [('third', self.zoe.username),
+                          ('second', self.nate.username),
+                          ('first', self.zoe.username)])
+        self.assertEqual(len(self.nate.feed(limit=2)), 2)
+        self.assertEqual(
+            [c.message for c in self.nate.feed((second.date, second.id), 1)],
+            ['first @{}'.format(self.nate.username)])
+
+        response = self.client.get('/api/{}/'.format(self.nate.username),
+                                   {'before': ''})
+        self.assertEqual(len(response.json()['chirps']), 3)
+        self.assertIsNone(response.json()['next_cursor'])
+
+    def test_search_merges_every_shard(self):
+        self.zoe.chirp('coffee time')
+        self.nate.chirp('more coffee')
+
+        self.assertEqual([c.message for c in Chirp.search('coffee')],
+                         ['more coffee', 'coffee time'])
+
+    def test_hashtags_are_sharded_with_their_chirps(self):
+        trending_tags.clear()
+        zoes = self.zoe.chirp('#coffee time')
+        self.nate.chirp_many(['more #coffee', '#tea'])
+
+        self.assertTrue(
+            ChirpHashtag.objects.using('shard1').filter(chirp=zoes).exists())
+        self.assertEqual([c.message for c in Hashtag.chirps('Coffee')],
+                         ['more #coffee', '#coffee time'])
+        self.assertEqual(Hashtag.trending(1), [('coffee', 2)])
+
+        zoes.message = 'tea time #tea'
+        zoes.save()
+        trending_tags.clear()
+
+        self.assertEqual([c.message for c in Hashtag.chirps('tea')],
+                         ['#tea', 'tea time #tea'])
+        self.assertEqual(Hashtag.trending(10), [('tea', 2), ('coffee', 1)])
+
+    @override_settings(CACHES=SHARED_CACHES, FEED_CACHE_ALIAS='worker-a')
+    def test_timeline_feeds_are_refused(self):
+        apps.get_app_config('app').ready()
+        with override_settings(CHIRPER_FEED_SOURCE='timeline'):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'timeline'):
+                apps.get_app_config('app').ready()
+        with self.assertRaises(CommandError):
+            call_command('backfill_timelines', stdout=io.StringIO())
+
+    def test_shards_need_a_shared_feed_cache(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, 'FEED_CACHE_ALIAS'):
+            apps.get_app_config('app').ready()
+
+    def test_rebalance_moves_chirps_to_their_shard(self):
+        with override_settings(CHIRP_SHARDS=[]):
+            self.zoe.chirp('hi @{} #hello'.format(self.nate.username))
+        out = io.StringIO()
+
+        call_command('rebalance_chirps', stdout=out)
+
+        self.assertIn('Moved 1 chirps.', out.getvalue())
+        self.assertFalse(Chirp.objects.using('default').exists())
+        self.assertFalse(TimelineEntry.objects.exists())
+        moved = Chirp.objects.using('shard1').get()
+        self.assertEqual(moved.author_id, self.zoe.id)
+        self.assertTrue(
+            Mention.objects.using('shard1').filter(
+                chirp=moved, chirperuser=self.nate).exists())
+        self.assertEqual([c.id for c in self.nate.feed()], [moved.id])
+        self.assertEqual([c.id for c in Chirp.search('hi')], [moved.id])
+        self.assertEqual([c.id for c in Hashtag.chirps('hello')], [moved.id])
+
+    @override_settings(CHIRP_ID_SOURCE='snowflake')
+    def test_rebalance_keeps_snowflake_ids(self):
+        with override_settings(CHIRP_SHARDS=[]):
+            chirp = self.zoe.chirp('hi')
+
+        call_command('rebalance_chirps', stdout=io.StringIO())
+
+        self.assertEqual(Chirp.objects.using('shard1').get().id, chirp.id)
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_settings = override_settings(CHIRP_ARCHIVE_DIR=directory.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        self.zoe = ChirperUser.signup('Zoe', 'zoe', 'zoe@example.com', 'badpass')
+
+    def chirp_old(self, chirper, message, days):
+        chirp = chirper.chirp(message)
+        Chirp.objects.filter(id=chirp.id).update(
+            date=timezone.now() - datetime.timedelta(days=days))
+        return chirp
+
+    def test_feed_continues_into_archive(self):
+        for i in range(30):
+            self.chirp_old(self.nate, 'Old {}'.format(i), 400 - i)
+        self.chirp_old(self.zoe, 'Old hi @natec425', 380)
+        for i in range(5):
+            self.nate.chirp('New {}'.format(i))
+        before = [(c.id, c.message, c.author.name) for c in self.nate.feed()]
+        out = io.StringIO()
+
+        call_command('archive_chirps', stdout=out)
+
+        self.assertIn('Archived 31 chirps', out.getvalue())
+        self.assertEqual(Chirp.objects.count(), 5)
+        self.assertFalse(Mention.objects.exists())
+        self.assertEqual(
+            [(c.id, c.message, c.author.name) for c in self.nate.feed()], before)
+        with override_settings(CHIRPER_FEED_SOURCE='timeline'):
+            self.assertEqual([c.id for c in self.nate.feed()],
+                             [id for id, _, _ in before])
+        self.assertEqual([c.message for c in self.zoe.feed()], ['Old hi @natec425'])
+
+        messages, cursor = [], ''
+        while cursor is not None:
+            page = self.client.get('/api/natec425/', {'before': cursor}).json()
+            messages += [c['message'] for c in page['chirps']]
+            cursor = page['next_cursor']
+        self.assertEqual(messages, [message for _, message, _ in before])
+        page = self.client.get('/api/natec425/', {'page': 2}).json()
+        self.assertEqual([c['message'] for c in page['chirps']],
+                         [message for _, message, _ in before[25:]])
+
+    def test_archived_chirps_of_deleted_users_are_left_out(self):
+        self.chirp_old(self.zoe, 'Old hi @natec425', 390)
+        self.chirp_old(self.nate, 'Old', 380)
+        call_command('archive_chirps', stdout=io.StringIO())
+        User.objects.filter(username='zoe').delete()
+
+        self.assertEqual([c.message for c in self.nate.feed()], ['Old'])
+        response = self.client.get('/api/natec425/', {'before': ''})
+        self.assertEqual([c['message'] for c in response.json()['chirps']],
+                         ['Old'])
+        self.assertEqual([c.message for c in self.nate.feed(limit=1)], ['Old'])
+
+    def test_dry_run_archives_nothing(self):
+        self.chirp_old(self.nate, 'Old', 400)
+        out = io.StringIO()
+
+        call_command('archive_chirps', '--dry-run', stdout=out)
+
+        self.assertIn('Would archive 1 chirps', out.getvalue())
+        self.assertEqual(Chirp.objects.count(), 1)
+        self.assertEqual(archive.segments(), [])
+
+    def test_archive_requires_a_directory(self):
+        with override_settings(CHIRP_ARCHIVE_DIR=None):
+            with self.assertRaises(CommandError):
+                call_command('archive_chirps', stdout=io.StringIO())
+
+    def test_records_merge_segments_and_skip_blocks(self):
+        start = timezone.now() - datetime.timedelta(days=100)
+
+        def chirps(ids):
+            return [(id, start + datetime.timedelta(seconds=id), 1, str(id))
+                    for id in ids]
+
+        with mock.patch.object(archive, 'BLOCK_SIZE', 2):
+            archive.write_segment(chirps(range(0, 10)), [(3, 2), (4, 2)])
+            archive.write_segment(chirps(range(10, 20)), [])
+        cursor = (start + datetime.timedelta(seconds=14), 14)
+
+        with mock.patch.object(archive.zlib, 'decompress',
+                               wraps=archive.zlib.decompress) as decompress:
+            first = list(itertools.islice(archive.records(1, cursor), 3))
+
+        self.assertEqual([id for id, *_ in first], [13, 12, 11])
+        self.assertEqual(decompress.call_count, 2)
+        self.assertEqual(
+            [id for id, *_ in archive.records(1)], list(range(19, -1, -1)))
+        self.assertEqual([id for id, *_ in archive.records(2)], [4, 3])
+        self.assertEqual(archive.count(1), 20)
+        self.assertEqual(archive.count(1, cursor), 14)
+        self.assertEqual(first[0][3], start + datetime.timedelta(seconds=13))
+
+    def test_corrupt_segment(self):
+        path = archive.write_segment(
+            [(1, timezone.now(), self.nate.id, 'Hi')], [])
+        with open(path, 'r+b') as f:
+            f.truncate(20)
+
+        with self.assertRaises(archive.CorruptSegment):
+            archive.Segment(path)
+
+
+class TestBulkChirp(TestCase):
+    def setUp(self):
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        self.not_nate = ChirperUser.signup('Not Nate', 'not_nate',
+                                           'foo@example.com', 'badpass')
+        self.nate.login()
+        self.auth = 'Key {}'.format(self.nate.session.key)
+
+    def post(self, payload, **extra):
+        return self.client.post(
+            '/api/chirps/bulk/',
+            json.dumps(payload),
+            content_type='application/json',
+            **extra)
+
+    def test_bulk_chirp(self):
+        messages = ['Hey @not_nate', 'Hello', 'x' * 300, 'Bye @not_nate']
+
+        response = self.post({'messages': messages}, HTTP_AUTHORIZATION=self.auth)
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], [201, 201, 422, 201])
+        self.assertIn('message', results[2]['errors'])
+        self.assertEqual(
+            [c.message for c in self.nate.feed()],
+            ['Bye @not_nate', 'Hello', 'Hey @not_nate'])
+        self.assertEqual(
+            [c.message for c in self.not_nate.timeline_feed()],
+            ['Bye @not_nate', 'Hey @not_nate'])
+
+    def test_bulk_chirp_query_count(self):
+        messages = ['Hey @not_nate {}'.format(i) for i in range(20)]
+
+        # Session lookup, savepoint, chirp insert, mention lookup, mention
+        # insert, timeline insert, search index insert on SQLite, savepoint
+        # release.
+        with self.assertNumQueries(8 if connection.vendor == 'sqlite' else 7):
+            self.post({'messages': messages}, HTTP_AUTHORIZATION=self.auth)
+
+        self.assertEqual(self.not_nate.chirping_at_set.count(), 20)
+
+    def test_bulk_chirp_requires_login(self):
+        response = self.post({'messages': ['Hello']})
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_bulk_chirp_without_messages(self):
+        response = self.post({}, HTTP_AUTHORIZATION=self.auth)
+
+        self.assertEqual(response.status_code, 422)
+
+
+@override_settings(CACHES=SHARED_CACHES, USERNAME_FILTER_CACHE_ALIAS='worker-a')
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        caches['worker-a'].clear()
+        self.nate = ChirperUser.signup('Nate', 'natec425', 'foo@example.com',
+                                       'badpass')
+        for i in range(30):
+            self.nate.chirp('Chirp {}'.format(i))
+        usernames.rebuild()
+        self.factory = AsyncRequestFactory()
+
+    async def test_async_feed_matches_feed(self):
+        for params in [{}, {'page': 2}, {'page': 9}, {'before': ''}]:
+            request = self.factory.get('/api/natec425/', params)
+            response = await async_views.feed(request, 'natec425')
+            expected = await self.async_client.get('/api/natec425/', params)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), expected.json())
+
+    async def test_async_feed_uses_async_cache_calls(self):
+        expected = await self.async_client.get('/api/natec425/', {'page': 2})
+        blocking = mock.Mock(side_effect=AssertionError('blocking cache call'))
+
+        with mock.patch.multiple(feed_cache, version=blocking,
+                                 get_page=blocking, set_page=blocking):
+            for _ in range(2):
+                response = await async_views.feed(
+                    self.factory.get('/api/natec425/', {'page': 2}), 'natec425')
+                self.assertEqual(json.loads(response.content), expected.json())
+
+    async def test_async_feed_for_unknown_user_404s(self):
+        request = self.factory.get('/api/nobody/')
+        response = await async_views.feed(request, 'nobody')
+
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_username_exists(self):
+        request = self.factory.get('/api/username_exists/natec425/')
+        response = await async_views.username_exists(request, 'natec425')
+
+        self.assertEqual(json.loads(response.content), {'exists': True})
+
+
+class TestBenchmarkCommands(TransactionTestCase):
+    def test_seed_data(self):
+        call_command(
+            'seed_data', users=20, chirps=200, batch_size=64, stdout=io.StringIO())
+
+        self.assertEqual(ChirperUser.objects.count(), 20)
+        self.assertEqual(Chirp.objects.count(), 200)
+        self.assertTrue(Mention.objects.exists())
+        dates = list(Chirp.objects.order_by('id').values_list('date', flat=True))
+        self.assertEqual(dates, sorted(dates))
+        self.assertGreater(dates[-1] - dates[0], datetime.timedelta(days=300))
+        call_command('backfill_timelines', verify=True, stdout=io.StringIO())
+
+    def test_loadtest(self):
+        call_command('seed_data', users=10, chirps=50, stdout=io.StringIO())
+        out = io.StringIO()
+
+        call_command('loadtest', clients=1, requests=40, stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['requests'], 40)
+        self.assertEqual(report['operations']['signup']['errors'], 0)
+        self.assertEqual(report['operations']['signup']['queries_max'], 5)
@@ -0,0 +1,135 @@
+'''Measures where the time of a request goes.
+
+`app.middleware.record_metrics` starts a `RequestTiming` for every request,
+and `app.middleware.request_timing` for a sample of them. While one is
+current, every query on every database connection and every call to
+`app.serializers.dumps` is added to it. Work done outside of a request pays
+for one context variable lookup per query.
+'''
+import contextvars
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+_current = contextvars.ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    '`RequestTiming` holds the measurements of one request. Times are in seconds.'
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = None
+        self.serialize = 0.0
+
+    def add_query(self, sql, elapsed):
+        self.queries += 1
+        self.db += elapsed
+        if elapsed >= self.slowest:
+            self.slowest = elapsed
+            self.slowest_sql = sql
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total) -> str:
+        '''Returns the value of a `Server-Timing` header for these measurements.
+
+        The SQL of the slowest query is left out, since the header is sent to
+        clients.
+        '''
+        return ', '.join([
+            'db;dur={:.2f};desc="{} queries"'.format(ms(self.db), self.queries),
+            'db-slowest;dur={:.2f}'.format(ms(self.slowest)),
+            'serialize;dur={:.2f}'.format(ms(self.serialize)),
+            'total;dur={:.2f}'.format(ms(total)),
+        ])
+
+    def record(self, total) -> dict:
+        return {
+            'total_ms': round(ms(total), 2),
+            'queries': self.queries,
+            'db_ms': round(ms(self.db), 2),
+            'slowest_query_ms': round(ms(self.slowest), 2),
+            'slowest_query': self.slowest_sql,
+            'serialize_ms': round(ms(self.serialize), 2),
+        }
+
+
+def ms(seconds):
+    return seconds * 1000
+
+
+def current():
+    'Returns the `RequestTiming` of the request being handled, or `None`.'
+    return _current.get()
+
+
+@contextmanager
+def timing():
+    '''Makes a new `RequestTiming` current for the duration of the block.
+
+    If one is already current it is reused, so middleware that measures every
+    request and middleware that reports a sample of them see the same numbers.
+    The context variable is copied into threads started by `sync_to_async`, so
+    async views are measured too.
+    '''
+    measurements = _current.get()
+    if measurements is not None:
+        yield measurements
+        return
+    measurements = RequestTiming()
+    token = _current.set(measurements)
+    try:
+        yield measurements
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def serializing():
+    'Adds the time spent in the block to the current `RequestTiming`, if any.'
+    measurements = _current.get()
+    if measurements is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        measurements.serialize += time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    measurements = _current.get()
+    if measurements is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        measurements.add_query(sql, time.perf_counter() - start)
+
+
+def install():
+    '''Adds `record_query` to the current thread's connections and every new one.
+
+    It is safe to call more than once.
+    '''
+    for connection in connections.all():
+        add_wrapper(connection)
+    connection_created.connect(add_wrapper_on_connect, dispatch_uid=__name__)
+
+
+def add_wrapper(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+def add_wrapper_on_connect(sender, connection, **kwargs):
+    add_wrapper(connection)
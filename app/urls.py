@@ -1,6 +1,12 @@
+from django.conf import settings
 from django.urls import path
 from django.http.response import HttpResponse
-from app.views import signup, feed, login, logout, username_exists, chirp
+from app.views import (signup, feed, login, logout, username_exists, chirp,
+                       chirp_bulk, prometheus_metrics, search_chirps,
+                       tag_chirps, trending, user_search)
+
+if settings.CHIRPER_ASYNC_VIEWS:
+    from app.async_views import feed, username_exists
 
 app_name = 'chirper'
 
@@ -9,6 +15,12 @@ urlpatterns = [
     path('login/', login, name='login'),
     path('logout/', logout, name='logout'),
     path('chirp/', chirp, name='chirp'),
+    path('chirps/bulk/', chirp_bulk, name='chirp_bulk'),
+    path('_metrics', prometheus_metrics, name='metrics'),
+    path('users/search', user_search, name='user_search'),
+    path('search/chirps', search_chirps, name='search_chirps'),
+    path('tags/<tag>/', tag_chirps, name='tag_chirps'),
+    path('trending/', trending, name='trending'),
     path(
         'username_exists/<username>/', username_exists, name='username_exists'),
     path('<username>/', feed, name='feed'),
@@ -0,0 +1,222 @@
+'''Answers most lookups of usernames that are not taken without a query.
+
+`might_exist` checks a Bloom filter of every username. A Bloom filter never
+says "no" for a name that was added to it, while "yes" only means "maybe" and
+has to be confirmed by the database.
+
+Each process builds its filter in the background, when a worker starts (see
+`warm`) and again every `USERNAME_FILTER_REFRESH` seconds. Users saved in
+this process are added to it right away. Users saved by other processes are
+missing from it until the next rebuild, so every saved username is also kept
+in Django's cache for twice that long, and a "no" from the filter is only
+final once the cache confirms it. That cache has to be shared by every
+process, so with an in-memory one the filter is not used at all. A filter
+that is more than twice `USERNAME_FILTER_REFRESH` seconds old, or not built
+yet, answers "maybe" for every name. Users inserted without saving them
+through the ORM are only seen after the next rebuild.
+'''
+import hashlib
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, transaction
+
+from app import caching
+
+_lock = threading.Lock()
+# `adding` holds a list for each rebuild in progress, which collects the names
+# added while it reads.
+_state = {'filter': None, 'built': 0.0, 'rebuilding': False, 'adding': []}
+
+
+class BloomFilter:
+    '''`BloomFilter` is a compact set of strings that may report false positives.
+
+    It is sized so that with `capacity` strings added, about `error_rate` of
+    the strings that were not added are reported as present.
+    '''
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2)**2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item: str):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(item))
+
+
+def might_exist(username: str) -> bool:
+    'Returns `False` if `username` is certainly not taken.'
+    bloom = usable()
+    if bloom is None or username in bloom:
+        return True
+    return saved_recently(username)
+
+
+async def amight_exist(username: str) -> bool:
+    'The async version of `might_exist`.'
+    bloom = usable()
+    if bloom is None or username in bloom:
+        return True
+    return await asaved_recently(username)
+
+
+def cache():
+    return caches[settings.USERNAME_FILTER_CACHE_ALIAS]
+
+
+def saved_key(username: str) -> str:
+    digest = hashlib.md5(username.encode('utf-8')).hexdigest()
+    return 'username-saved:{}'.format(digest)
+
+
+def saved_recently(username: str) -> bool:
+    'Returns whether `username` was saved in the last `USERNAME_FILTER_REFRESH` seconds or so.'
+    return cache().get(saved_key(username)) is not None
+
+
+async def asaved_recently(username: str) -> bool:
+    'The async version of `saved_recently`.'
+    return await cache().aget(saved_key(username)) is not None
+
+
+def add(username: str):
+    '''Adds `username` to the filter, and to the one being rebuilt if there is one.
+
+    It is also marked as saved in the cache, for the filters of other
+    processes, now and again once the transaction commits.
+    '''
+    with _lock:
+        if _state['filter'] is not None:
+            _state['filter'].add(username)
+        for added in _state['adding']:
+            added.append(username)
+    mark_saved(username)
+    transaction.on_commit(lambda: mark_saved(username))
+
+
+def mark_saved(username: str):
+    cache().set(saved_key(username), True,
+                2 * settings.USERNAME_FILTER_REFRESH + 60)
+
+
+def reset():
+    'Drops the filter, so the next lookup builds a new one.'
+    with _lock:
+        _state['filter'] = None
+
+
+def shared() -> bool:
+    'Returns whether the cache of saved names is seen by every process, without which the filter is not used.'
+    return caching.shared(settings.USERNAME_FILTER_CACHE_ALIAS)
+
+
+def warm():
+    'Starts building the filter in the background, if there is none yet. Servers call this when a worker starts.'
+    if not shared():
+        return
+    with _lock:
+        if _state['filter'] is None:
+            start_rebuild()
+
+
+def usable():
+    '''Returns the filter if its "no" can be trusted, and `None` otherwise.
+
+    A missing filter, or one older than `USERNAME_FILTER_REFRESH` seconds, is
+    rebuilt in a background thread. Until it is more than twice that old, the
+    old one is still used.
+    '''
+    if not shared():
+        return None
+    with _lock:
+        bloom = _state['filter']
+        age = time.monotonic() - _state['built']
+        if bloom is None or age >= settings.USERNAME_FILTER_REFRESH:
+            start_rebuild()
+        if bloom is None or age >= 2 * settings.USERNAME_FILTER_REFRESH:
+            return None
+        return bloom
+
+
+def start_rebuild():
+    'Starts `rebuild_in_background` unless it is running. Must be called with `_lock` held.'
+    if not _state['rebuilding']:
+        _state['rebuilding'] = True
+        threading.Thread(target=rebuild_in_background, daemon=True).start()
+
+
+def build() -> BloomFilter:
+    'Builds a filter of every username in the database.'
+    count = User.objects.count()
+    bloom = BloomFilter(count + count // 2 + 1000,
+                        settings.USERNAME_FILTER_ERROR_RATE)
+    for username in User.objects.values_list(
+            'username', flat=True).iterator(chunk_size=10000):
+        bloom.add(username)
+    return bloom
+
+
+def _after_fork():
+    # A rebuild started before a fork (e.g. by chirper.asgi with gunicorn's
+    # --preload) does not run in the child.
+    _state['rebuilding'] = False
+    _state['adding'] = []
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def rebuild():
+    '''Builds a new filter of every username, on this thread, and starts using it.
+
+    `usable` and `warm` run this in a background thread.
+    '''
+    # The age of a filter counts from when it started reading, since names
+    # saved after that may be missing from it.
+    started = time.monotonic()
+    added = []
+    with _lock:
+        _state['adding'].append(added)
+    try:
+        bloom = build()
+    except Exception:
+        with _lock:
+            _state['adding'].remove(added)
+        raise
+    with _lock:
+        _state['adding'].remove(added)
+        # Names added while `build` was reading may be missing from its
+        # result, so they are added again.
+        for username in added:
+            bloom.add(username)
+        if started >= _state['built'] or _state['filter'] is None:
+            _state['filter'] = bloom
+            _state['built'] = started
+
+
+def rebuild_in_background():
+    try:
+        rebuild()
+    finally:
+        with _lock:
+            _state['rebuilding'] = False
+        connection.close()
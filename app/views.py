@@ -1,19 +1,36 @@
+import hashlib
+import hmac
 import json
 from http import HTTPStatus
 
+from django.conf import settings
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.exceptions import ValidationError
 from django.db.utils import IntegrityError
-from django.http import HttpRequest, HttpResponse
-from django.views.decorators.http import require_POST
-from django.contrib import auth
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_GET, require_POST
 
-from app.models import ChirperUser, Session
+from app import (feed_cache, hashing, metrics, pagination, replicas, search,
+                 serializers, usernames)
+from app.replicas import replica_reads
+from app.middleware import json_body, session_key
+from app.models import Chirp, ChirperUser, Hashtag, Session
+
+
+BULK_CHIRP_LIMIT = 100
+
+USER_SEARCH_LIMIT = 10
+
+USER_SEARCH_MAX_LIMIT = 50
+
+TRENDING_LIMIT = 10
 
 
 def JsonResponse(json_dumpable, status=HTTPStatus.OK):
     return HttpResponse(
-        json.dumps(json_dumpable),
+        serializers.dumps(json_dumpable),
         content_type='application/json',
         status=status)
 
@@ -34,9 +51,10 @@ def signup(request: HttpRequest) -> HttpResponse:
     Failure Responses:
         400, {error: "MALFORMED_REQUEST"}
         422, {error: "INVALID_DATA", errors: <ValidationErrors>}
+        503, {error: "BUSY"}
     '''
     try:
-        data = json.loads(request.body.decode('utf-8'))
+        data = json_body(request)
         name = data.get('name')
         username = data.get('username')
         email = data.get('email')
@@ -53,56 +71,216 @@ def signup(request: HttpRequest) -> HttpResponse:
             'error': 'INVALID_DATA',
             'errors': e.message_dict
         }, HTTPStatus.UNPROCESSABLE_ENTITY)
+    except hashing.Busy:
+        return busy_response()
 
     chirper.login()
 
     return JsonResponse({'key': chirper.session.key}, HTTPStatus.CREATED)
 
 
+@replica_reads
 def feed(request: HttpRequest, username: str) -> HttpResponse:
+    '''Returns a page of `username`'s feed.
+
+    By default the feed is paginated by page number with `?page=<n>`.
+
+    Pages are cached until a write changes the feed, see `app.feed_cache`.
+    Responses carry an `ETag`, and a matching `If-None-Match` gets a 304
+    before the page is read or serialized. Feeds that changed in the last
+    `REPLICA_PIN_SECONDS` seconds are read from the primary, see
+    `find_feed_owner`.
+
+    Passing `?before=<cursor>` switches to cursor mode, which does not count
+    the feed and costs the same no matter how deep the client has scrolled.
+    An empty `before` starts from the newest chirp. Cursor mode responses
+    include a `next_cursor` field, which is `null` on the last page.
+
+    With `?stream=1` the page is written out as its chirps are read from the
+    database instead of being built in memory first. Streamed pages are not
+    cached.
+
+    Failure Responses:
+        400, {error: "INVALID_CURSOR"}
+        404, {}
+    '''
     try:
-        chirper = ChirperUser.find_by_username(username)
+        chirper = find_feed_owner(username)
     except ChirperUser.DoesNotExist:
         return JsonResponse({}, HTTPStatus.NOT_FOUND)
-    paginator = Paginator(chirper.feed(), 25)
-    page = request.GET.get('page')
+    page_params = feed_page_params(request)
+    version = feed_cache.version(chirper.id)
+    etag = feed_etag(chirper, page_params, version)
+    cache_key = feed_cache.page_key(chirper.id, etag, version)
+    stream = request.GET.get('stream') == '1'
+    response = cached_feed_response(request, etag, cache_key, not stream)
+    if response is not None:
+        return response
+
+    cursor = request.GET.get('before')
+    if cursor is None:
+        paginator = Paginator(chirper.feed(), pagination.PAGE_SIZE)
+        page = request.GET.get('page')
+        try:
+            chirps = paginator.page(page)
+        except PageNotAnInteger:
+            chirps = paginator.page(1)
+        except EmptyPage:
+            chirps = paginator.page(paginator.num_pages)
+        extra = {}
+        if stream:
+            chirps = chirps.object_list.iterator()
+    else:
+        try:
+            before = pagination.decode_cursor(cursor) if cursor else None
+        except pagination.InvalidCursor:
+            return JsonResponse({
+                'error': 'INVALID_CURSOR'
+            }, HTTPStatus.BAD_REQUEST)
+        chirps = chirper.feed(before, limit=pagination.PAGE_SIZE + 1)
+        if stream:
+            chirps = pagination.KeysetPage(chirps)
+            extra = {'next_cursor': lambda: chirps.next_cursor}
+        else:
+            chirps, next_cursor = pagination.keyset_page(chirps)
+            extra = {'next_cursor': next_cursor}
+
+    if stream:
+        response = StreamingHttpResponse(
+            serializers.stream_feed(chirper, chirps, **extra),
+            content_type='application/json')
+        response['ETag'] = etag
+        return response
+    return feed_response(chirper, chirps, extra, etag, cache_key)
+
+
+def find_feed_owner(username: str) -> ChirperUser:
+    '''Returns `ChirperUser.find_feed_owner(username)`, from the primary if a replica may be behind on the feed.
+
+    When the feed changed in the last `REPLICA_PIN_SECONDS` seconds, or the
+    user signed up lately and the replica does not have them yet, the owner
+    is read again from the primary and so is the rest of the view.
+    '''
     try:
-        chirps = paginator.page(page)
-    except PageNotAnInteger:
-        chirps = paginator.page(1)
-    except EmptyPage:
-        chirps = paginator.page(paginator.num_pages)
-    return JsonResponse({
-        'chirper': {
-            'name': chirper.name,
-            'username': chirper.username,
-            'description': chirper.description,
-            'location': chirper.location,
-            'website': chirper.website,
-            'joined': {
-                'month': chirper.joined.month,
-                'year': chirper.joined.year
-            }
-        },
-        'chirps': [{
-            'author': {
-                'name': c.author.name,
-                'username': c.author.username
-            },
-            'date': {
-                'month': c.date.month,
-                'day': c.date.day,
-                'year': c.date.year
-            },
-            'message': c.message
-        } for c in chirps]
-    }, 200)
+        chirper = ChirperUser.find_feed_owner(username)
+    except ChirperUser.DoesNotExist:
+        if not (replicas.reading_replica() and
+                usernames.saved_recently(username)):
+            raise
+    else:
+        if not (replicas.reading_replica() and
+                feed_cache.written_recently(chirper.id)):
+            return chirper
+    replicas.read_from_primary()
+    return ChirperUser.find_feed_owner(username)
+
+
+async def afind_feed_owner(username: str) -> ChirperUser:
+    'The async version of `find_feed_owner`.'
+    try:
+        chirper = await ChirperUser.afind_feed_owner(username)
+    except ChirperUser.DoesNotExist:
+        if not (replicas.reading_replica() and
+                await usernames.asaved_recently(username)):
+            raise
+    else:
+        if not (replicas.reading_replica() and
+                await feed_cache.awritten_recently(chirper.id)):
+            return chirper
+    replicas.read_from_primary()
+    return await ChirperUser.afind_feed_owner(username)
+
+
+def feed_page_params(request: HttpRequest) -> str:
+    'Returns a string naming the page of the feed that `request` asks for.'
+    cursor = request.GET.get('before')
+    if cursor is None:
+        return 'page:{}'.format(request.GET.get('page'))
+    return 'before:' + cursor
+
+
+def cached_feed_response(request: HttpRequest, etag: str, cache_key: str,
+                         use_cache: bool=True):
+    '''Answers a feed request without reading the feed, if possible.
+
+    Returns a 304 if the client already has the page, the cached page if there
+    is one, or `None` if the page has to be built.
+    '''
+    response = not_modified_response(request, etag)
+    if response is None and use_cache:
+        response = cached_page_response(feed_cache.get_page(cache_key), etag)
+    return response
+
+
+async def acached_feed_response(request: HttpRequest, etag: str,
+                                cache_key: str):
+    'The async version of `cached_feed_response`.'
+    response = not_modified_response(request, etag)
+    if response is None:
+        response = cached_page_response(
+            await feed_cache.aget_page(cache_key), etag)
+    return response
+
+
+def not_modified_response(request: HttpRequest, etag: str):
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+    return not_modified
+
+
+def cached_page_response(content, etag: str):
+    if content is None:
+        return None
+    response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def feed_response(chirper: ChirperUser, chirps, extra: dict, etag: str,
+                  cache_key: str) -> HttpResponse:
+    'Serializes a page of `chirper`\'s feed and caches it under `cache_key`.'
+    response = JsonResponse(serializers.feed(chirper, chirps, **extra))
+    feed_cache.set_page(cache_key, response.content)
+    response['ETag'] = etag
+    return response
+
+
+async def afeed_response(chirper: ChirperUser, chirps, extra: dict, etag: str,
+                         cache_key: str) -> HttpResponse:
+    'The async version of `feed_response`.'
+    response = JsonResponse(serializers.feed(chirper, chirps, **extra))
+    await feed_cache.aset_page(cache_key, response.content)
+    response['ETag'] = etag
+    return response
+
+
+def feed_etag(chirper: ChirperUser, page_params: str, version: int) -> str:
+    '''Returns an ETag for a page of `chirper`'s feed, without reading the page.
+
+    It changes when a chirp enters the feed, when the feed's cache `version`
+    is bumped, or when `chirper`'s profile changes. Pages are cached under
+    it, so a page built from a replica that had not seen a chirp yet is only
+    found by readers of replicas that had not either.
+    '''
+    validator = '|'.join(
+        str(part) for part in [
+            chirper.newest_chirp_id,
+            version,
+            chirper.name,
+            chirper.description,
+            chirper.location,
+            chirper.website,
+            chirper.joined,
+            page_params,
+        ])
+    return quote_etag(hashlib.md5(validator.encode('utf-8')).hexdigest())
 
 
 @require_POST
 def login(request):
     try:
-        data = json.loads(request.body.decode('utf-8'))
+        data = json_body(request)
     except json.JSONDecodeError:
         return JsonResponse({
             'error': 'MALFORMED_REQUEST'
@@ -116,42 +294,170 @@ def login(request):
             'error': 'INVALID_DATA'
         }, HTTPStatus.UNPROCESSABLE_ENTITY)
 
-    user = auth.authenticate(request, username=username, password=password)
-    if user is not None:
-        user.chirperuser.login()
-        return JsonResponse({'key': user.chirperuser.session.key}, HTTPStatus.CREATED)
+    try:
+        chirper = ChirperUser.authenticate(username, password)
+    except hashing.Busy:
+        return busy_response()
+    if chirper is not None:
+        chirper.login()
+        return JsonResponse({'key': chirper.session.key}, HTTPStatus.CREATED)
     else:
         return JsonResponse({
             'error': 'INVALID_USERNAME_PASSWORD'
         }, HTTPStatus.UNAUTHORIZED)
 
 
+def busy_response() -> HttpResponse:
+    'The response for a request turned away because `app.hashing` is overloaded.'
+    response = JsonResponse({'error': 'BUSY'}, HTTPStatus.SERVICE_UNAVAILABLE)
+    response['Retry-After'] = '1'
+    return response
+
+
 @require_POST
 def logout(request):
     try:
-        data = json.loads(request.body.decode('utf-8'))
+        key = session_key(request)
     except json.JSONDecodeError:
         return JsonResponse({
             'error': 'MALFORMED_REQUEST'
         }, HTTPStatus.BAD_REQUEST)
-        key = data['key']
-    try:
-        key = data['key']
-    except KeyError:
+    if key is None:
         return JsonResponse({
             'error': 'INVALID_DATA'
         }, HTTPStatus.UNPROCESSABLE_ENTITY)
-    
+
     Session.delete_with_key(key)
     return JsonResponse({})
 
+@replica_reads
 def username_exists(request, username):
-    return JsonResponse({'exists': ChirperUser.username_exists(username)})
+    if replicas.reading_replica() and usernames.saved_recently(username):
+        # The replica may not have the user yet.
+        replicas.read_from_primary()
+    return username_exists_response(request,
+                                    ChirperUser.username_exists(username))
+
+
+def username_exists_response(request: HttpRequest, exists: bool) -> HttpResponse:
+    etag = quote_etag('exists' if exists else 'missing')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse({'exists': exists})
+    response['ETag'] = etag
+    patch_cache_control(
+        response, public=True, max_age=settings.USERNAME_EXISTS_MAX_AGE)
+    return response
+
+@replica_reads
+def user_search(request: HttpRequest) -> HttpResponse:
+    '''Returns the users whose username starts with `?prefix=`, for mention autocomplete.
+
+    A leading `@` in the prefix is ignored. `?limit=` caps the number of users
+    returned, up to 50, and defaults to 10.
+
+    Success Response:
+        200, {users: [{username, name}]}
+
+    Failure Responses:
+        422, {error: "INVALID_DATA"}
+    '''
+    prefix = request.GET.get('prefix', '').lstrip('@')
+    try:
+        limit = int(request.GET.get('limit', USER_SEARCH_LIMIT))
+    except ValueError:
+        limit = 0
+    if not prefix or not 1 <= limit <= USER_SEARCH_MAX_LIMIT:
+        return JsonResponse({
+            'error': 'INVALID_DATA'
+        }, HTTPStatus.UNPROCESSABLE_ENTITY)
+    users = [{
+        'username': username,
+        'name': name
+    } for username, name in ChirperUser.search(prefix, limit)]
+    return JsonResponse({'users': users})
+
+
+@replica_reads
+def search_chirps(request: HttpRequest) -> HttpResponse:
+    '''Returns the chirps that contain every word of `?q=`, newest first.
+
+    Results are paged like the feed with `?before=`: pass the `next_cursor`
+    of a page as `?before=` to get the next one.
+
+    Success Response:
+        200, {chirps: [<chirp>], next_cursor: <cursor or null>}
+
+    Failure Responses:
+        400, {error: "INVALID_CURSOR"}
+        422, {error: "INVALID_DATA"}
+    '''
+    query = request.GET.get('q', '')
+    if not search.terms(query):
+        return JsonResponse({
+            'error': 'INVALID_DATA'
+        }, HTTPStatus.UNPROCESSABLE_ENTITY)
+    cursor = request.GET.get('before')
+    try:
+        before = pagination.decode_cursor(cursor) if cursor else None
+    except pagination.InvalidCursor:
+        return JsonResponse({
+            'error': 'INVALID_CURSOR'
+        }, HTTPStatus.BAD_REQUEST)
+    chirps, next_cursor = pagination.keyset_page(Chirp.search(query, before))
+    return JsonResponse({
+        'chirps': [serializers.chirp(c) for c in chirps],
+        'next_cursor': next_cursor
+    })
+
+
+@replica_reads
+def tag_chirps(request: HttpRequest, tag: str) -> HttpResponse:
+    '''Returns a page of the chirps tagged with `#<tag>`, newest first.
+
+    Pages work like `search_chirps`, with `?before=` and `next_cursor`.
+
+    Success Response:
+        200, {tag: <tag>, chirps: [<chirp>], next_cursor: <cursor or null>}
+
+    Failure Responses:
+        400, {error: "INVALID_CURSOR"}
+    '''
+    tag = tag.lstrip('#').casefold()
+    cursor = request.GET.get('before')
+    try:
+        before = pagination.decode_cursor(cursor) if cursor else None
+    except pagination.InvalidCursor:
+        return JsonResponse({
+            'error': 'INVALID_CURSOR'
+        }, HTTPStatus.BAD_REQUEST)
+    chirps, next_cursor = pagination.keyset_page(Hashtag.chirps(tag, before))
+    return JsonResponse({
+        'tag': tag,
+        'chirps': [serializers.chirp(c) for c in chirps],
+        'next_cursor': next_cursor
+    })
+
+
+@replica_reads
+def trending(request: HttpRequest) -> HttpResponse:
+    '''Returns the most used hashtags of the last `TRENDING_WINDOW_MINUTES` minutes.
+
+    Success Response:
+        200, {tags: [{tag, count}]}
+    '''
+    return JsonResponse({
+        'tags': [{
+            'tag': tag,
+            'count': count
+        } for tag, count in Hashtag.trending(TRENDING_LIMIT)]
+    })
+
 
 @require_POST
 def chirp(request):
     try:
-        data = json.loads(request.body.decode('utf-8'))
+        data = json_body(request)
         message = data['message']
         
         if request.user.is_authenticated:
@@ -164,3 +470,68 @@ def chirp(request):
         return JsonResponse({}, status=HTTPStatus.UNPROCESSABLE_ENTITY)
     else:
         return JsonResponse({}, status=HTTPStatus.CREATED)
+
+
+@require_POST
+def chirp_bulk(request):
+    '''Creates a chirp for each message in a batch, for the logged in user.
+
+    It expects a json payload with the following fields:
+        - messages, a list of at most `BULK_CHIRP_LIMIT` messages
+
+    Success Response:
+        200, {results: [{status: 201} | {status: 422, errors: <ValidationErrors>}]}
+            with one result per message, in order
+
+    Failure Responses:
+        400, {error: "MALFORMED_REQUEST"}
+        401, {}
+        422, {error: "INVALID_DATA"}
+    '''
+    try:
+        messages = json_body(request)['messages']
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'error': 'MALFORMED_REQUEST'
+        }, HTTPStatus.BAD_REQUEST)
+    except (KeyError, TypeError):
+        return JsonResponse({
+            'error': 'INVALID_DATA'
+        }, HTTPStatus.UNPROCESSABLE_ENTITY)
+    if not isinstance(messages, list) or len(messages) > BULK_CHIRP_LIMIT:
+        return JsonResponse({
+            'error': 'INVALID_DATA'
+        }, HTTPStatus.UNPROCESSABLE_ENTITY)
+
+    if not request.user.is_authenticated:
+        return JsonResponse({}, status=HTTPStatus.UNAUTHORIZED)
+
+    results = []
+    for result in request.user.chirp_many(messages):
+        if isinstance(result, ValidationError):
+            results.append({
+                'status': HTTPStatus.UNPROCESSABLE_ENTITY,
+                'errors': result.message_dict
+            })
+        else:
+            results.append({'status': HTTPStatus.CREATED})
+    return JsonResponse({'results': results})
+
+
+@require_GET
+def prometheus_metrics(request: HttpRequest) -> HttpResponse:
+    '''Returns the metrics of every worker process in the Prometheus text format.
+
+    See `app.metrics`. The request must send `METRICS_TOKEN` as
+    `Authorization: Bearer <token>`, and without a token configured there is
+    nothing to scrape.
+    '''
+    if not settings.CHIRPER_METRICS or not settings.METRICS_TOKEN:
+        return JsonResponse({}, HTTPStatus.NOT_FOUND)
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(
+            token.strip(), settings.METRICS_TOKEN):
+        return JsonResponse({}, HTTPStatus.UNAUTHORIZED)
+    return HttpResponse(
+        metrics.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,30 @@
+"""
+ASGI config for chirper project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+It also serves the feed and username_exists views from app.async_views, so
+a worker keeps answering other requests while those wait on the database.
+Signup and login stay sync views, which Django runs in a thread, so password
+hashing never runs on the event loop.
+
+Run it with, for example:
+
+    gunicorn chirper.asgi:application -k uvicorn.workers.UvicornWorker
+
+For more information on this file, see
+https://docs.djangoproject.com/en/dev/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chirper.settings")
+os.environ.setdefault("CHIRPER_ASYNC_VIEWS", "1")
+
+application = get_asgi_application()
+
+# Started here as well, for servers that do not read gunicorn.conf.py.
+from app import usernames  # noqa: E402
+
+usernames.warm()
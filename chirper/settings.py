@@ -42,6 +42,8 @@ if not os.environ.get('DEBUG', False):
     INSTALLED_APPS.append('raven.contrib.django.raven_compat')
 
 MIDDLEWARE = [
+    'app.middleware.request_timing',
+    'app.middleware.record_metrics',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,8 +55,47 @@ ROOT_URLCONF = 'chirper.urls'
 
 TEMPLATES = []
 
+# The API authenticates with its own session keys (`app.middleware` sets
+# `request.user` to a `ChirperUser`), so Django's templates, sessions and
+# messages, which the admin would need, are left out on purpose.
+
+SILENCED_SYSTEM_CHECKS = [
+    'admin.E403', 'admin.E406', 'admin.E408', 'admin.E409', 'admin.E410'
+]
+
 WSGI_APPLICATION = 'chirper.wsgi.application'
 
+ASGI_APPLICATION = 'chirper.asgi.application'
+
+# Serve the read-only views from `app.async_views`. `chirper.asgi` turns this
+# on, since async views only help when the server runs an event loop.
+
+CHIRPER_ASYNC_VIEWS = bool(os.environ.get('CHIRPER_ASYNC_VIEWS', False))
+
+# `app.middleware.request_timing` measures this fraction of requests, between 0
+# and 1, and adds a Server-Timing header and an `app.timing` log line to them.
+# At 0 the middleware is not loaded at all.
+
+REQUEST_TIMING_SAMPLE_RATE = float(
+    os.environ.get('REQUEST_TIMING_SAMPLE_RATE', 0))
+
+# `app.metrics` counts requests, cache hits and chirp writes, and serves them at
+# /api/_metrics for Prometheus. Scrapes must send `Authorization: Bearer
+# <METRICS_TOKEN>`; without a token the endpoint does not exist, and metrics
+# are only collected when a token is set unless CHIRPER_METRICS says otherwise.
+# With several worker processes, set METRICS_DIR to a directory they share (a
+# tmpfs is best); each worker writes its numbers there at most every
+# METRICS_FLUSH_INTERVAL seconds and every scrape adds them up.
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+CHIRPER_METRICS = os.environ.get('CHIRPER_METRICS',
+                                 '1' if METRICS_TOKEN else '0') != '0'
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
 # Database
 # https://docs.djangoproject.com/en/dev/ref/settings/#databases
 
@@ -67,6 +108,163 @@ DATABASES = {
 
 DATABASES['default'].update(dj_database_url.config(conn_max_age=500))
 
+# The type of primary keys the migrations already created.
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# REPLICA_DATABASE_URL is a comma separated list of read replicas of the
+# default database. `app.replicas` sends the reads of the feed, username and
+# search views to them, except for feeds that changed in the last
+# REPLICA_PIN_SECONDS seconds and users who signed up lately, which are read
+# from the default database. That is remembered in the FEED_CACHE_ALIAS and
+# USERNAME_FILTER_CACHE_ALIAS caches, so they have to be shared (CACHE_BACKEND
+# set to memcached or redis, or a file cache on a single host). To try it
+# locally, point it at a copy of the SQLite file, e.g.
+# REPLICA_DATABASE_URL=sqlite:////tmp/replica.sqlite3
+# CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache
+# CACHE_LOCATION=/tmp/chirper-cache
+
+REPLICA_DATABASES = []
+
+for i, url in enumerate(
+        u.strip() for u in os.environ.get('REPLICA_DATABASE_URL', '').split(',')
+        if u.strip()):
+    alias = 'replica{}'.format(i)
+    DATABASES[alias] = dj_database_url.parse(url, conn_max_age=500)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    REPLICA_DATABASES.append(alias)
+
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', 5))
+
+# CHIRP_SHARD_DATABASE_URLS is a comma separated list of databases that chirps,
+# their mentions and hashtags are spread over by author, see `app.sharding`.
+# The word `default` stands for the default database. Every shard needs the
+# full schema (`manage.py migrate --database shard1`), and shards may only be
+# added to the end of the list, after which `manage.py rebalance_chirps` moves
+# the chirps that now belong elsewhere. Sharded feeds are only revalidated
+# through the FEED_CACHE_ALIAS cache, so it has to be shared (CACHE_BACKEND set
+# to memcached or redis, or a file cache on a single host). To try it locally
+# with SQLite files:
+# CHIRP_SHARD_DATABASE_URLS=default,sqlite:////tmp/shard1.sqlite3
+# CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache
+# CACHE_LOCATION=/tmp/chirper-cache
+
+CHIRP_SHARDS = []
+
+for i, url in enumerate(
+        u.strip() for u in os.environ.get('CHIRP_SHARD_DATABASE_URLS', '').split(',')
+        if u.strip()):
+    if url == 'default':
+        CHIRP_SHARDS.append('default')
+        continue
+    alias = 'shard{}'.format(i)
+    DATABASES[alias] = dj_database_url.parse(url, conn_max_age=500)
+    CHIRP_SHARDS.append(alias)
+
+# Number of threads per process that read feeds from the shards in parallel.
+
+CHIRP_SHARD_WORKERS = int(os.environ.get('CHIRP_SHARD_WORKERS', 8))
+
+# Where chirp ids come from: 'database' uses the table's sequence, 'snowflake'
+# generates time-ordered 64-bit ids in the process, see `app.snowflake`.
+# Every process writing chirps needs its own CHIRP_ID_WORKER (0-1023), which
+# gunicorn.conf.py sets per worker from the range of its host (see
+# chirp_id_workers there); unset, the process id is used.
+
+CHIRP_ID_SOURCE = os.environ.get('CHIRP_ID_SOURCE', 'database')
+
+CHIRP_ID_WORKER = (int(os.environ['CHIRP_ID_WORKER'])
+                   if os.environ.get('CHIRP_ID_WORKER') else None)
+
+DATABASE_ROUTERS = ['app.replicas.ReplicaRouter', 'app.sharding.ShardRouter']
+
+# Directory of the segment files `archive_chirps` moves old chirps into, see
+# `app.archive`. Feeds continue into the archive after the database's chirps
+# run out. Every process serving feeds needs to see the same directory.
+# Unset, nothing is archived.
+
+CHIRP_ARCHIVE_DIR = os.environ.get('CHIRP_ARCHIVE_DIR') or None
+
+# Caches
+# https://docs.djangoproject.com/en/dev/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND':
+        os.environ.get('CACHE_BACKEND',
+                       'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION':
+        os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Serialized feed pages are cached under a per-user feed version, which writes
+# bump, so FEED_CACHE_TIMEOUT only bounds how long unused pages are kept.
+
+FEED_CACHE_ALIAS = 'default'
+
+FEED_CACHE_TIMEOUT = int(os.environ.get('FEED_CACHE_TIMEOUT', 300))
+
+# Where `ChirperUser.feed` reads from: 'live' computes the feed from chirps and
+# mentions on every read, 'timeline' reads the per-user `TimelineEntry` rows.
+# Sharded chirps have no timeline entries, so 'timeline' is refused with them.
+
+CHIRPER_FEED_SOURCE = os.environ.get('CHIRPER_FEED_SOURCE', 'live')
+
+# `ChirperUser.find_by_key` keeps recently used session keys in this Django
+# cache for SESSION_KEY_CACHE_TTL seconds, see `app.session_cache`. Logging out
+# or in forgets the old key there, so it stops working everywhere at once.
+# That needs a cache every process shares (CACHE_BACKEND set to memcached or
+# redis); with the default in-memory cache no keys are cached.
+
+SESSION_KEY_CACHE_ALIAS = 'default'
+
+SESSION_KEY_CACHE_TTL = float(os.environ.get('SESSION_KEY_CACHE_TTL', 60))
+
+# Logins check passwords on a pool of PASSWORD_HASH_WORKERS threads. Once
+# PASSWORD_HASH_QUEUE more logins are waiting for a worker, further logins are
+# answered with 503 and a Retry-After header. Together they must stay below
+# the request threads per process (`threads` in gunicorn.conf.py), or a burst
+# of logins can still occupy every thread.
+
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 4))
+
+# `app.usernames` keeps a Bloom filter of taken usernames so that
+# username_exists can answer "no" without a query. About
+# USERNAME_FILTER_ERROR_RATE of the names that are not taken still need a
+# query. Each process rebuilds its filter every USERNAME_FILTER_REFRESH seconds,
+# and saved usernames are kept in the USERNAME_FILTER_CACHE_ALIAS cache until
+# every filter has them. That cache has to be shared (CACHE_BACKEND set to
+# memcached or redis); with the default in-memory cache the filter is not used
+# and every lookup is a query. Answers may be cached by clients
+# for USERNAME_EXISTS_MAX_AGE seconds.
+
+USERNAME_FILTER_ERROR_RATE = float(
+    os.environ.get('USERNAME_FILTER_ERROR_RATE', 0.01))
+
+USERNAME_FILTER_REFRESH = float(os.environ.get('USERNAME_FILTER_REFRESH', 300))
+
+USERNAME_FILTER_CACHE_ALIAS = 'default'
+
+USERNAME_EXISTS_MAX_AGE = int(os.environ.get('USERNAME_EXISTS_MAX_AGE', 10))
+
+# `ChirperUser.search` keeps recent results per prefix in a per-process cache,
+# so a new user can take USER_SEARCH_CACHE_TTL seconds to show up in them.
+
+USER_SEARCH_CACHE_SIZE = int(os.environ.get('USER_SEARCH_CACHE_SIZE', 10000))
+
+USER_SEARCH_CACHE_TTL = float(os.environ.get('USER_SEARCH_CACHE_TTL', 30))
+
+# `Hashtag.trending` adds up the per-minute hashtag counts of the last
+# TRENDING_WINDOW_MINUTES minutes. Each process recomputes it at most every
+# TRENDING_CACHE_TTL seconds.
+
+TRENDING_WINDOW_MINUTES = int(os.environ.get('TRENDING_WINDOW_MINUTES', 60))
+
+TRENDING_CACHE_TTL = float(os.environ.get('TRENDING_CACHE_TTL', 30))
+
 # Password validation
 # https://docs.djangoproject.com/en/dev/ref/settings/#auth-password-validators
 
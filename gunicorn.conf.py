@@ -0,0 +1,62 @@
+'''Gunicorn settings, read from the working directory when gunicorn starts.'''
+import os
+import re
+
+# Threaded workers, so a request waiting on `app.hashing` or the database does
+# not hold up its whole process. Keep PASSWORD_HASH_WORKERS +
+# PASSWORD_HASH_QUEUE below `threads`, so logins never take every thread.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+
+def chirp_id_workers():
+    '''Returns the `(base, span)` of the `app.snowflake` worker ids of this host.
+
+    Every host writing chirps to the same database needs its own range of ids.
+    It starts at CHIRP_ID_WORKER_BASE, or on Heroku, where every dyno has the
+    same config vars, at the dyno's number in DYNO: web.1 gets the first
+    CHIRP_ID_WORKER_SPAN (default 32) ids, web.2 the next ones, and so on.
+    Returns `None` if neither is set.
+    '''
+    span = os.environ.get('CHIRP_ID_WORKER_SPAN')
+    dyno = re.fullmatch(r'\w+\.(\d+)', os.environ.get('DYNO', ''))
+    if os.environ.get('CHIRP_ID_WORKER_BASE'):
+        base = int(os.environ['CHIRP_ID_WORKER_BASE'])
+        span = int(span or 1024 - base)
+    elif dyno:
+        span = int(span or 32)
+        base = (int(dyno.group(1)) - 1) * span
+    else:
+        return None
+    if base < 0 or span < 1 or base + span > 1024:
+        raise RuntimeError(
+            'Chirp id workers {} to {} are outside 0-1023.'.format(
+                base, base + span - 1))
+    return base, span
+
+
+def on_starting(server):
+    # Without a range per host, every host would give its workers the same
+    # ids, and chirps written at the same millisecond would collide.
+    if (os.environ.get('CHIRP_ID_SOURCE') == 'snowflake' and
+            chirp_id_workers() is None):
+        raise RuntimeError(
+            'Set CHIRP_ID_WORKER_BASE to a different range on every host '
+            'writing chirps, see chirp_id_workers in gunicorn.conf.py.')
+
+
+def post_fork(server, worker):
+    # Gives each worker its own `app.snowflake` worker id, before the worker
+    # loads the settings (so not with --preload). `worker.age` counts the
+    # workers this arbiter has started, so two live workers only share an id
+    # if SPAN workers were started while one of them kept running.
+    workers = chirp_id_workers()
+    if workers is not None:
+        base, span = workers
+        os.environ['CHIRP_ID_WORKER'] = str(base + worker.age % span)
+
+
+def post_worker_init(worker):
+    # Starts building the username filter before the first request needs it.
+    from app import usernames
+    usernames.warm()